@@ -0,0 +1,361 @@
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import rdflib
+import requests
+
+from LinkedDicomTe.util import new_http_session
+
+# uncompressed size of a chunk of N-Triples lines
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+# gzip level of the chunks, low levels compress N-Triples well enough at a fraction of the CPU time
+GZIP_LEVEL = 1
+# status codes after which a chunk is sent again
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+# size of the blocks read from a file which is streamed as one request
+STREAM_BLOCK_SIZE = 1024 * 1024
+# number of lines checked to recognize an N-Triples file
+SNIFF_LINES = 1000
+# rdflib parser formats of the content types accepted by upload_file
+RDF_FORMATS = {
+    "application/n-triples": "nt",
+    "text/plain": "nt",
+    "application/x-turtle": "turtle",
+    "text/turtle": "turtle",
+    "application/ld+json": "json-ld",
+    "application/json": "json-ld",
+    "application/rdf+xml": "xml",
+}
+
+
+def nt_lines(triples):
+    """
+    :param triples: iterable of (subject, predicate, object) rdflib terms
+    :return: generator of the triples as N-Triples lines in bytes
+    """
+    for subject, predicate, value in triples:
+        yield f"{subject.n3()} {predicate.n3()} {value.n3()} .\n".encode("utf-8")
+
+
+def is_ntriples(file_path):
+    """
+    Check whether a file is N-Triples, a subset of Turtle which can be split at any line.
+    The streamed results of ldcm-parse are N-Triples, also when saved with the ttl extension.
+    :param file_path:
+    :return: True when the first lines all are one complete triple
+    """
+    if file_path.endswith(".nt"):
+        return True
+    with open(file_path, "rb") as file:
+        for index, line in enumerate(file):
+            if index >= SNIFF_LINES:
+                break
+            line = line.strip()
+            if not line or line.startswith(b"#"):
+                continue
+            if not (line.startswith(b"<") or line.startswith(b"_:")) or not line.endswith(b"."):
+                return False
+    return True
+
+
+def file_blocks(file_path, compress=True, block_size=STREAM_BLOCK_SIZE):
+    """
+    :param file_path:
+    :param compress: gzip compress the blocks, as one gzip stream
+    :param block_size: size of the blocks read from the file
+    :return: generator of the (compressed) blocks of the file in bytes
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            block = compressor.compress(block) if compress else block
+            if block:
+                yield block
+    if compress:
+        yield compressor.flush()
+
+
+def chunk_lines(lines, chunk_size):
+    """
+    :param lines: iterable of lines in bytes
+    :param chunk_size: minimum size of a chunk in bytes, the last chunk can be smaller
+    :return: generator of (chunk index, chunk bytes, number of lines)
+    """
+    index = 0
+    buffer = io.BytesIO()
+    count = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        buffer.write(line if line.endswith(b"\n") else line + b"\n")
+        count += 1
+        if buffer.tell() >= chunk_size:
+            yield index, buffer.getvalue(), count
+            index += 1
+            buffer = io.BytesIO()
+            count = 0
+    if count:
+        yield index, buffer.getvalue(), count
+
+
+class UploadCheckpoint:
+    """
+    Chunks of a file which are uploaded, kept in a JSON file so an interrupted upload continues with the
+    missing chunks. The checkpoint is only used for the same file, unchanged, with the same chunk size.
+    Sending a chunk twice is harmless, as the repository keeps one copy of every triple.
+    """
+
+    def __init__(self, checkpoint_path, source_path, chunk_size):
+        stat = os.stat(source_path)
+        self.checkpoint_path = checkpoint_path
+        self.__source = {
+            "path": os.path.abspath(source_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "chunk_size": chunk_size,
+        }
+        self.__lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as file:
+                checkpoint = json.load(file)
+            if checkpoint.get("source") == self.__source:
+                self.done = set(checkpoint["done"])
+                logging.info(f"Upload checkpoint {checkpoint_path}: {len(self.done)} chunks done")
+            else:
+                logging.warning(f"Upload checkpoint {checkpoint_path} is of another file or chunk size, "
+                                f"starting over")
+
+    def is_done(self, index):
+        return index in self.done
+
+    def mark_done(self, index):
+        with self.__lock:
+            self.done.add(index)
+            temporary_path = self.checkpoint_path + ".tmp"
+            with open(temporary_path, "w") as file:
+                json.dump({"source": self.__source, "done": sorted(self.done)}, file)
+            os.replace(temporary_path, self.checkpoint_path)
+
+
+class BulkUploader:
+    """
+    Upload N-Triples to an HTTP endpoint (e.g. the statements of a GraphDB repository) in chunks of a fixed
+    size, streamed from the source so only the chunks in flight are in memory. The chunks are gzip compressed
+    and sent by a bounded number of threads over one keep-alive session, a failed chunk is sent again after an
+    exponential backoff with jitter. Formats which cannot be split, such as Turtle, are streamed as one request.
+    """
+
+    def __init__(self, url, content_type="application/n-triples", chunk_size=DEFAULT_CHUNK_SIZE, workers=4,
+                 retries=5, backoff=1.0, compress=True, timeout=300, session=None, progress_interval=30):
+        """
+        :param url: endpoint the chunks are posted to
+        :param content_type: content type of the chunks, N-Triples can also be sent as Turtle
+        :param chunk_size: uncompressed size of a chunk in bytes
+        :param workers: number of chunks sent at the same time
+        :param retries: number of times a failed chunk is sent again
+        :param backoff: seconds before the first retry, doubled for every next retry
+        :param compress: send the chunks with gzip content encoding
+        :param timeout: seconds to wait for the response of a chunk
+        :param session: requests Session to use, a pooled session is created when None
+        :param progress_interval: minimum number of seconds between two progress log messages
+        """
+        self.url = url
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.compress = compress
+        self.timeout = timeout
+        self.session = session if session is not None else new_http_session(self.workers)
+        self.progress_interval = progress_interval
+        self.__lock = threading.Lock()
+        self.__reset()
+
+    def __reset(self):
+        self.chunks = 0
+        self.skipped = 0
+        self.failed = []
+        self.triples = 0
+        self.bytes = 0
+        self.sent_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_log_time = self.start_time
+
+    def upload_file(self, file_path, rdf_format=None, checkpoint_path=None, parse_in_memory=False):
+        """
+        Upload an RDF file. N-Triples files are sent in chunks, Turtle files are streamed as one request.
+        Other formats are refused, unless parse_in_memory is set: the file is then parsed in memory first, which
+        takes many times the size of the file, so this is only meant for small (e.g. JSON-LD) files.
+        :param file_path:
+        :param rdf_format: rdflib format of the file, guessed from the extension and content when None
+        :param checkpoint_path: JSON file recording the uploaded chunks, to resume an interrupted upload
+        :param parse_in_memory: parse a file which is neither N-Triples nor Turtle with rdflib
+        :return: report, see report
+        """
+        if rdf_format == "nt" or (rdf_format is None and is_ntriples(file_path)):
+            checkpoint = None
+            if checkpoint_path is not None:
+                checkpoint = UploadCheckpoint(checkpoint_path, file_path, self.chunk_size)
+            with open(file_path, "rb") as file:
+                return self.upload_lines(file, checkpoint)
+
+        rdf_format = rdf_format or rdflib.util.guess_format(file_path) or "turtle"
+        if checkpoint_path is not None:
+            logging.warning("The upload checkpoint is only used for N-Triples files")
+        if rdf_format == "turtle":
+            logging.info(f"{file_path} is not N-Triples, it is streamed as one Turtle request")
+            return self.upload_stream(file_path, "text/turtle")
+        if not parse_in_memory:
+            raise Exception(f"{file_path} is {rdf_format}, only N-Triples and Turtle files are streamed. Export "
+                            f"the results with ldcm-parse --stream, or parse a small file in memory with "
+                            f"parse_in_memory")
+
+        logging.info(f"Parsing {file_path} as {rdf_format} to upload it as N-Triples")
+        graph = rdflib.Graph()
+        graph.parse(file_path, format=rdf_format)
+        return self.upload_lines(nt_lines(graph))
+
+    def upload_stream(self, file_path, content_type=None):
+        """
+        Upload a file as one request, read in blocks and gzip compressed while it is sent (chunked transfer
+        encoding), for formats which cannot be split, such as Turtle. A failed request sends the whole file again.
+        :param file_path:
+        :param content_type: content type of the file, the content type of the uploader when None
+        :return: report, see report
+        """
+        self.__reset()
+        sent = {"bytes": 0}
+
+        def body():
+            sent["bytes"] = 0
+            for block in file_blocks(file_path, self.compress):
+                sent["bytes"] += len(block)
+                yield block
+
+        if self.__post(f"Stream of {file_path}", body, content_type or self.content_type):
+            self.chunks = 1
+            self.bytes = os.path.getsize(file_path)
+            self.sent_bytes = sent["bytes"]
+        else:
+            self.__failed(0)
+        return self.__finish()
+
+    def upload_lines(self, lines, checkpoint=None):
+        """
+        :param lines: iterable of N-Triples lines in bytes
+        :param checkpoint: UploadCheckpoint, chunks done according to it are skipped
+        :return: report, see report
+        """
+        self.__reset()
+        # chunks read ahead of the threads, bounds the memory to the chunks in flight
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def send(index, chunk, count):
+            try:
+                self.__send(index, chunk, count, checkpoint)
+            except Exception as e:
+                logging.warning(f"Chunk {index} failed, {type(e).__name__}: {e}")
+                self.__failed(index)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for index, chunk, count in chunk_lines(lines, self.chunk_size):
+                if checkpoint is not None and checkpoint.is_done(index):
+                    self.skipped += 1
+                    continue
+                slots.acquire()
+                executor.submit(send, index, chunk, count)
+
+        return self.__finish()
+
+    def __finish(self):
+        report = self.report()
+        logging.info(f"Uploaded {report['chunks']} chunks ({report['skipped']} skipped, {report['failed']} failed), "
+                     f"{report['triples']} triples, {report['bytes'] / 1e6:.1f} MB "
+                     f"({report['sent_bytes'] / 1e6:.1f} MB sent) in {report['seconds']:.1f} s, "
+                     f"{report['mb_per_s']:.1f} MB/s, {report['triples_per_s']:.0f} triples/s")
+        if self.failed:
+            raise Exception(f"Upload to {self.url} failed for chunks {sorted(self.failed)}")
+        return report
+
+    def __send(self, index, chunk, count, checkpoint):
+        data = gzip.compress(chunk, compresslevel=GZIP_LEVEL) if self.compress else chunk
+        if not self.__post(f"Chunk {index}", lambda: data, self.content_type):
+            self.__failed(index)
+            return
+
+        if checkpoint is not None:
+            checkpoint.mark_done(index)
+        with self.__lock:
+            self.chunks += 1
+            self.triples += count
+            self.bytes += len(chunk)
+            self.sent_bytes += len(data)
+            now = time.monotonic()
+            if now - self.last_log_time >= self.progress_interval:
+                self.last_log_time = now
+                logging.info(f"Uploaded {self.chunks} chunks, {self.triples} triples, "
+                             f"{self.bytes / 1e6 / (now - self.start_time):.1f} MB/s")
+
+    def __post(self, name, body, content_type):
+        """
+        Post a request, sent again after a backoff when it fails with a connection error or a retry status code
+        :param name: name of the request in the log messages
+        :param body: function returning the request body, called again for every attempt
+        :param content_type:
+        :return: True when the request succeeded
+        """
+        headers = {"Content-Type": content_type}
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.backoff * 2 ** (attempt - 1)
+                time.sleep(delay / 2 + random.uniform(0, delay / 2))
+            try:
+                response = self.session.post(self.url, data=body(), headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if 200 <= response.status_code < 300:
+                    return True
+                error = f"status {response.status_code}: {response.text[:200]}"
+                if response.status_code not in RETRY_STATUS_CODES:
+                    logging.warning(f"{name} rejected, {error}")
+                    return False
+            logging.warning(f"{name} failed (attempt {attempt + 1}), {error}")
+        return False
+
+    def __failed(self, index):
+        with self.__lock:
+            self.failed.append(index)
+
+    def report(self):
+        """
+        :return: dict with the number of chunks uploaded, skipped and failed, triples, bytes before and after
+            compression, seconds and throughput
+        """
+        seconds = max(time.monotonic() - self.start_time, 1e-6)
+        return {
+            "chunks": self.chunks,
+            "skipped": self.skipped,
+            "failed": len(self.failed),
+            "triples": self.triples,
+            "bytes": self.bytes,
+            "sent_bytes": self.sent_bytes,
+            "seconds": seconds,
+            "mb_per_s": self.bytes / 1e6 / seconds,
+            "triples_per_s": self.triples / seconds,
+        }
@@ -1,27 +1,140 @@
 from LinkedDicomTe import LinkedDicom
+from LinkedDicomTe.BulkUploader import BulkUploader, nt_lines
+from LinkedDicomTe.RDFService import GraphService
+from LinkedDicomTe.util import new_http_session
 import click
+import logging
 import os
 import uuid
 import json
 import shutil
-import requests
-from multiprocessing import Process
+import threading
+import time
+from multiprocessing import Pool
 
 from pynetdicom import (
     AE, evt,
     StoragePresentationContexts
 )
 
+# C-STORE status returned while the processing queue is full, the sender can retry the image later
+STATUS_OUT_OF_RESOURCES = 0xA700
+
+# HTTP session of a worker process, created once per process by _init_scp_worker
+_worker_session = None
+
+
+def _init_scp_worker():
+    global _worker_session
+    _worker_session = new_http_session()
+
+
+class AssociationQueue:
+    """
+    Store or post the triples of closed associations in a fixed pool of long-lived worker processes, which keep
+    their HTTP connections to the SPARQL endpoint open. At most max_pending associations are queued or running,
+    submitting another one waits for a free slot.
+    """
+
+    def __init__(self, sparql_endpoint, workers=1, max_pending=8):
+        """
+        :param sparql_endpoint: SPARQL endpoint URL to post the triples to, None to store them as ttl
+        :param workers: number of worker processes
+        :param max_pending: maximum number of associations queued or running
+        """
+        self.__sparqlEndpoint = sparql_endpoint
+        self.__pool = Pool(processes=max(1, workers), initializer=_init_scp_worker)
+        self.__slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.__lock = threading.Lock()
+        self.maxPending = max(1, max_pending)
+        self.pending = 0
+        self.maxDepth = 0
+        self.submitted = 0
+        self.finished = 0
+        self.failed = 0
+        self.processingTime = 0.0
+
+    def isFull(self):
+        return self.pending >= self.maxPending
+
+    def submit(self, dictInfo, triples):
+        """
+        Queue the triples of a closed association, waits while the queue is full
+        :param dictInfo: association information, see SCP_handlers.handle_assoc_open
+        :param triples: list of triples parsed from the association
+        :return:
+        """
+        if not self.__slots.acquire(blocking=False):
+            logging.warning(f"Processing queue full ({self.pending} associations), "
+                            f"waiting to queue association {dictInfo['uuid']}")
+            self.__slots.acquire()
+        with self.__lock:
+            self.pending += 1
+            self.submitted += 1
+            self.maxDepth = max(self.maxDepth, self.pending)
+        self.__pool.apply_async(run_ldcm, (dictInfo, triples, self.__sparqlEndpoint),
+                                callback=self.__finish, error_callback=self.__fail)
+        logging.info(f"Queued association {dictInfo['uuid']}, {self.metrics()}")
+
+    def __done(self):
+        with self.__lock:
+            self.pending -= 1
+        self.__slots.release()
+
+    def __finish(self, result):
+        assocId, seconds = result
+        with self.__lock:
+            self.finished += 1
+            self.processingTime += seconds
+        self.__done()
+        logging.info(f"Processed association {assocId} in {seconds:.1f} s, {self.metrics()}")
+
+    def __fail(self, exception):
+        with self.__lock:
+            self.failed += 1
+        self.__done()
+        logging.warning(f"Processing association failed: {type(exception).__name__}: {exception}, {self.metrics()}")
+
+    def metrics(self):
+        """
+        :return: queue depth and counters as a dict
+        """
+        with self.__lock:
+            return {
+                "pending": self.pending,
+                "max_depth": self.maxDepth,
+                "submitted": self.submitted,
+                "finished": self.finished,
+                "failed": self.failed,
+                "mean_seconds": round(self.processingTime / self.finished, 3) if self.finished else None,
+            }
+
+    def close(self):
+        """
+        Wait for the queued associations and stop the workers
+        :return:
+        """
+        self.__pool.close()
+        self.__pool.join()
+        logging.info(f"Processing queue closed, {self.metrics()}")
+
+
 class SCP_handlers:
-    def __init__(self, ontology_file, sparql_endpoint):
+    def __init__(self, ontology_file, sparql_endpoint, queue=None, file_persistent=False):
         # Create association list
         self.__assocFolderDict = { }
+        # Parser of every open association, sharing the ontology parsed once
+        self.__assocParserDict = { }
         # Create folder where results are actually stored
         self.__dataDir = os.path.join("ldcm_scp_data")
         os.makedirs(self.__dataDir, exist_ok=True)
-        self.__ontology_file = ontology_file
-        self.__sparql_endpoint = sparql_endpoint
-    
+        self.__file_persistent = file_persistent
+        # parsed once, every association gets a parser sharing it from newParser
+        self.__ldcm = LinkedDicom.LinkedDicom(ontology_file)
+        if queue is None:
+            queue = AssociationQueue(sparql_endpoint)
+        self.__queue = queue
+
     def handle_assoc_open(self, event):
         """
         Handle the DICOM association open event
@@ -32,51 +145,82 @@ class SCP_handlers:
             "directory": os.path.join(self.__dataDir, assocId),
             "dicom_in": {
                 "directory": os.path.join(self.__dataDir, assocId, "original"),
-                "files": [ ]
+                "files": [ ],
+                "instances": 0
             }
         }
+        self.__assocParserDict[event.assoc] = self.__ldcm.newParser()
         print("association opened " + self.__assocFolderDict[event.assoc]["uuid"])
-        os.makedirs(self.__assocFolderDict[event.assoc]["dicom_in"]["directory"])
+        if self.__file_persistent:
+            os.makedirs(self.__assocFolderDict[event.assoc]["dicom_in"]["directory"])
     def handle_store(self, event):
         """Handle a C-STORE request event."""
+        # Refuse new images while the processing queue is full, the sender retries them later
+        if self.__queue.isFull():
+            return STATUS_OUT_OF_RESOURCES
+
         # Decode the C-STORE request's *Data Set* parameter to a pydicom Dataset
         ds = event.dataset
 
         # Add the File Meta Information
         ds.file_meta = event.file_meta
 
-        # Save the dataset using the SOP Instance UID as the filename
-        filePath = os.path.join(self.__assocFolderDict[event.assoc]["dicom_in"]["directory"], ds.SOPInstanceUID + ".dcm")
-        ds.save_as(filePath, write_like_original=False)
-        self.__assocFolderDict[event.assoc]["dicom_in"]["files"].append(filePath)
+        contentUrl = None
+        if self.__file_persistent:
+            # Save the dataset using the SOP Instance UID as the filename
+            filePath = os.path.join(self.__assocFolderDict[event.assoc]["dicom_in"]["directory"], ds.SOPInstanceUID + ".dcm")
+            ds.save_as(filePath, write_like_original=False)
+            self.__assocFolderDict[event.assoc]["dicom_in"]["files"].append(filePath)
+            contentUrl = os.path.abspath(filePath)
+
+        # Parse the dataset while the association is open, the triples are ready when it closes
+        try:
+            self.__assocParserDict[event.assoc].parse(ds, contentUrl)
+            self.__assocFolderDict[event.assoc]["dicom_in"]["instances"] += 1
+        except Exception as e:
+            logging.warning(f"Error parsing {getattr(ds, 'SOPInstanceUID', '')}")
+            logging.warning(f"Exception type: {type(e).__name__}")
+            logging.warning(f"Exception message: {str(e)}")
 
         # Return a 'Success' status
         return 0x0000
     def handle_assoc_close(self, event):
         """
-        Handle association close, and trigger the analysis
+        Handle association close, and queue the parsed triples
         """
-        print("association closed: " + str(self.__assocFolderDict[event.assoc]["uuid"]))
-        with open(os.path.join(self.__assocFolderDict[event.assoc]["directory"], "output.json"), "w") as f:
-            json.dump(self.__assocFolderDict[event.assoc], f)
+        dictInfo = self.__assocFolderDict.pop(event.assoc)
+        parser = self.__assocParserDict.pop(event.assoc)
+        print("association closed: " + str(dictInfo["uuid"]))
 
-        os.system("chmod -R 777 %s" % self.__assocFolderDict[event.assoc]["directory"])
-        
-        print("Try to start process")
-        p = Process(target=run_ldcm, args=(self.__assocFolderDict[event.assoc],self.__ontology_file,self.__sparql_endpoint,))
-        p.start()
+        if self.__file_persistent:
+            if not dictInfo["dicom_in"]["files"]:
+                shutil.rmtree(dictInfo["directory"])
+            else:
+                with open(os.path.join(dictInfo["directory"], "output.json"), "w") as f:
+                    json.dump(dictInfo, f)
+                os.system("chmod -R 777 %s" % dictInfo["directory"])
+
+        if dictInfo["dicom_in"]["instances"] == 0:
+            return
+        self.__queue.submit(dictInfo, parser.graphService.getTriples())
 
 @click.command()
 @click.argument('port', type=click.INT)
 @click.option('-o', '--ontology-file', help='Location of ontology file to use for override.')
 @click.option('-s', '--sparql-endpoint', help='SPARQL endpoint URL to post the resulting triples towards')
-def start_scp(port, ontology_file, sparql_endpoint):
+@click.option('-w', '--workers', type=int, default=1, help='Number of processes storing the triples of closed associations.')
+@click.option('-mp', '--max-pending', type=int, default=8,
+              help='Maximum number of closed associations queued for storing, new images are refused when full.')
+@click.option('-fp', '--file-persistent', is_flag=True, default=False,
+              help='Keep the received files on disk and store their path while parsing metadata.')
+def start_scp(port, ontology_file, sparql_endpoint, workers, max_pending, file_persistent):
     """
-    Create a DICOM SCP which can accept C-STORE commands. For every association, an analysis is triggered on association close.
-    For every association close, the analysis is triggered in a separate thread.
+    Create a DICOM SCP which can accept C-STORE commands. Every received dataset is parsed while the association is open,
+    on association close the triples are queued to be stored or posted by a pool of worker processes.
     """
 
-    scpHandlers = SCP_handlers(ontology_file, sparql_endpoint)
+    queue = AssociationQueue(sparql_endpoint, workers, max_pending)
+    scpHandlers = SCP_handlers(ontology_file, sparql_endpoint, queue, file_persistent)
     handlers = [(evt.EVT_C_STORE, scpHandlers.handle_store), (evt.EVT_CONN_OPEN, scpHandlers.handle_assoc_open), (evt.EVT_CONN_CLOSE, scpHandlers.handle_assoc_close)]
 
     # Initialise the Application Entity
@@ -90,33 +234,36 @@ def start_scp(port, ontology_file, sparql_endpoint):
         print(f"SPARQL endpoint: {sparql_endpoint}")
 
     # Start listening for incoming association requests
-    ae.start_server(('', port), evt_handlers=handlers)
+    try:
+        ae.start_server(('', port), evt_handlers=handlers)
+    finally:
+        queue.close()
 
-def run_ldcm(dict_info, ontology_file_path, sparql_endpoint_url):
-    ldcm = LinkedDicom.LinkedDicom(ontology_file_path)
-    
-    dicom_input_folder = dict_info['directory']
-    print(f"Start processing folder {dicom_input_folder}. Depending on the folder size this might take a while.")
-    
-    ldcm.processFolder(dicom_input_folder)
+def run_ldcm(dict_info, triples, sparql_endpoint_url=None):
+    """
+    Store or post the triples of an association, in a worker process of AssociationQueue
+    :param dict_info: association information, see SCP_handlers.handle_assoc_open
+    :param triples: list of triples parsed from the association
+    :param sparql_endpoint_url: SPARQL endpoint URL to post the triples to, None to store them as ttl
+    :return: association uuid and processing time in seconds
+    """
+    if _worker_session is None:
+        _init_scp_worker()
+    start = time.monotonic()
 
     if sparql_endpoint_url is None:
-        output_location = os.path.join(dicom_input_folder, "..", f"{dict_info['uuid']}.ttl") 
-        ldcm.saveResults(output_location)
-        print("Stored results in " + output_location)
+        graphService = GraphService(checkInstances=False)
+        graphService.addTriples(triples)
+        output_location = os.path.join(os.path.dirname(dict_info['directory']), f"{dict_info['uuid']}.ttl")
+        graphService.saveTriples(output_location)
+        logging.info("Stored results in " + output_location)
     else:
-        turtle = ldcm.graphService.getTriplesTurtle()
-        loadRequest = requests.post(sparql_endpoint_url,
-            data=turtle, 
-            headers={
-                "Content-Type": "application/x-turtle"
-            }
-        )
-        
-        if loadRequest.status_code >= 200 | loadRequest.status_code > 210:
-            print(f"Received error code {loadRequest.status_code}\n{loadRequest.text}")
+        # posted in chunks with retries over the session kept open by the worker
+        uploader = BulkUploader(sparql_endpoint_url, content_type="application/x-turtle", workers=1,
+                                session=_worker_session)
+        uploader.upload_lines(nt_lines(triples))
 
-    shutil.rmtree(dicom_input_folder)
+    return dict_info['uuid'], time.monotonic() - start
 
 if __name__=="__main__":
     start_scp()
@@ -0,0 +1,353 @@
+import io
+import logging
+import os
+import tarfile
+import threading
+import time
+import zipfile
+
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b"DICM"
+# archives accepted instead of a directory
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+# separates the archive path from the member name in the location of a member
+ARCHIVE_MEMBER_SEPARATOR = "!/"
+# minimum number of bytes read at once from a streamed tar member
+STREAM_READ_SIZE = 64 * 1024
+
+
+def is_archive(path):
+    """
+    :param path:
+    :return: True when path is a file with one of the archive extensions
+    """
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class DicomScanner:
+    """
+    Walk a directory tree with os.scandir and yield the DICOM files as they are found, so parsing can start
+    before the walk is finished. Files with a DICOM extension are accepted directly, other files are
+    accepted when they have the 128 byte preamble followed by the "DICM" magic.
+    The number of files and bytes found so far is kept for progress reporting, the totals of the whole tree
+    can be known early by counting them ahead, see count_ahead.
+    """
+
+    def __init__(self, directory, extensions=(".dcm", ".DCM"), detect_magic=True):
+        """
+        :param directory: root of the tree to scan
+        :param extensions: file name endings accepted without reading the file
+        :param detect_magic: peek in files without one of the extensions for the DICOM magic
+        """
+        self.directory = directory
+        self.extensions = tuple(extensions)
+        self.detect_magic = detect_magic
+        self.file_count = 0
+        self.byte_count = 0
+        self.finished = False
+        self.total_files = None
+        self.total_bytes = None
+
+    @staticmethod
+    def has_dicom_magic(file_path):
+        """
+        :param file_path:
+        :return: True when the file has the DICM magic after the preamble
+        """
+        try:
+            with open(file_path, "rb") as file:
+                header = file.read(DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC))
+        except OSError:
+            return False
+        return header[DICOM_PREAMBLE_LENGTH:] == DICOM_MAGIC
+
+    def is_dicom(self, entry):
+        if entry.name.endswith(self.extensions):
+            return True
+        return self.detect_magic and self.has_dicom_magic(entry.path)
+
+    def scan(self):
+        """
+        Walk the tree depth first in sorted order, files of a directory before its subdirectories.
+        Symbolic links to directories are not followed.
+        :return: generator of (file path, size, mtime in ns)
+        """
+        self.file_count = 0
+        self.byte_count = 0
+        self.finished = False
+        directories = [self.directory]
+        try:
+            while directories:
+                directory = directories.pop()
+                try:
+                    with os.scandir(directory) as iterator:
+                        entries = sorted(iterator, key=lambda entry: entry.name)
+                except OSError as e:
+                    logging.warning(f"Cannot scan {directory}: {e}")
+                    continue
+
+                subdirectories = []
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                            continue
+                        if not entry.is_file() or not self.is_dicom(entry):
+                            continue
+                        stat = entry.stat()
+                    except OSError as e:
+                        logging.warning(f"Cannot read {entry.path}: {e}")
+                        continue
+                    self.file_count += 1
+                    self.byte_count += stat.st_size
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+                directories.extend(reversed(subdirectories))
+        finally:
+            # also when the scan is stopped early, which stops the count ahead
+            self.finished = True
+
+    def count_ahead(self):
+        """
+        Count the DICOM files of the tree in a background thread, which walks it a second time without keeping
+        the paths, so the totals are known while the files are still parsed from scan. The second walk reads the
+        directory metadata again, so it is only worth it for long runs. Only files with one of the extensions are
+        counted, files are not opened to peek for the DICOM magic. The count is given up when scan finishes
+        or is stopped first.
+        :return: the counting thread
+        """
+        counter = DicomScanner(self.directory, self.extensions, detect_magic=False)
+
+        def count():
+            for _ in counter.scan():
+                if self.finished:
+                    return
+            self.total_files = counter.file_count
+            self.total_bytes = counter.byte_count
+            logging.info(f"Found {counter.file_count} DICOM files, {counter.byte_count / 1e6:.1f} MB")
+
+        thread = threading.Thread(target=count, name="dicom-count", daemon=True)
+        thread.start()
+        return thread
+
+    def totals(self):
+        """
+        :return: (number of files, bytes, True when these are the totals of the whole tree)
+        """
+        if not self.finished and self.total_files is not None:
+            return self.total_files, self.total_bytes, True
+        return self.file_count, self.byte_count, self.finished
+
+
+class StreamedMember(io.RawIOBase):
+    """
+    Seekable file of a member of a streamed tar archive, which can only be read forward. The bytes read so far
+    are kept, so the parser can seek back within them, seeking past them reads the member further.
+    """
+
+    def __init__(self, stream, size):
+        """
+        :param stream: file of the member as returned by TarFile.extractfile
+        :param size: size of the member in bytes
+        """
+        self.__stream = stream
+        self.__size = size
+        self.__data = bytearray()
+        self.__position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def __fill(self, end):
+        end = min(end, self.__size)
+        while len(self.__data) < end:
+            chunk = self.__stream.read(min(max(end - len(self.__data), STREAM_READ_SIZE),
+                                           self.__size - len(self.__data)))
+            if not chunk:
+                break
+            self.__data += chunk
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        self.__fill(self.__position + len(view))
+        data = self.__data[self.__position:self.__position + len(view)]
+        view[:len(data)] = data
+        self.__position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence == io.SEEK_END:
+            offset += self.__size
+        self.__position = max(0, offset)
+        return self.__position
+
+    def tell(self):
+        return self.__position
+
+
+class ArchiveScanner:
+    """
+    Iterate over the DICOM members of a zip or tar archive without extracting it. Every member is yielded
+    with an open binary file, so only the bytes read by the parser are decompressed, up to the member itself.
+    Tar archives are read as a stream in one forward pass, compressed tar archives are decompressed once.
+    The tar module keeps the header of every member read, about 0.5 KB per member.
+    The location of a member is the absolute archive path and the member name joined by "!/".
+    The fraction of the archive file read so far is kept for progress reporting.
+    """
+
+    def __init__(self, archive_path, extensions=(".dcm", ".DCM"), detect_magic=True):
+        """
+        :param archive_path: zip or tar archive, tar archives can be compressed with gzip, bzip2 or xz
+        :param extensions: member name endings accepted without reading the member
+        :param detect_magic: peek in members without one of the extensions for the DICOM magic
+        """
+        self.archive_path = archive_path
+        self.extensions = tuple(extensions)
+        self.detect_magic = detect_magic
+        self.file_count = 0
+        self.byte_count = 0
+        self.finished = False
+        self.read_fraction = 0.0
+
+    def member_location(self, name):
+        return os.path.abspath(self.archive_path) + ARCHIVE_MEMBER_SEPARATOR + name
+
+    def is_dicom(self, name, file):
+        """
+        :param name: member name
+        :param file: open member, at the start again when the method returns
+        :return:
+        """
+        if name.endswith(self.extensions):
+            return True
+        if not self.detect_magic:
+            return False
+        header = file.read(DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC))
+        # the peeked bytes are still buffered, seeking back does not read them again
+        file.seek(0)
+        return header[DICOM_PREAMBLE_LENGTH:] == DICOM_MAGIC
+
+    def scan(self):
+        """
+        :return: generator of (member location, size, mtime in ns, open binary file of the member).
+            The file is closed when the next member is yielded.
+        """
+        self.file_count = 0
+        self.byte_count = 0
+        self.finished = False
+        self.read_fraction = 0.0
+        try:
+            if zipfile.is_zipfile(self.archive_path):
+                yield from self.__scan_zip()
+            else:
+                yield from self.__scan_tar()
+            self.read_fraction = 1.0
+        finally:
+            self.finished = True
+
+    def totals(self):
+        """
+        :return: (number of files, bytes, True when these are the totals of the whole archive)
+        """
+        return self.file_count, self.byte_count, self.finished
+
+    def __scan_zip(self):
+        archive_size = max(os.path.getsize(self.archive_path), 1)
+        with zipfile.ZipFile(self.archive_path) as archive:
+            for info in archive.infolist():
+                self.read_fraction = min((info.header_offset + info.compress_size) / archive_size, 1.0)
+                if info.is_dir():
+                    continue
+                mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * 10 ** 9
+                with archive.open(info) as file:
+                    if not self.is_dicom(info.filename, file):
+                        continue
+                    self.file_count += 1
+                    self.byte_count += info.file_size
+                    yield self.member_location(info.filename), info.file_size, mtime_ns, file
+
+    def __scan_tar(self):
+        archive_size = max(os.path.getsize(self.archive_path), 1)
+        with open(self.archive_path, "rb") as raw, tarfile.open(fileobj=raw, mode="r|*") as archive:
+            for member in archive:
+                # compressed bytes read from the archive file so far
+                self.read_fraction = min(raw.tell() / archive_size, 1.0)
+                if not member.isfile():
+                    continue
+                # a member of the stream can only be read while it is the current member
+                with StreamedMember(archive.extractfile(member), member.size) as file:
+                    if not self.is_dicom(member.name, file):
+                        continue
+                    self.file_count += 1
+                    self.byte_count += member.size
+                    yield self.member_location(member.name), member.size, int(member.mtime) * 10 ** 9, file
+
+
+class ScanProgress:
+    """
+    Log the progress of parsing the files found by a DicomScanner or ArchiveScanner, with an ETA once the totals
+    are known, or from the fraction of an archive read so far. Files skipped because they are done already are
+    left out of the totals.
+    """
+
+    def __init__(self, scanner, interval=30):
+        """
+        :param scanner: DicomScanner or ArchiveScanner
+        :param interval: minimum number of seconds between two log messages
+        """
+        self.scanner = scanner
+        self.interval = interval
+        self.file_count = 0
+        self.byte_count = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_log_time = self.start_time
+
+    def update(self, size):
+        """
+        Register a processed file, and log the progress when the interval has passed
+        :param size: size of the processed file in bytes
+        :return:
+        """
+        self.file_count += 1
+        self.byte_count += size
+        now = time.monotonic()
+        if now - self.last_log_time >= self.interval:
+            self.last_log_time = now
+            self.log()
+
+    def skip(self, size):
+        """
+        Register a file found by the scanner which is not processed, e.g. because the manifest has it done
+        :param size: size of the skipped file in bytes
+        :return:
+        """
+        self.skipped_files += 1
+        self.skipped_bytes += size
+
+    def log(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        rate = self.byte_count / elapsed
+        total_files, total_bytes, complete = self.scanner.totals()
+        # the skipped files found so far, the totals counted ahead can still include files skipped later
+        total_files -= self.skipped_files
+        total_bytes -= self.skipped_bytes
+        read_fraction = getattr(self.scanner, "read_fraction", 0.0)
+        message = (f"Processed {self.file_count}/{total_files} files, "
+                   f"{self.byte_count / 1e6:.1f}/{total_bytes / 1e6:.1f} MB, "
+                   f"{self.file_count / elapsed:.1f} files/s")
+        if self.skipped_files:
+            message += f", {self.skipped_files} files done before skipped"
+        if complete and rate > 0:
+            message += f", ETA {max(total_bytes - self.byte_count, 0) / rate:.0f} s"
+        elif read_fraction > 0:
+            eta = elapsed * (1 - read_fraction) / read_fraction
+            message += f", {read_fraction:.0%} of the archive read, ETA {eta:.0f} s"
+        else:
+            message += ", still scanning"
+        logging.info(message)
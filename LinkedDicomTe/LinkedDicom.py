@@ -1,15 +1,20 @@
+import copy
+import io
 import logging
 
 import pydicom
 import os
+from multiprocessing import Pool
 
-import requests
 from LinkedDicomTe.OntologyService import OntologyService
 from LinkedDicomTe.OntologyService import PropertyType
 from LinkedDicomTe.RDFService import GraphService
+from LinkedDicomTe.BulkUploader import BulkUploader, nt_lines
 from pydicom.tag import Tag
+from rdflib import URIRef
 from abc import ABC, abstractmethod
-from .util import read_list, save_list
+from .ManifestService import ManifestService, FileStatus
+from .DicomScanner import ArchiveScanner, DicomScanner, ScanProgress, is_archive
 from pydicom import config
 
 config.convert_wrong_length_to_UN = True
@@ -22,6 +27,78 @@ class ProcessFolder(ABC):
         self.directory = directory
 
 
+# LinkedDicom instance of a worker process, created once per process by _init_worker
+_worker_ldcm = None
+
+
+def _init_worker(ontology_file_path, persistent_storage, header_only, check_instances):
+    global _worker_ldcm
+    _worker_ldcm = LinkedDicom(ontology_file_path)
+    _worker_ldcm.checkInstances = check_instances
+    _worker_ldcm.worker_options = (persistent_storage, header_only)
+
+
+def _parse_files_worker(files):
+    """
+    Parse a chunk of files in a worker process into a fresh partial graph
+    :param files: list of (file path, size, mtime in ns)
+    :return: the triples and shared instances of the partial graph, and a list of
+        (file path, size, mtime in ns, SOP Instance UID, parsed)
+    """
+    persistent_storage, header_only = _worker_ldcm.worker_options
+    _worker_ldcm.graphService = _worker_ldcm.newGraphService()
+    results = []
+    for file_path, size, mtime_ns in files:
+        parsed = _worker_ldcm.parseDcmFileSafe(file_path, persistent_storage, header_only)
+        results.append((file_path, size, mtime_ns, _worker_ldcm.lastSopInstanceUID, parsed))
+    graphService = _worker_ldcm.graphService
+    return graphService.getTriples(), graphService.getSharedInstances(), results
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _BufferReader(io.RawIOBase):
+    """
+    Read only binary file over a bytes-like buffer, the bytes are only copied when they are read
+    """
+
+    def __init__(self, buffer):
+        self.__buffer = memoryview(buffer).cast("B")
+        self.__position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self.__buffer[self.__position:self.__position + len(b)]
+        b[:len(chunk)] = chunk
+        self.__position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence == io.SEEK_END:
+            offset += len(self.__buffer)
+        self.__position = max(0, offset)
+        return self.__position
+
+    def tell(self):
+        return self.__position
+
+
 class LinkedDicom:
     def __init__(self, ontology_file_path):
         # Determine external ontology file or embedded in package
@@ -31,9 +108,17 @@ class LinkedDicom:
             self.ontologyService = OntologyService(my_data, True)
         else:
             self.ontologyService = OntologyService(ontology_file_path)
+        self.ontology_file_path = ontology_file_path
+        self.tagPlan = self.ontologyService.getTagPlan()
+        self.mappedTags = self.ontologyService.getMappedTags()
+        # check instances exist before adding predicates to them, can be disabled for bulk loads
+        self.checkInstances = True
         self.graphService = GraphService()
         self.ontologyPrefix = "https://johanvansoest.nl/ontologies/LinkedDicom/"
+        self.hasSequenceItem = URIRef(self.ontologyPrefix + "has_sequence_item")
         self.process_f = None
+        self.manifest = None
+        self.lastSopInstanceUID = None
 
     class ProcessFolderStandard(ProcessFolder):
 
@@ -41,77 +126,216 @@ class LinkedDicom:
             super().__init__(directory)
             self.outer = outer
 
-        def process_folder(self, persistent_storage):
+        def process_folder(self, persistent_storage, header_only=True):
             """
             Standard function to process the folder where dicom are stored
             :param persistent_storage:
+            :param header_only: read only the mapped header tags, stop before the pixel data
             :return:
             """
-            for root, subdirs, files in os.walk(self.directory):
-                for filename in files:
-                    file_path = os.path.join(root, filename)
-                    if file_path.endswith(".dcm") or file_path.endswith(".DCM"):
-                        self.outer.parseDcmFile(file_path, persistentStorage=persistent_storage)
+            for file_path, size, mtime_ns in DicomScanner(self.directory).scan():
+                self.outer.parseDcmFile(file_path, persistentStorage=persistent_storage, headerOnly=header_only)
 
-        def process_folder_fr(self, persistent_storage, list_present, number_file):
+        def list_dicom_files(self, scanner, manifest, number_file, progress=None):
+            """
+            Scan the folder for DICOM files which are not done according to the manifest.
+            Files are yielded while the scan is still running.
+            :param scanner: DicomScanner of the folder
+            :param manifest: ManifestService or None
+            :param number_file: maximum number of files, None for all
+            :param progress: ScanProgress the files done according to the manifest are skipped in, or None
+            :return: generator of (file path, size, mtime in ns)
+            """
+            counter = 0
+            for file_path, size, mtime_ns in scanner.scan():
+                if number_file is not None and counter >= number_file:
+                    return
+                if manifest is not None and manifest.isDone(file_path, size, mtime_ns):
+                    if progress is not None:
+                        progress.skip(size)
+                    continue
+                counter += 1
+                yield file_path, size, mtime_ns
+
+        def process_folder_fr(self, persistent_storage, list_present, number_file, header_only=True,
+                              detect_magic=True, count_ahead=False):
             """
             Custom process folder for a specific project
             :param persistent_storage:
-            :param list_present:
+            :param list_present: path of the ingest manifest, unchanged files done in earlier runs are skipped
+            :param number_file:
+            :param header_only: read only the mapped header tags, stop before the pixel data
+            :param detect_magic: also accept files without dcm extension which have the DICOM magic
+            :param count_ahead: count the files in a second walk of the folder, for the ETA of the progress log
+            :return:
+            """
+            manifest = self.outer.openManifest(list_present)
+            scanner = DicomScanner(self.directory, detect_magic=detect_magic)
+            # the files are scanned while they are parsed, the totals for the ETA are only known ahead when counted
+            if count_ahead:
+                scanner.count_ahead()
+            progress = ScanProgress(scanner)
+
+            for file_path, size, mtime_ns in self.list_dicom_files(scanner, manifest, number_file, progress):
+                parsed = self.outer.parseDcmFileSafe(file_path, persistent_storage, header_only)
+                self.outer.markFile(file_path, size, mtime_ns, self.outer.lastSopInstanceUID, parsed)
+                progress.update(size)
+            progress.log()
+
+        def process_archive(self, persistent_storage, list_present, number_file, header_only=True,
+                            detect_magic=True):
+            """
+            Process the DICOM members of the zip or tar archive at the directory location, streamed from the
+            archive without extracting it. The location of a member in the archive is its schema:contentUrl.
+            :param persistent_storage:
+            :param list_present: path of the ingest manifest, unchanged members done in earlier runs are skipped
             :param number_file:
+            :param header_only: read only the mapped header tags, stop before the pixel data
+            :param detect_magic: also accept members without dcm extension which have the DICOM magic
             :return:
             """
+            manifest = self.outer.openManifest(list_present)
+            scanner = ArchiveScanner(self.directory, detect_magic=detect_magic)
+            progress = ScanProgress(scanner)
 
             counter = 0
-            list_file = []
-            list_present_ = read_list(list_present)
-            br = False
-            if list_present_ is not None:
-                list_file.extend(list_present_)
-                logging.info("Older list of file executed available")
-            else:
-                logging.info("List present is None no previous file has been included")
-
-            for root, subdirs, files in os.walk(self.directory):
-                try:
-                    for filename in files:
-                        if number_file is None or counter < number_file:
-
-                            file_path = os.path.join(root, filename)
-                            if list_present_ is None or file_path not in list_present_:
-
-                                if file_path.endswith(".dcm") or file_path.endswith(".DCM"):
-                                    self.outer.parseDcmFile(file_path, persistentStorage=persistent_storage)
-                                    if number_file is not None:
-                                        counter += 1
-                                    list_file.append(file_path)
-                        else:
-                            br = True
-                            break
-                    if br:
-                        break
-                # TODO this can be done better
-                except Exception as e:
-                    print(e)
-                    logging.warning(e)
-                    logging.warning(f"Exception type: {type(e).__name__}")
-                    logging.warning(f"Exception message: {str(e)}")
-            if list_present_ is not None:
-                save_list(list_file, list_present)
+            for location, size, mtime_ns, file in scanner.scan():
+                if number_file is not None and counter >= number_file:
+                    break
+                if manifest is not None and manifest.isDone(location, size, mtime_ns):
+                    progress.skip(size)
+                    continue
+                counter += 1
+                parsed = self.outer.parseSafe(file, location, location if persistent_storage else None,
+                                              header_only)
+                self.outer.markFile(location, size, mtime_ns, self.outer.lastSopInstanceUID, parsed)
+                progress.update(size)
+            progress.log()
+
+        def process_folder_parallel(self, persistent_storage, list_present, number_file, header_only=True,
+                                    workers=2, detect_magic=True, chunk_size=64, count_ahead=False):
+            """
+            Process the folder with a pool of worker processes. Every worker parses a chunk of files
+            into its own partial graph, the partial graphs are merged in chunk order in the graph of outer.
+            Shared instances (patient, study, series) have the same IRI in every partial graph and are
+            deduplicated by the merge. Chunks are handed to the pool while the folder is still being scanned.
+            :param persistent_storage:
+            :param list_present: path of the ingest manifest, unchanged files done in earlier runs are skipped
+            :param number_file:
+            :param header_only:
+            :param workers: number of worker processes
+            :param detect_magic: also accept files without dcm extension which have the DICOM magic
+            :param chunk_size: number of files parsed into one partial graph
+            :param count_ahead: count the files in a second walk of the folder, for the ETA of the progress log
+            :return:
+            """
+            manifest = self.outer.openManifest(list_present)
+            scanner = DicomScanner(self.directory, detect_magic=detect_magic)
+            # the files are scanned while they are parsed, the totals for the ETA are only known ahead when counted
+            if count_ahead:
+                scanner.count_ahead()
+            progress = ScanProgress(scanner)
+            files = self.list_dicom_files(scanner, manifest, number_file, progress)
+            logging.info(f"Parsing files in chunks of {chunk_size} with {workers} workers")
+
+            with Pool(workers, initializer=_init_worker,
+                      initargs=(self.outer.ontology_file_path, persistent_storage, header_only,
+                                self.outer.checkInstances)) as pool:
+                for triples, shared_instances, results in pool.imap(_parse_files_worker,
+                                                                     _chunks(files, chunk_size)):
+                    self.outer.graphService.addTriples(triples, shared_instances)
+                    self.outer.graphService.flush()
+                    for file_path, size, mtime_ns, sop_instance_uid, parsed in results:
+                        self.outer.markFile(file_path, size, mtime_ns, sop_instance_uid, parsed)
+                        progress.update(size)
+            progress.log()
+
+    def openManifest(self, manifest_path):
+        """
+        Open the ingest manifest, replacing the manifest opened earlier. The manifest which is open already is
+        kept, so the files it has marked parsed are still committed when the results are saved.
+        :param manifest_path: path of the SQLite manifest, None for no manifest
+        :return: ManifestService or None
+        """
+        if (self.manifest is not None and manifest_path is not None
+                and self.manifest.manifestPath == os.path.abspath(manifest_path)):
+            return self.manifest
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if manifest_path is not None:
+            self.manifest = ManifestService(manifest_path)
+            logging.info(f"Ingest manifest {manifest_path}: {self.manifest.getStatusCounts()}")
+        return self.manifest
+
+    def markFile(self, file_path, size, mtime_ns, sop_instance_uid, parsed):
+        """
+        Record a finished file in the manifest. Files whose triples are only in memory are marked parsed,
+        and become done when the results are saved.
+        :return:
+        """
+        if self.manifest is None:
+            return
+        if not parsed:
+            status = FileStatus.FAILED
+        elif self.graphService.isDurable():
+            status = FileStatus.DONE
+        else:
+            status = FileStatus.PARSED
+        self.manifest.markFile(file_path, size, mtime_ns, sop_instance_uid, status)
+
+    def parseDcmFileSafe(self, file_path, persistent_storage=False, header_only=False):
+        """
+        Parse a file, logging the exception instead of raising it
+        :return: True when the file is parsed
+        """
+        return self.parseSafe(file_path, file_path, os.path.abspath(file_path) if persistent_storage else None,
+                              header_only)
+
+    def parseSafe(self, source, name, contentUrl=None, headerOnly=False):
+        """
+        Parse a DICOM object, logging the exception instead of raising it
+        :param source: see parse
+        :param name: name of the object in the log
+        :param contentUrl: see parse
+        :param headerOnly: see parse
+        :return: True when the object is parsed
+        """
+        try:
+            self.parse(source, contentUrl, headerOnly)
+            return True
+        except Exception as e:
+            logging.warning(f"Error parsing {name}")
+            logging.warning(f"Exception type: {type(e).__name__}")
+            logging.warning(f"Exception message: {str(e)}")
+            return False
 
     def process_folder_exe(self, folder_location, persistent_storage=False,
-                           list_present=None, int_numb=None):
+                           list_present=None, int_numb=None, header_only=True, workers=1, detect_magic=True,
+                           count_ahead=False):
         """
-        Iterate on the folder selected and check which ends with dcm
+        Iterate on the folder selected and check which ends with dcm. The folder location can also be a zip or
+        tar archive, its members are parsed from the archive in this process without extracting them.
 
         :param list_present:
         :param persistent_storage:
-        :param folder_location:
+        :param folder_location: directory, or zip or tar archive
         :param int_numb:
+        :param header_only: read only the mapped header tags, stop before the pixel data
+        :param workers: number of processes, the files are parsed in parallel when larger than 1
+        :param detect_magic: also accept files without dcm extension which have the DICOM magic
+        :param count_ahead: count the files of a folder in a second walk, for the ETA of the progress log
         :return:
         """
         self.process_f = self.ProcessFolderStandard(folder_location, self)
-        self.process_f.process_folder_fr(persistent_storage, list_present, int_numb)
+        if is_archive(folder_location):
+            self.process_f.process_archive(persistent_storage, list_present, int_numb, header_only, detect_magic)
+        elif workers > 1:
+            self.process_f.process_folder_parallel(persistent_storage, list_present, int_numb, header_only,
+                                                   workers, detect_magic, count_ahead=count_ahead)
+        else:
+            self.process_f.process_folder_fr(persistent_storage, list_present, int_numb, header_only,
+                                             detect_magic, count_ahead)
         # self.process_f.process_folder(persistent_storage)
 
     def getTagValueForPredicate(self, dcmHeader, predicate):
@@ -154,17 +378,69 @@ class LinkedDicom:
             keyForInstance = self.ontologyService.getKeyForClass(newClass)
             newInstance = self.graphService.createOrGetInstance(newClass,
                                                                 self.getTagValueForPredicate(dcmHeader, keyForInstance),
-                                                                keyForInstance)
+                                                                keyForInstance, shared=True)
 
             self.graphService.addPredicateObjectToInstance(newInstance, predicate, currentInstance)
 
             self.createParentInstances(dcmHeader, newInstance, newClass)
 
-    def parseDcmFile(self, filePath, clearStore=False, persistentStorage=False):
+    def readDcmFile(self, filePath, headerOnly=False):
+        """
+        Read a DICOM file. In header only mode reading stops before the Pixel Data (7FE0,0010)
+        and only the tags mapped in the ontology are parsed, other elements are skipped on disk.
+        :param filePath: file path or binary file-like object
+        :param headerOnly:
+        :return: pydicom Dataset
+        """
+        if headerOnly:
+            return pydicom.dcmread(filePath, force=True, stop_before_pixels=True, specific_tags=self.mappedTags)
+        return pydicom.dcmread(filePath, force=True)
+
+    def parseDcmFile(self, filePath, clearStore=False, persistentStorage=False, headerOnly=False):
         if clearStore:
-            self.graphService = GraphService()
+            self.graphService = self.newGraphService()
+
+        self.parse(filePath, os.path.abspath(filePath) if persistentStorage else None, headerOnly)
 
-        dcmHeader = pydicom.dcmread(filePath, force=True)
+        if clearStore:
+            return self.graphService.getTriplesTurtle()
+
+    def parse(self, source, contentUrl=None, headerOnly=False):
+        """
+        Parse a DICOM object into the graph. A buffer is read in place, only the bytes read by pydicom are copied.
+        To get only the triples of the object without accumulating them, parse with a parser from newParser.
+        :param source: pydicom Dataset, bytes, bytearray or memoryview of a DICOM file, binary file-like object
+            or file path
+        :param contentUrl: location of the DICOM object recorded as schema:contentUrl, None to not record it
+        :param headerOnly: read only the mapped header tags, stop before the pixel data. Not used for a Dataset.
+        :return: iterator over the triples added to the graph for the object
+        """
+        self.lastSopInstanceUID = None
+        if isinstance(source, pydicom.Dataset):
+            dcmHeader = source
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            dcmHeader = self.readDcmFile(_BufferReader(source), headerOnly)
+        else:
+            dcmHeader = self.readDcmFile(source, headerOnly)
+
+        triples = self.graphService.recordTriples()
+        try:
+            self.parseDcmDataset(dcmHeader, contentUrl)
+        finally:
+            self.graphService.stopRecording()
+        # a triple is recorded again when an element adds a value which is already in the graph
+        return iter(dict.fromkeys(triples))
+
+    def parseDcmDataset(self, dcmHeader, contentUrl=None):
+        """
+        Parse a DICOM dataset which is already read, for example received over the network
+        :param dcmHeader: pydicom Dataset
+        :param contentUrl: location of the DICOM file recorded as schema:contentUrl, None to not record it
+        :return:
+        """
+        self.lastSopInstanceUID = None
+        if 0x00080018 in dcmHeader:
+            self.lastSopInstanceUID = str(dcmHeader[Tag(0x8, 0x18)].value)
 
         sopClassUid = dcmHeader[Tag(0x8, 0x16)].value
 
@@ -176,83 +452,145 @@ class LinkedDicom:
 
         self.createParentInstances(dcmHeader, sopInstanceUID, iodClass)
 
-        if persistentStorage:
+        if contentUrl is not None:
             self.graphService.addPredicateLiteralToInstance(sopInstanceUID,
                                                             self.graphService.replaceShortToUri("schema:contentUrl"),
-                                                            os.path.abspath(filePath))
+                                                            contentUrl)
             self.graphService.addPredicateLiteralToInstance(sopInstanceUID, self.graphService.replaceShortToUri(
                 "schema:encodingFormat"), "application/dicom")
 
-        for key in dcmHeader.keys():
-            element = dcmHeader[key]
+        self.parseDataset(dcmHeader, dcmHeader, sopInstanceUID, None)
+        self.graphService.flush()
+
+    def parseDataset(self, dcmHeader, dataset, iodInstance, currentInstance):
+        """
+        Parse all elements of a dataset (or sequence item) which are mapped in the tag plan.
+        Tags unknown to the ontology are skipped before the element value is even decoded.
+        :param dcmHeader: the complete DICOM header, used to look up instance keys
+        :param dataset: the dataset or sequence item to parse
+        :param iodInstance: instance sequences are attached to
+        :param currentInstance: instance literal/object elements are attached to, None for the information entity
+        :return:
+        """
+        for key in dataset.keys():
+            tagPredicates = self.tagPlan.get(key)
+            if tagPredicates is None:
+                continue
+            element = dataset[key]
 
             if element.VR == "SQ":
-                self.parseSequence(dcmHeader, element, sopInstanceUID)
+                self.parseSequence(dcmHeader, element, iodInstance, tagPredicates)
             else:
-                self.parseElement(dcmHeader, element, None)
+                self.parseElement(dcmHeader, element, currentInstance, tagPredicates)
+
+    def parseElement(self, dcmHeader, element, currentInstance, tagPredicates=None):
+        if tagPredicates is None:
+            tagPredicates = self.tagPlan.get(element.tag, ())
+
+        for tagPredicate in tagPredicates:
+            predicate = tagPredicate.predicate
+            if currentInstance is None:
+                currentInstance = self.graphService.createOrGetInstance(tagPredicate.informationEntity,
+                                                                        dcmHeader[tagPredicate.keyTag].value,
+                                                                        tagPredicate.key, shared=True)
+
+            if tagPredicate.propertyType == PropertyType.OBJECT:
+                self.graphService.addPredicateObjectToInstance(currentInstance, predicate,
+                                                               self.graphService.valueAsIri(str(element.value)))
+            if tagPredicate.propertyType == PropertyType.LITERAL:
+                self.graphService.addPredicateLiteralToInstance(currentInstance, predicate, str(element.value))
+
+    def parseSequence(self, dcmHeader, sequenceElement, iodInstance, tagPredicates=None):
+        if tagPredicates is None:
+            tagPredicates = self.tagPlan.get(sequenceElement.tag, ())
+
+        for tagPredicate in tagPredicates:
+            predicate = tagPredicate.predicate
+            currentSequenceInstance = self.graphService.createOrGetInstance(tagPredicate.sequenceClass,
+                                                                            iodInstance + "_" + tagPredicate.tagString,
+                                                                            None)
+            self.graphService.addPredicateObjectToInstance(iodInstance, predicate, currentSequenceInstance)
+
+            for i in range(len(sequenceElement.value)):
+                sequenceItemElement = sequenceElement.value[i]
+                currentSequenceItemInstance = self.graphService.createOrGetInstance(tagPredicate.sequenceItemClass,
+                                                                                    currentSequenceInstance + "_" + str(
+                                                                                        i), None)
+                self.graphService.addPredicateObjectToInstance(currentSequenceInstance,
+                                                               self.hasSequenceItem,
+                                                               currentSequenceItemInstance)
+
+                self.parseDataset(dcmHeader, sequenceItemElement, currentSequenceItemInstance,
+                                  currentSequenceItemInstance)
+
+    def newGraphService(self, **kwargs):
+        """
+        Create a GraphService with the instance check setting of this LinkedDicom
+        :param kwargs: arguments for GraphService
+        :return:
+        """
+        return GraphService(checkInstances=self.checkInstances, **kwargs)
 
-        if clearStore:
-            return self.graphService.getTriplesTurtle()
+    def newParser(self):
+        """
+        Create a LinkedDicom sharing the parsed ontology of this one with its own empty graph,
+        to parse in another thread without loading the ontology again
+        :return: LinkedDicom
+        """
+        parser = copy.copy(self)
+        parser.graphService = self.newGraphService()
+        parser.process_f = None
+        parser.manifest = None
+        parser.lastSopInstanceUID = None
+        return parser
+
+    def setBulkMode(self, bulk):
+        """
+        In bulk mode the instance existence check before adding predicates is disabled
+        :param bulk:
+        :return:
+        """
+        self.checkInstances = not bulk
+        self.graphService = self.newGraphService()
+
+    def streamResults(self, location):
+        """
+        Write the triples as N-Triples to location after every parsed file, instead of keeping
+        all of them in memory until saveResults is called.
+        :param location: file path or binary file-like object
+        :return:
+        """
+        self.graphService = self.newGraphService(sink=location)
+
+    def openStore(self, store_path, store_type="Oxigraph"):
+        """
+        Accumulate the triples in a persistent on-disk store instead of in memory.
+        Triples already in the store are kept.
+        :param store_path: directory of the store
+        :param store_type: rdflib store plugin
+        :return:
+        """
+        self.graphService = self.newGraphService(storePath=store_path, storeType=store_type)
 
-    def parseElement(self, dcmHeader, element, currentInstance):
-        predicates = self.tagToPredicate(element.tag)
-
-        for predicate in predicates:
-            if self.ontologyService.predicateExists(predicate):
-                if currentInstance is None:
-                    myClass = self.ontologyService.relatedToInformationEntity(predicate)
-                    keyforClass = self.ontologyService.getKeyForClass(myClass)
-                    currentInstance = self.graphService.createOrGetInstance(myClass,
-                                                                            self.getTagValueForPredicate(dcmHeader,
-                                                                                                         keyforClass),
-                                                                            keyforClass)
-
-                predicateType = self.ontologyService.getPredicatePropertyType(predicate)
-                if predicateType == PropertyType.OBJECT:
-                    self.graphService.addPredicateObjectToInstance(currentInstance, predicate,
-                                                                   self.graphService.valueAsIri(str(element.value)))
-                if predicateType == PropertyType.LITERAL:
-                    self.graphService.addPredicateLiteralToInstance(currentInstance, predicate, str(element.value))
-
-    def parseSequence(self, dcmHeader, sequenceElement, iodInstance):
-        predicates = self.tagToPredicate(sequenceElement.tag)
-
-        for predicate in predicates:
-            if self.ontologyService.predicateExists(predicate):
-                sequenceClass = self.ontologyService.relatedToSequence(predicate)
-                currentSequenceInstance = self.graphService.createOrGetInstance(sequenceClass,
-                                                                                iodInstance + "_" + self.tagToString(
-                                                                                    sequenceElement.tag), None)
-                self.graphService.addPredicateObjectToInstance(iodInstance, predicate, currentSequenceInstance)
-
-                for i in range(len(sequenceElement.value)):
-                    sequenceItemElement = sequenceElement.value[i]
-                    sequenceItemClass = self.ontologyService.getRelatedSequenceItemClass(sequenceClass)
-                    currentSequenceItemInstance = self.graphService.createOrGetInstance(sequenceItemClass,
-                                                                                        currentSequenceInstance + "_" + str(
-                                                                                            i), None)
-                    self.graphService.addPredicateObjectToInstance(currentSequenceInstance,
-                                                                   self.ontologyPrefix + "has_sequence_item",
-                                                                   currentSequenceItemInstance)
-
-                    for key in sequenceItemElement.keys():
-                        element = sequenceItemElement[key]
-
-                        if element.VR == "SQ":
-                            self.parseSequence(dcmHeader, element, currentSequenceItemInstance)
-                        else:
-                            self.parseElement(dcmHeader, element, currentSequenceItemInstance)
+    def closeStore(self):
+        self.graphService.close()
+        if self.manifest is not None:
+            self.manifest.commitParsed()
 
     def saveResults(self, location):
         self.graphService.saveTriples(location)
+        if self.manifest is not None:
+            self.manifest.commitParsed()
 
-    def postSparqlEndpoint(self, serverUrl, repoName, localGraphName):
-        turtle = self.graphService.getTriplesTurtle()
-
-        # upload to RDF store
-        loadRequest = requests.post(serverUrl + "/repositories/" + repoName + "/rdf-graphs/" + localGraphName,
-                                    data=turtle,
-                                    headers={
-                                        "Content-Type": "text/turtle"
-                                    }
-                                    )
+    def postSparqlEndpoint(self, serverUrl, repoName, localGraphName, **kwargs):
+        """
+        Add the triples to a named graph of a repository, in chunks with retries, see BulkUploader
+        :param serverUrl:
+        :param repoName:
+        :param localGraphName:
+        :param kwargs: arguments for BulkUploader, e.g. chunk_size, workers or retries
+        :return: upload report, see BulkUploader.report
+        """
+        uploader = BulkUploader(serverUrl + "/repositories/" + repoName + "/rdf-graphs/" + localGraphName,
+                                content_type="text/turtle", **kwargs)
+        return uploader.upload_lines(nt_lines(self.graphService.getTriples()))
@@ -0,0 +1,128 @@
+import datetime
+import logging
+import os
+import sqlite3
+from enum import Enum
+
+from .util import read_list
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+class FileStatus(Enum):
+    # seen, but not parsed or its triples were lost in an interrupted run
+    PENDING = 'pending'
+    # parsed, but the triples are only in memory until the results are saved
+    PARSED = 'parsed'
+    # parsed and the triples are saved
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class ManifestService:
+    """
+    Incremental ingest manifest: a SQLite table keyed by file path with the size, modification time,
+    SOP Instance UID and status of every file seen. Every update is committed directly, so an interrupted
+    run can be resumed and files which did not change since they were done are skipped. Files left parsed by an
+    interrupted run are reset to pending, only the files parsed by this instance are committed as done.
+    """
+
+    def __init__(self, manifestPath):
+        legacyList = None
+        if os.path.exists(manifestPath) and not self.isSqliteFile(manifestPath):
+            # flat list of file paths written by earlier versions, kept as backup and imported below
+            legacyList = read_list(manifestPath)
+            os.replace(manifestPath, manifestPath + ".bak")
+            logging.info(f"Importing file list {manifestPath} in the ingest manifest, old list kept as .bak")
+
+        self.manifestPath = os.path.abspath(manifestPath)
+        self.__connection = sqlite3.connect(manifestPath)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sop_instance_uid TEXT,
+                status TEXT NOT NULL,
+                updated TEXT NOT NULL
+            )
+        """)
+        # the triples of files left parsed by an interrupted run were never saved
+        reset = self.__connection.execute("UPDATE files SET status = ? WHERE status = ?",
+                                          (FileStatus.PENDING.value, FileStatus.PARSED.value)).rowcount
+        self.__connection.commit()
+        if reset:
+            logging.warning(f"Reset {reset} files parsed by an interrupted run to pending in the ingest manifest")
+        # files marked parsed by this instance, committed as done by commitParsed
+        self.__parsedPaths = set()
+
+        if legacyList is not None:
+            self.__importList(legacyList)
+
+    @staticmethod
+    def isSqliteFile(path):
+        with open(path, "rb") as file:
+            return file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+    def __importList(self, filePaths):
+        with self.__connection:
+            for filePath in filePaths:
+                if os.path.exists(filePath):
+                    stat = os.stat(filePath)
+                    self.__upsert(filePath, stat.st_size, stat.st_mtime_ns, None, FileStatus.DONE)
+
+    def __upsert(self, filePath, size, mtimeNs, sopInstanceUid, status):
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, sop_instance_uid, status, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (filePath, size, mtimeNs, sopInstanceUid, status.value, datetime.datetime.now().isoformat()))
+
+    def isDone(self, filePath, size, mtimeNs):
+        """
+        :param filePath:
+        :param size:
+        :param mtimeNs:
+        :return: True when the file is done and did not change since
+        """
+        row = self.__connection.execute("SELECT size, mtime_ns, status FROM files WHERE path = ?",
+                                        (filePath,)).fetchone()
+        return row is not None and row[2] == FileStatus.DONE.value and row[0] == size and row[1] == mtimeNs
+
+    def markFile(self, filePath, size, mtimeNs, sopInstanceUid, status):
+        """
+        Record the status of a file, committed directly
+        :param filePath:
+        :param size:
+        :param mtimeNs:
+        :param sopInstanceUid:
+        :param status: FileStatus
+        :return:
+        """
+        with self.__connection:
+            self.__upsert(filePath, size, mtimeNs, sopInstanceUid, status)
+        if status == FileStatus.PARSED:
+            self.__parsedPaths.add(filePath)
+        else:
+            self.__parsedPaths.discard(filePath)
+
+    def commitParsed(self):
+        """
+        Mark the files parsed by this instance as done, to be called once their triples are saved
+        :return:
+        """
+        with self.__connection:
+            self.__connection.executemany("UPDATE files SET status = ? WHERE path = ? AND status = ?",
+                                          ((FileStatus.DONE.value, filePath, FileStatus.PARSED.value)
+                                           for filePath in self.__parsedPaths))
+        self.__parsedPaths.clear()
+
+    def getStatusCounts(self):
+        """
+        :return: dict of status value -> number of files
+        """
+        return dict(self.__connection.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall())
+
+    def close(self):
+        self.__connection.close()
@@ -1,11 +1,21 @@
+import re
 import rdflib
-from rdflib import URIRef
+from rdflib import RDF, RDFS, OWL, URIRef
+from collections import namedtuple
 
 from enum import Enum
 class PropertyType(Enum):
     LITERAL = 'literal'
     OBJECT = 'object'
 
+LDCM = rdflib.Namespace("https://johanvansoest.nl/ontologies/LinkedDicom/")
+
+# Everything the parser needs to know about one ontology predicate of a DICOM tag
+TagPredicate = namedtuple("TagPredicate", ["predicate", "propertyType", "informationEntity", "key", "keyTag",
+                                           "sequenceClass", "sequenceItemClass", "tagString"])
+
+TAG_PREDICATE_PATTERN = re.compile("^" + re.escape(str(LDCM)) + "([TR])([0-9A-F]{8})$")
+
 class OntologyService:
     def __init__(self, ontologyContents, ontologyString=False):
         self.__ontology = rdflib.Graph()
@@ -13,134 +23,188 @@ class OntologyService:
             self.__ontology.parse(data=ontologyContents, format='xml')
         else:
             self.__ontology.parse(ontologyContents)
+        self.__compileIndexes()
+
+    def __compileIndexes(self):
+        """
+        Compile the ontology once into dict indexes, so every lookup done while parsing
+        DICOM elements is a constant time dict access instead of a SPARQL query.
+        All indexes are keyed by the string form of the IRI (or literal).
+        :return:
+        """
+        ontology = self.__ontology
+
+        self.__subjects = set(str(s) for s in ontology.subjects(unique=True))
+
+        self.__propertyTypes = {}
+        for s, o in ontology.subject_objects(RDF.type):
+            if o == OWL.DatatypeProperty:
+                self.__propertyTypes.setdefault(str(s), PropertyType.LITERAL)
+            elif o == OWL.ObjectProperty:
+                self.__propertyTypes.setdefault(str(s), PropertyType.OBJECT)
+
+        self.__informationEntities = {}
+        for s, o in ontology.subject_objects(LDCM.related_to_information_entity):
+            self.__informationEntities.setdefault(str(s), o)
+
+        self.__sequences = {}
+        for s, o in ontology.subject_objects(LDCM.related_to_sequence):
+            self.__sequences.setdefault(str(s), o)
+
+        # rdfs:subClassOf* for every class in the ontology, starting with the class itself
+        self.__superClasses = {}
+        for classUri in set(ontology.subjects(RDFS.subClassOf)) | set(ontology.objects(None, RDFS.subClassOf)):
+            self.__superClasses[str(classUri)] = self.__transitiveSuperClasses(classUri)
+
+        sequenceItemClass = str(LDCM.Sequence_Item)
+        self.__sequenceItemClasses = {}
+        for s, o in ontology.subject_objects(LDCM.related_to_sequence):
+            if sequenceItemClass in self.__getSuperClasses(s):
+                self.__sequenceItemClasses.setdefault(str(o), s)
+
+        identifiers = {}
+        for s, o in ontology.subject_objects(LDCM.has_unique_identifier):
+            identifiers.setdefault(str(s), o)
+        self.__keys = {}
+        for classUri in self.__superClasses:
+            for superClass in self.__superClasses[classUri]:
+                if superClass in identifiers:
+                    self.__keys[classUri] = identifiers[superClass]
+                    break
+        for classUri in identifiers:
+            self.__keys.setdefault(classUri, identifiers[classUri])
+
+        self.__classesForUid = {}
+        for s, o in ontology.subject_objects(LDCM.has_sop_class_uid):
+            self.__classesForUid.setdefault(str(o), s)
+
+        self.__predicatesForRange = {}
+        for predicate, rangeClass in ontology.subject_objects(RDFS.range):
+            for domain in ontology.objects(predicate, RDFS.domain):
+                self.__predicatesForRange.setdefault(str(rangeClass), []).append(
+                    {"predicate": predicate, "domain": domain})
+        self.__objectPredicatesForRange = {}
+        for classUri in self.__superClasses:
+            rows = []
+            for superClass in self.__superClasses[classUri]:
+                for row in self.__predicatesForRange.get(superClass, []):
+                    if row not in rows:
+                        rows.append(row)
+            self.__objectPredicatesForRange[classUri] = rows
+
+        self.__tagPlan = self.__compileTagPlan()
+
+    def __compileTagPlan(self):
+        """
+        Build the tag plan: integer DICOM tag -> tuple of TagPredicate, with the T (tag) predicate
+        before the R (reference) predicate. Tags which are not in the plan are not mapped in the ontology.
+        :return:
+        """
+        predicatesForTag = {}
+        for subject in self.__subjects:
+            match = TAG_PREDICATE_PATTERN.match(subject)
+            if match is not None:
+                predicatesForTag.setdefault(int(match.group(2), 16), {})[match.group(1)] = subject
+
+        tagPlan = {}
+        for tag, predicates in predicatesForTag.items():
+            tagPredicates = []
+            for predicateKind in ["T", "R"]:
+                if predicateKind not in predicates:
+                    continue
+                predicate = predicates[predicateKind]
+                informationEntity = self.relatedToInformationEntity(predicate)
+                key = self.getKeyForClass(informationEntity)
+                keyTag = None
+                if key is not None:
+                    keyTag = int(str(key).replace(str(LDCM) + "T", ""), 16)
+                sequenceClass = self.relatedToSequence(predicate)
+                tagPredicates.append(TagPredicate(predicate=URIRef(predicate),
+                                                  propertyType=self.getPredicatePropertyType(predicate),
+                                                  informationEntity=informationEntity,
+                                                  key=key,
+                                                  keyTag=keyTag,
+                                                  sequenceClass=sequenceClass,
+                                                  sequenceItemClass=self.getRelatedSequenceItemClass(sequenceClass),
+                                                  tagString="%08x" % tag))
+            tagPlan[tag] = tuple(tagPredicates)
+        return tagPlan
+
+    def getMappedTags(self):
+        """
+        All DICOM tags the parser can use: the tags in the tag plan, the SOP Class UID and the unique
+        identifier tags of the classes. Can be used as whitelist when reading DICOM headers.
+        :return: sorted list of integer DICOM tags
+        """
+        mappedTags = set(self.__tagPlan.keys())
+        mappedTags.add(0x00080016)
+        for key in self.__keys.values():
+            match = TAG_PREDICATE_PATTERN.match(str(key))
+            if match is not None:
+                mappedTags.add(int(match.group(2), 16))
+        return sorted(mappedTags)
+
+    def __transitiveSuperClasses(self, classUri):
+        """
+        :param classUri:
+        :return: list of the class and all its super classes, nearest first
+        """
+        result = [str(classUri)]
+        toVisit = [classUri]
+        while toVisit:
+            current = toVisit.pop(0)
+            for superClass in self.__ontology.objects(current, RDFS.subClassOf):
+                if str(superClass) not in result:
+                    result.append(str(superClass))
+                    toVisit.append(superClass)
+        return result
+
+    def __getSuperClasses(self, classUri):
+        return self.__superClasses.get(str(classUri), [str(classUri)])
+
+    def getTagPlan(self):
+        """
+        :return: dict of integer DICOM tag -> tuple of TagPredicate
+        """
+        return self.__tagPlan
 
     def predicateExists(self, predicateUri):
-        return (URIRef(predicateUri), None, None) in self.__ontology
-    
+        return str(predicateUri) in self.__subjects
+
     def getPredicatePropertyType(self, predicateUri):
-        result = self.__ontology.query("""
-            PREFIX ldcm: <https://johanvansoest.nl/ontologies/LinkedDicom/>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX owl: <http://www.w3.org/2002/07/owl#>
-
-            SELECT ?class
-            WHERE {
-                <%s> rdf:type ?class.
-                FILTER (?class IN (owl:DatatypeProperty, owl:ObjectProperty))
-            }
-        """ % predicateUri)
-        for row in result:
-            if str(row["class"])=="http://www.w3.org/2002/07/owl#DatatypeProperty":
-                return PropertyType.LITERAL
-            if str(row["class"])=="http://www.w3.org/2002/07/owl#ObjectProperty":
-                return PropertyType.OBJECT
-    
+        return self.__propertyTypes.get(str(predicateUri))
+
     def relatedToInformationEntity(self, predicateUri):
-        result = self.__ontology.query("""
-            PREFIX ldcm: <https://johanvansoest.nl/ontologies/LinkedDicom/>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX owl: <http://www.w3.org/2002/07/owl#>
-
-            SELECT ?class
-            WHERE {
-                <%s> ldcm:related_to_information_entity ?class.
-            }
-        """ % predicateUri)
-        for row in result:
-            return row["class"]
+        return self.__informationEntities.get(str(predicateUri))
 
     def getRelatedSequenceItemClass(self, sequenceClass):
-        result = self.__ontology.query("""
-            PREFIX ldcm: <https://johanvansoest.nl/ontologies/LinkedDicom/>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX owl: <http://www.w3.org/2002/07/owl#>
-
-            SELECT ?class
-            WHERE {
-                ?class ldcm:related_to_sequence <%s>;
-                       rdfs:subClassOf* ldcm:Sequence_Item.
-            }
-        """ % sequenceClass)
-        for row in result:
-            return row["class"]
-    
+        return self.__sequenceItemClasses.get(str(sequenceClass))
+
     def relatedToSequence(self, predicateUri):
-        result = self.__ontology.query("""
-            PREFIX ldcm: <https://johanvansoest.nl/ontologies/LinkedDicom/>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX owl: <http://www.w3.org/2002/07/owl#>
-
-            SELECT ?class
-            WHERE {
-                <%s> ldcm:related_to_sequence ?class.
-            }
-        """ % predicateUri)
-        for row in result:
-            return row["class"]
+        return self.__sequences.get(str(predicateUri))
 
     def getObjectPredicatesForClassRange(self, classUri):
         """
 
         :param classUri:
-        :return:
+        :return: list of rows with the keys "predicate" and "domain"
         """
-        result = self.__ontology.query("""
-            PREFIX ldcm: <https://johanvansoest.nl/ontologies/LinkedDicom/>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX owl: <http://www.w3.org/2002/07/owl#>
-
-            SELECT ?predicate ?domain
-            WHERE {
-                <%s> rdfs:subClassOf* ?superClass.
-                
-                {
-                    ?predicate rdfs:range <%s>.
-                    ?predicate rdfs:domain ?domain.
-                } UNION {
-                    ?predicate rdfs:range ?superClass.
-                    ?predicate rdfs:domain ?domain.
-                }
-            }
-        """ % (classUri, classUri))
-        return result
-    
+        classUri = str(classUri)
+        if classUri in self.__objectPredicatesForRange:
+            return self.__objectPredicatesForRange[classUri]
+        return self.__predicatesForRange.get(classUri, [])
+
     def getKeyForClass(self, classUri):
         """
         :param classUri:
         :return:
         """
-        result = self.__ontology.query("""
-            PREFIX ldcm: <https://johanvansoest.nl/ontologies/LinkedDicom/>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX owl: <http://www.w3.org/2002/07/owl#>
-
-            SELECT ?tag
-            WHERE {
-                <%s> rdfs:subClassOf* ?superClass.
-
-                { ?superClass ldcm:has_unique_identifier ?tag }
-                UNION
-                { <%s> ldcm:has_unique_identifier ?tag. }
-            }
-        """ % (classUri, classUri))
-        for row in result:
-            return row["tag"]
-    
+        return self.__keys.get(str(classUri))
+
     def getClassForUID(self, uid):
         """
         :param uid:
         :return:
         """
-        result = self.__ontology.query("""
-            PREFIX ldcm: <https://johanvansoest.nl/ontologies/LinkedDicom/>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX owl: <http://www.w3.org/2002/07/owl#>
-
-            SELECT ?class
-            WHERE {
-                ?class ldcm:has_sop_class_uid "%s".
-            }
-        """ % uid)
-        for row in result:
-            return row["class"]
-        return "https://johanvansoest.nl/ontologies/LinkedDicom/Information_Object_Definition"
+        return self.__classesForUid.get(str(uid),
+                                        "https://johanvansoest.nl/ontologies/LinkedDicom/Information_Object_Definition")
@@ -1,83 +1,306 @@
 import rdflib
 from rdflib import RDF, RDFS, Literal, URIRef
+from collections import OrderedDict
+from functools import lru_cache
+import os
 import urllib.parse
 
+# Graph identifier used in persistent stores, so the triples are found again when the store is reopened
+STORE_GRAPH_IDENTIFIER = URIRef("http://data.local/rdf/linkeddicom/")
+
+# Number of short IRI <-> URIRef conversions cached per GraphService
+IRI_CACHE_SIZE = 100000
+# Number of instance IRIs remembered when the graph itself can be checked for the other instances
+INSTANCE_CACHE_SIZE = 100000
+
+
+class _InstanceIndex:
+    """
+    IRIs of instances known to exist. With a maximum size only the most recently used IRIs are kept.
+    """
+
+    def __init__(self, maxsize=None):
+        """
+        :param maxsize: number of IRIs kept, None to keep all
+        """
+        self.__maxsize = maxsize
+        self.__instances = OrderedDict()
+
+    def __contains__(self, instanceUri):
+        if instanceUri not in self.__instances:
+            return False
+        if self.__maxsize is not None:
+            self.__instances.move_to_end(instanceUri)
+        return True
+
+    def add(self, instanceUri):
+        self.__instances[instanceUri] = None
+        if self.__maxsize is not None:
+            self.__instances.move_to_end(instanceUri)
+            if len(self.__instances) > self.__maxsize:
+                self.__instances.popitem(last=False)
+
+    def clear(self):
+        self.__instances.clear()
+
 
 class GraphService:
-    def __init__(self, filePath=None, store=None):
+    def __init__(self, filePath=None, store=None, sink=None, storePath=None, storeType="Oxigraph",
+                 checkInstances=True):
+        """
+        :param filePath: RDF file to load in memory, or in the persistent store when it is still empty
+        :param store: rdflib store to use (e.g. SPARQLStore)
+        :param sink: file path or binary file-like object. When given, the graph only holds the triples
+            which are not flushed yet, every flush appends them as N-Triples to the sink. The flushed triples
+            of shared instances are kept, so they are written once although every file adds them again.
+        :param storePath: directory of a persistent on-disk store, created when it does not exist
+        :param storeType: rdflib store plugin used for storePath, e.g. "Oxigraph" (oxrdflib) or "BerkeleyDB"
+        :param checkInstances: check that the instance exists before adding predicates to it.
+            Can be disabled for bulk loads, as it only guards against programming errors.
+        """
+        self.__checkInstances = checkInstances
+        # triples added since recordTriples was called, None when not recording
+        self.__recorded = None
+        # IRIs of the instances in the graph, when it is complete a miss does not need a lookup in the store.
+        # Otherwise a miss is looked up in the graph, so only the recently used IRIs are kept (e.g. for a
+        # persistent store, which would be undone by keeping every IRI in memory)
+        self.__instanceIndexComplete = filePath is None and store is None and storePath is None
+        self.__instances = _InstanceIndex(None if self.__instanceIndexComplete else INSTANCE_CACHE_SIZE)
+        self.__sink = None
+        self.__ownsSink = False
+        # IRI strings of the shared instances (patient, study, series, equipment), which many files refer to.
+        # They are never evicted, so they are not created again after a flush in a long run
+        self.__sharedInstances = set()
+        # flushed triples of the shared instances, except their links to the instances of a single file
+        self.__emittedSharedTriples = set()
+        if sink is not None:
+            if hasattr(sink, "write"):
+                self.__sink = sink
+            else:
+                self.__sink = open(sink, "wb")
+                self.__ownsSink = True
 
-        if filePath is not None:
+        self.__persistent = False
+        if storePath is not None:
+            try:
+                self.__graph = rdflib.Graph(store=storeType, identifier=STORE_GRAPH_IDENTIFIER)
+            except rdflib.plugin.PluginException:
+                raise Exception(f"Store type {storeType} is not available, for Oxigraph install oxrdflib")
+            self.__graph.open(storePath, create=not os.path.exists(storePath))
+            self.__persistent = True
+            self.__bindNamespaces()
+            if filePath is not None and (None, None, None) not in self.__graph:
+                self.__graph.parse(filePath, format=rdflib.util.guess_format(filePath), encoding="utf-8")
+        elif filePath is not None:
             self.__graph = rdflib.Graph()
-            self.__graph.bind('ldcm', 'https://johanvansoest.nl/ontologies/LinkedDicom/')
-            self.__graph.bind('data', 'http://data.local/rdf/linkeddicom/')
-            self.__graph.bind('rdfs', 'http://www.w3.org/2000/01/rdf-schema#')
-            self.__graph.bind('schema', 'https://schema.org/')
-            self.__graph.bind('file', 'file:/')
+            self.__bindNamespaces()
             self.__graph.parse(filePath, format=rdflib.util.guess_format(filePath), encoding="utf-8")
         elif store is not None:
             self.__graph = rdflib.Graph(store=store)
         else:
             self.__graph = rdflib.Graph()
-            self.__graph.bind('ldcm', 'https://johanvansoest.nl/ontologies/LinkedDicom/')
-            self.__graph.bind('data', 'http://data.local/rdf/linkeddicom/')
-            self.__graph.bind('rdfs', 'http://www.w3.org/2000/01/rdf-schema#')
-            self.__graph.bind('schema', 'https://schema.org/')
-            self.__graph.bind('file', 'file:/')
+            self.__bindNamespaces()
+        self.__resolveNamespaces()
 
-    def replaceUriToShort(self, uriString):
-        for ns in self.__graph.namespaces():
-            uriString = uriString.replace(str(ns[1]), str(ns[0]) + ":")
+    def __bindNamespaces(self):
+        self.__graph.bind('ldcm', 'https://johanvansoest.nl/ontologies/LinkedDicom/')
+        self.__graph.bind('data', 'http://data.local/rdf/linkeddicom/')
+        self.__graph.bind('rdfs', 'http://www.w3.org/2000/01/rdf-schema#')
+        self.__graph.bind('schema', 'https://schema.org/')
+        self.__graph.bind('file', 'file:/')
+
+    def __resolveNamespaces(self):
+        """
+        Resolve the namespace bindings once into a fixed prefix map, and create the IRI caches
+        :return:
+        """
+        self.__namespaces = [(str(prefix), str(namespace)) for prefix, namespace in self.__graph.namespaces()]
+        self.__prefixMap = dict(self.__namespaces)
+        self.__shortToUri = lru_cache(maxsize=IRI_CACHE_SIZE)(self.__buildUri)
+        self.__uriToShort = lru_cache(maxsize=IRI_CACHE_SIZE)(self.__buildShort)
+
+    def __buildUri(self, iriString):
+        position = iriString.find(":")
+        content = urllib.parse.quote(iriString[position + 1:])
+        prefix = iriString[0:position]
+        namespace = self.__prefixMap.get(prefix)
+        if position < 0 or namespace is None:
+            return URIRef(f"{iriString[0:position + 1]}{content}")
+        return URIRef(namespace + content)
+
+    def __buildShort(self, uriString):
+        for prefix, namespace in self.__namespaces:
+            uriString = uriString.replace(namespace, prefix + ":")
         return uriString
 
-    def replaceShortToUri(self, iriString):
-        content = iriString[iriString.find(":") + 1:]
-        content = urllib.parse.quote(content)
-        prefix = iriString[0:iriString.find(":") + 1]
-        iriString = f"{prefix}{content}"
+    def toUri(self, iri):
+        """
+        :param iri: URIRef, which is returned as is, or a short ("data:...") or full IRI string
+        :return: URIRef
+        """
+        if type(iri) is URIRef:
+            return iri
+        return self.__shortToUri(str(iri))
+
+    def replaceUriToShort(self, uriString):
+        return self.__uriToShort(str(uriString))
 
-        for ns in self.__graph.namespaces():
-            iriString = iriString.replace(str(ns[0]) + ":", str(ns[1]))
-        return URIRef(iriString)
+    def replaceShortToUri(self, iriString):
+        return self.__shortToUri(str(iriString))
 
     def removeNamespaceFromClass(self, iriString):
-        for ns in self.__graph.namespaces():
-            iriString = iriString.replace(str(ns[0]) + ":", "")
+        for prefix, namespace in self.__namespaces:
+            iriString = iriString.replace(prefix + ":", "")
         return iriString
 
     def valueAsIri(self, value):
         value = urllib.parse.quote(value)
-        return self.replaceShortToUri("data:" + value)
+        return self.__shortToUri("data:" + value)
 
     def instanceIriExists(self, iriString):
-        return (self.replaceShortToUri(iriString), None, None) in self.__graph
+        instanceUri = self.toUri(iriString)
+        if instanceUri in self.__instances:
+            return True
+        if self.__sharedInstances and str(instanceUri) in self.__sharedInstances:
+            return True
+        if self.__instanceIndexComplete:
+            return False
+        return (instanceUri, None, None) in self.__graph
 
-    def createOrGetInstance(self, classUri, identifier, identifierPredicate=None):
-        iriClass = self.replaceUriToShort(classUri)
-        if identifier.startswith("data:"):
-            instanceIri = identifier
+    def createOrGetInstance(self, classUri, identifier, identifierPredicate=None, shared=False):
+        """
+        :param classUri:
+        :param identifier: value identifying the instance, or the IRI (URIRef or "data:..." string) of the instance
+        :param identifierPredicate: predicate to store the identifier value with, if any
+        :param shared: the instance is referred to by many files (e.g. patient, study or series), it is remembered
+            after a flush
+        :return: URIRef of the instance
+        """
+        if type(identifier) is URIRef:
+            instanceUri = identifier
+        elif identifier.startswith("data:"):
+            instanceUri = self.__shortToUri(identifier)
         else:
-            instanceIri = "data:%s" % identifier
+            instanceUri = self.__shortToUri("data:%s" % identifier)
 
-        if not self.instanceIriExists(instanceIri):
-            self.__graph.add([self.replaceShortToUri(instanceIri), RDF.type, self.replaceShortToUri(iriClass)])
+        if not self.instanceIriExists(instanceUri):
+            self.__add((instanceUri, RDF.type, self.__shortToUri(self.replaceUriToShort(classUri))))
             if identifierPredicate is not None:
-                self.__graph.add([self.replaceShortToUri(instanceIri), self.replaceShortToUri(identifierPredicate),
-                                  Literal(identifier)])
+                self.__add((instanceUri, self.toUri(identifierPredicate), Literal(identifier)))
+            self.__instances.add(instanceUri)
+            if shared:
+                self.__sharedInstances.add(str(instanceUri))
 
-        return instanceIri
+        return instanceUri
 
     def addPredicateLiteralToInstance(self, instanceIri, predicate, value):
-        if not self.instanceIriExists(instanceIri):
+        instanceUri = self.toUri(instanceIri)
+        if self.__checkInstances and not self.instanceIriExists(instanceUri):
             raise Exception("Instance IRI does not exist")
 
-        self.__graph.add([self.replaceShortToUri(instanceIri), self.replaceShortToUri(predicate), Literal(value)])
+        self.__add((instanceUri, self.toUri(predicate), Literal(value)))
 
     def addPredicateObjectToInstance(self, instanceIri, predicate, value):
-        if not self.instanceIriExists(instanceIri):
+        instanceUri = self.toUri(instanceIri)
+        if self.__checkInstances and not self.instanceIriExists(instanceUri):
             raise Exception("Instance IRI does not exist")
 
-        self.__graph.add(
-            [self.replaceShortToUri(instanceIri), self.replaceShortToUri(predicate), self.replaceShortToUri(value)])
+        self.__add((instanceUri, self.toUri(predicate), self.toUri(value)))
+
+    def __add(self, triple):
+        self.__graph.add(triple)
+        if self.__recorded is not None:
+            self.__recorded.append(triple)
+
+    def recordTriples(self):
+        """
+        Start recording the triples added to the graph, replacing an earlier recording
+        :return: list the triples are appended to, also when they are flushed to a sink afterwards
+        """
+        self.__recorded = []
+        return self.__recorded
+
+    def stopRecording(self):
+        self.__recorded = None
+
+    def getTriples(self):
+        """
+        :return: list of all (subject, predicate, object) triples in the graph
+        """
+        return list(self.__graph)
+
+    def addTriples(self, triples, sharedInstances=()):
+        """
+        Merge triples (e.g. from getTriples of another GraphService) into this graph.
+        Instances present in both graphs are deduplicated, as the graph is a set of triples.
+        :param triples:
+        :param sharedInstances: IRI strings of the shared instances of the triples, see getSharedInstances
+        :return:
+        """
+        for triple in triples:
+            self.__graph.add(triple)
+            self.__instances.add(triple[0])
+        self.__sharedInstances.update(sharedInstances)
+
+    def getSharedInstances(self):
+        """
+        :return: set of the IRI strings of the instances created as shared
+        """
+        return self.__sharedInstances
+
+    def isStreaming(self):
+        return self.__sink is not None
+
+    def isDurable(self):
+        """
+        :return: True when the triples are written out as they are added (sink or persistent store)
+        """
+        return self.__sink is not None or self.__persistent
+
+    def flush(self):
+        """
+        Append the triples in memory as N-Triples to the sink and clear the graph.
+        Does nothing when no sink is set.
+        :return:
+        """
+        if self.__sink is None:
+            return
+        # the triples of shared instances are added again by every file referring to them, their links to the
+        # instances of the flushed files are not added again and are not remembered
+        duplicates = []
+        for triple in self.__graph:
+            if str(triple[0]) not in self.__sharedInstances:
+                continue
+            if triple in self.__emittedSharedTriples:
+                duplicates.append(triple)
+            elif not (triple[2] in self.__instances and str(triple[2]) not in self.__sharedInstances):
+                self.__emittedSharedTriples.add(triple)
+        for triple in duplicates:
+            self.__graph.remove(triple)
+
+        self.__graph.serialize(destination=self.__sink, format="nt")
+        self.__sink.flush()
+        self.__graph.remove((None, None, None))
+        # of the flushed instances only the shared instances are remembered
+        self.__instances.clear()
+
+    def close(self):
+        """
+        Flush the remaining triples and close the sink if it was opened by this GraphService,
+        or close the persistent store.
+        :return:
+        """
+        if self.__persistent:
+            self.__graph.close()
+            self.__persistent = False
+        if self.__sink is None:
+            return
+        self.flush()
+        if self.__ownsSink:
+            self.__sink.close()
+        else:
+            self.__sink.flush()
+        self.__sink = None
 
     def getAllTriples(self):
         # return str(self.__graph.serialize(format="n3"), 'utf-8')
@@ -87,6 +310,10 @@ class GraphService:
         return allTriplesSerialized
 
     def saveTriples(self, filePath):
+        if self.__sink is not None:
+            # the triples are already written to the sink
+            self.close()
+            return
         with open(filePath, "w") as text_file:
             text_file.write(self.getAllTriples())
 
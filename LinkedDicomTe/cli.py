@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
 from LinkedDicomTe import LinkedDicom
+from LinkedDicomTe.DicomScanner import is_archive
 from LinkedDicomTe.rt import dvh
-from LinkedDicomTe.rt.dvh import calculate_dvh_folder, dose_summation_process
+from LinkedDicomTe.rt.dvh import calculate_dvh_folder, calculate_dvh_packages, dose_summation_process
+from LinkedDicomTe.rt.metrics import MetricSet, DEFAULT_METRICS
+from LinkedDicomTe.rt.result_sink import OUTPUT_FORMATS, export_jsonld
+from LinkedDicomTe.rt.sparql_pages import DEFAULT_PAGE_SIZE
 import os
 import click
 import pandas as pd
-from .util import upload_graph_db
+from .util import parse_memory_size, upload_graph_db
 from uuid import uuid4
 import logging
 
@@ -44,30 +48,70 @@ SELECT  distinct ?patientID ?rtDose ?rtStruct ?rtDosePath ?rtStructPath ?rtPlanP
                 
                 
                 """
+
+
+def output_folder(dicom_input):
+    """
+    :param dicom_input: folder or archive given as DICOM input
+    :return: folder the results are stored in by default, the folder of an archive
+    """
+    if is_archive(dicom_input):
+        return os.path.dirname(os.path.abspath(dicom_input))
+    return dicom_input
+
+
 @click.command()
 @click.argument('dicom-input-folder', type=click.Path(exists=True))
 @click.option('-o', '--ontology-file', help='Location of ontology file to use for override.')
 @click.option('-fp', '--file-persistent', is_flag=True, default=False, help='Store file path while parsing metadata.')
 @click.option('-ol', '--output_location', default=None, help='Store file path while parsing metadata.')
+@click.option('-ho', '--header-only/--full-read', default=True,
+              help='Read only the mapped header tags and stop before the pixel data (default).')
+@click.option('-w', '--workers', type=int, default=1, help='Number of processes used to parse the files.')
+@click.option('-st', '--stream', is_flag=True, default=False,
+              help='Write the triples as N-Triples while parsing instead of keeping them in memory. '
+                   'The triples of instances shared by several files (patient, study, series) are written once.')
+@click.option('-sp', '--store_path', default=None,
+              help='Directory of a persistent triple store to add the triples to, instead of memory.')
+@click.option('-sty', '--store_type', default="Oxigraph", help='rdflib store plugin used for the store path.')
+@click.option('-b', '--bulk', is_flag=True, default=False,
+              help='Bulk mode, skip the instance existence check when adding triples.')
+@click.option('-eo', '--extension-only', is_flag=True, default=False,
+              help='Only parse files ending with .dcm, do not check other files for the DICOM magic.')
+@click.option('-ca', '--count-ahead', is_flag=True, default=False,
+              help='Count the .dcm files of the folder in a second walk, for the ETA of the progress log.')
 def main_parse(dicom_input_folder, ontology_file, file_persistent,
-               output_location=None):
+               output_location=None, header_only=True, workers=1, stream=False, store_path=None,
+               store_type="Oxigraph", bulk=False, extension_only=False, count_ahead=False):
     """
     Search the DICOM_INPUT_FOLDER for dicom files, and process these files.
-    The resulting turtle file can be stored in linkeddicom.ttl within this folder or in other location
+    DICOM_INPUT_FOLDER can also be a zip or tar archive, which is read without extracting it.
+    The resulting turtle file can be stored in linkeddicom.ttl within this folder (next to the archive) or in
+    other location if the output_location has been provided.
+    When a store path is given the triples are kept in that store, and only exported to turtle
     if the output_location has been provided.
     """
     ldcm = LinkedDicom.LinkedDicom(ontology_file)
+    if bulk:
+        ldcm.setBulkMode(True)
+    if store_path is not None:
+        ldcm.openStore(store_path, store_type)
+    else:
+        if output_location is None:
+            output_location = os.path.join(output_folder(dicom_input_folder), "linkeddicom.ttl")
+        if stream:
+            ldcm.streamResults(output_location)
 
     logging.info(f"Start processing folder {dicom_input_folder}. Depending on the folder size this might take a while.")
 
-    ldcm.process_folder_exe(dicom_input_folder, persistent_storage=file_persistent)
-    if output_location is None:
-        output_location = os.path.join(dicom_input_folder, "linkeddicom.ttl")
-        ldcm.saveResults(output_location)
-        logging.info("Stored results in " + output_location)
-    else:
+    ldcm.process_folder_exe(dicom_input_folder, persistent_storage=file_persistent, header_only=header_only,
+                            workers=workers, detect_magic=not extension_only, count_ahead=count_ahead)
+    if output_location is not None:
         ldcm.saveResults(output_location)
         logging.info("Stored results in " + output_location)
+    if store_path is not None:
+        ldcm.closeStore()
+        logging.info("Stored results in store " + store_path)
 
 
 @click.command()
@@ -75,29 +119,48 @@ def main_parse(dicom_input_folder, ontology_file, file_persistent,
 @click.option('-o', '--ontology-file', help='Location of ontology file to use for override.')
 @click.option('-fp', '--file-persistent', is_flag=True, default=False, help='Store file path while parsing metadata.')
 @click.option('-ol', '--output_location', default=None, help='output file locaiton.')
-@click.option('-ks', '--list_saved', default=None, help='save location')
+@click.option('-ks', '--list_saved', default=None,
+              help='Ingest manifest (SQLite) location, unchanged files done in earlier runs are skipped.')
 @click.option('-nf', '--number_file', type=int, default=None, help='number file to process')
+@click.option('-ho', '--header-only/--full-read', default=True,
+              help='Read only the mapped header tags and stop before the pixel data (default).')
+@click.option('-w', '--workers', type=int, default=1, help='Number of processes used to parse the files.')
+@click.option('-st', '--stream', is_flag=True, default=False,
+              help='Write the triples as N-Triples while parsing instead of keeping them in memory. '
+                   'The triples of instances shared by several files (patient, study, series) are written once.')
+@click.option('-b', '--bulk', is_flag=True, default=False,
+              help='Bulk mode, skip the instance existence check when adding triples.')
+@click.option('-eo', '--extension-only', is_flag=True, default=False,
+              help='Only parse files ending with .dcm, do not check other files for the DICOM magic.')
+@click.option('-ca', '--count-ahead', is_flag=True, default=False,
+              help='Count the .dcm files of the folder in a second walk, for the ETA of the progress log.')
 def main_parse_test(dicom_input_folder, ontology_file, file_persistent,
-                    list_saved, number_file, output_location=None):
+                    list_saved, number_file, output_location=None, header_only=True, workers=1, stream=False,
+                    bulk=False, extension_only=False, count_ahead=False):
     """
     Search the DICOM_INPUT_FOLDER for dicom files, and process these files.
-    The resulting turtle file can be stored in linkeddicom.ttl within this folder or in other location
-    if the output_location has been provided.
+    DICOM_INPUT_FOLDER can also be a zip or tar archive, which is read without extracting it.
+    The resulting turtle file can be stored in linkeddicom.ttl within this folder (next to the archive) or in
+    other location if the output_location has been provided.
     """
     ldcm = LinkedDicom.LinkedDicom(ontology_file)
+    if bulk:
+        ldcm.setBulkMode(True)
+    uuid_for_calculation_str = str(uuid4())
+    if output_location is None:
+        output_file = os.path.join(output_folder(dicom_input_folder), uuid_for_calculation_str + "_linkeddicom.ttl")
+    else:
+        output_file = output_location + uuid_for_calculation_str + "_linkeddicom.ttl"
+    if stream:
+        ldcm.streamResults(output_file)
 
     logging.info(f"Start processing folder {dicom_input_folder}. Depending on the folder size this might take a while.")
 
-    ldcm.process_folder_exe(dicom_input_folder, file_persistent, list_saved, number_file)
-    uuid_for_calculation_str = str(uuid4())
+    ldcm.process_folder_exe(dicom_input_folder, file_persistent, list_saved, number_file, header_only, workers,
+                            not extension_only, count_ahead)
     logging.info(f"Calculation completed saving file....")
-    if output_location is None:
-        output_location = os.path.join(dicom_input_folder, uuid_for_calculation_str + "_linkeddicom.ttl")
-        ldcm.saveResults(output_location)
-        logging.info("Stored results in " + output_location)
-    else:
-        ldcm.saveResults(output_location + uuid_for_calculation_str + "_linkeddicom.ttl")
-        logging.info("Stored results in " + output_location)
+    ldcm.saveResults(output_file)
+    logging.info("Stored results in " + output_file)
 
 
 @click.command()
@@ -105,43 +168,134 @@ def main_parse_test(dicom_input_folder, ontology_file, file_persistent,
 @click.argument('query', type=str)
 @click.option('-fl', '--ldcm_rdf_location', default=None, type=click.Path(exists=True))
 @click.option('-ep', '--db_endpoint', default=None, type=str)
-def calc_dvh(output_location, query=query_example, ldcm_rdf_location=None, db_endpoint=None):
+@click.option('-sp', '--store_path', default=None,
+              help='Directory of a persistent triple store to query, loaded from the ttl file when it is empty.')
+@click.option('-sty', '--store_type', default="Oxigraph", help='rdflib store plugin used for the store path.')
+@click.option('-sw', '--structure-workers', type=int, default=1,
+              help='Number of processes calculating the structures of a package in parallel.')
+@click.option('-w', '--workers', type=int, default=1, help='Number of dose packages calculated at the same time.')
+@click.option('-mm', '--max-memory', default=None,
+              help='Memory budget of the running dose packages and their structure workers, for example 8G. '
+                   'No limit by default.')
+@click.option('-to', '--timeout', type=float, default=None, help='Seconds after which a dose package is stopped.')
+@click.option('-r', '--retries', type=int, default=1, help='Number of times a failed dose package is tried again.')
+@click.option('-m', '--metrics', default=",".join(DEFAULT_METRICS),
+              help='Comma separated DVH metrics to calculate, for example D2,D95,D2cc,V95,V20Gy.')
+@click.option('-of', '--output-format', type=click.Choice(OUTPUT_FORMATS), default="jsonld",
+              help='jsonld for a file per calculation, or parquet, arrow or npz for one columnar store.')
+@click.option('-cu', '--context-url', default=None,
+              help='URL of the JSON-LD context the documents refer to, by default it is written in the output folder.')
+@click.option('--memmap-rtdose/--no-memmap-rtdose', default=True,
+              help='Memory map the RT Dose pixel data and summed doses instead of loading them.')
+@click.option('-rc', '--result-cache', default=None, type=click.Path(),
+              help='SQLite file caching the DVH results, packages found in it are not calculated again.')
+@click.option('--overwrite', is_flag=True, default=False,
+              help='Replace the parquet, arrow or npz results of an earlier run in the output folder.')
+@click.option('-ps', '--page-size', type=int, default=None,
+              help=f'Rows per page of the package query, packages are calculated while the next pages are fetched. '
+                   f'0 runs the query at once. Default {DEFAULT_PAGE_SIZE} for an endpoint, at once for a ttl file '
+                   f'or store.')
+@click.option('-pw', '--page-workers', type=int, default=4,
+              help='Number of pages fetched at the same time from the endpoint.')
+def calc_dvh(output_location, query=query_example, ldcm_rdf_location=None, db_endpoint=None, store_path=None,
+             store_type="Oxigraph", structure_workers=1, workers=1, max_memory=None, timeout=None, retries=1,
+             metrics=",".join(DEFAULT_METRICS), output_format="jsonld", context_url=None, memmap_rtdose=True,
+             result_cache=None, page_size=None, page_workers=4, overwrite=False):
     logging.info('Starting DVH Extraction')
     logging.info("File location: ", str(ldcm_rdf_location))
     logging.info("The output is saved in: ",str(output_location))
-    if db_endpoint is not None and ldcm_rdf_location is None:
-        dvh_factory = dvh.DVH_dicompyler(ldcm_rdf_location, urls=db_endpoint, query=query)
-        dvh_factory.calculate_dvh(output_location)
+    if db_endpoint is not None and ldcm_rdf_location is None and store_path is None:
+        dvh_factory = dvh.DVH_dicompyler(ldcm_rdf_location, urls=db_endpoint, query=query,
+                                         page_size=DEFAULT_PAGE_SIZE if page_size is None else page_size,
+                                         page_workers=page_workers)
+        dvh_factory.calculate_dvh(output_location, workers=workers, structure_workers=structure_workers,
+                                  max_memory=max_memory, timeout=timeout, retries=retries,
+                                  metrics=MetricSet(metrics).names, output_format=output_format,
+                                  context_url=context_url, memmap_rtdose=memmap_rtdose,
+                                  result_cache=result_cache, overwrite=overwrite)
 
-    elif db_endpoint is None and ldcm_rdf_location is not None:
-        dvh_factory = dvh.DVH_dicompyler(ldcm_rdf_location, query=query)
-        dvh_factory.calculate_dvh(output_location)
+    elif db_endpoint is None and (ldcm_rdf_location is not None or store_path is not None):
+        dvh_factory = dvh.DVH_dicompyler(ldcm_rdf_location, query=query, store_path=store_path,
+                                         store_type=store_type, page_size=page_size)
+        dvh_factory.calculate_dvh(output_location, workers=workers, structure_workers=structure_workers,
+                                  max_memory=max_memory, timeout=timeout, retries=retries,
+                                  metrics=MetricSet(metrics).names, output_format=output_format,
+                                  context_url=context_url, memmap_rtdose=memmap_rtdose,
+                                  result_cache=result_cache, overwrite=overwrite)
     else:
-        raise Exception("Missing ttl file location or graphdb address")
+        raise Exception("Missing ttl file location, store path or graphdb address")
 
 
 @click.command()
 @click.argument('db_host', type=str)
 @click.argument('repo_db', type=str)
 @click.argument('file', type=click.Path(exists=True))
-def upload_graph(db_host, repo_db, file):
-    upload_graph_db(db_host, repo_db, file, contenttype="application/x-turtle")
+@click.option('-cs', '--chunk-size', default="4M", help='Uncompressed size of the chunks sent, for example 4M.')
+@click.option('-w', '--workers', type=int, default=4, help='Number of chunks sent at the same time.')
+@click.option('-r', '--retries', type=int, default=5, help='Number of times a failed chunk is sent again.')
+@click.option('-cp', '--checkpoint', type=click.Path(), default=None,
+              help='JSON file recording the uploaded chunks, an interrupted upload continues from it.')
+@click.option('--gzip/--no-gzip', 'compress', default=True, help='Send the chunks gzip compressed (default).')
+@click.option('--parse-in-memory', is_flag=True, default=False,
+              help='Parse a small file which is neither N-Triples nor Turtle (e.g. JSON-LD) in memory first.')
+def upload_graph(db_host, repo_db, file, chunk_size, workers, retries, checkpoint, compress, parse_in_memory):
+    """
+    Upload the triples of FILE to the statements of repository REPO_DB on the GraphDB server DB_HOST.
+    N-Triples files (also the streamed results of ldcm-parse) are read in chunks, Turtle files are streamed as
+    one request, other formats are only parsed in memory with --parse-in-memory.
+    """
+    upload_graph_db(db_host, repo_db, file, contenttype="application/x-turtle",
+                    chunk_size=parse_memory_size(chunk_size), workers=workers, retries=retries,
+                    checkpoint_path=checkpoint, compress=compress, parse_in_memory=parse_in_memory)
 
 
 @click.command()
 @click.argument('path_file', type=click.Path(exists=False))
 @click.argument('output_folder', type=click.Path(exists=False))
-def DVH_from_folder_file(path_file, output_folder):
+@click.option('-sw', '--structure-workers', type=int, default=1,
+              help='Number of processes calculating the structures of a package in parallel.')
+@click.option('-w', '--workers', type=int, default=1, help='Number of dose packages calculated at the same time.')
+@click.option('-mm', '--max-memory', default=None,
+              help='Memory budget of the running dose packages and their structure workers, for example 8G. '
+                   'No limit by default.')
+@click.option('-to', '--timeout', type=float, default=None, help='Seconds after which a dose package is stopped.')
+@click.option('-r', '--retries', type=int, default=1, help='Number of times a failed dose package is tried again.')
+@click.option('-m', '--metrics', default=",".join(DEFAULT_METRICS),
+              help='Comma separated DVH metrics to calculate, for example D2,D95,D2cc,V95,V20Gy.')
+@click.option('-of', '--output-format', type=click.Choice(OUTPUT_FORMATS), default="jsonld",
+              help='jsonld for a file per calculation, or parquet, arrow or npz for one columnar store.')
+@click.option('-cu', '--context-url', default=None,
+              help='URL of the JSON-LD context the documents refer to, by default it is written in the output folder.')
+@click.option('--memmap-rtdose/--no-memmap-rtdose', default=True,
+              help='Memory map the RT Dose pixel data and summed doses instead of loading them.')
+@click.option('-rc', '--result-cache', default=None, type=click.Path(),
+              help='SQLite file caching the DVH results, packages found in it are not calculated again.')
+@click.option('--overwrite', is_flag=True, default=False,
+              help='Replace the parquet, arrow or npz results of an earlier run in the output folder.')
+def DVH_from_folder_file(path_file, output_folder, structure_workers, workers, max_memory, timeout, retries, metrics,
+                         output_format, context_url, memmap_rtdose, result_cache, overwrite):
     csv_data: pd.DataFrame = pd.read_csv(path_file)
+    packages = []
     for row in csv_data.itertuples():
-        logging.info("working on patient: " + row.patientID)
-        try:
-            calculate_dvh_folder(row.pathRT,row.rtDosePath, patient_id=row.patientID,
-                                 rt_plan_path=row.rtPlanPath,
-                                 folder_to_store_results=output_folder)
-        # TODO identify exception to catch
-        except:
-            continue
+        rt_plan_path = row.rtPlanPath if isinstance(row.rtPlanPath, str) else None
+        packages.append((row.patientID, row.pathRT, (row.rtDosePath,), rt_plan_path))
+    calculate_dvh_packages(packages, output_folder, workers=workers, max_memory=max_memory, timeout=timeout,
+                           retries=retries, structure_workers=structure_workers, metrics=MetricSet(metrics).names,
+                           output_format=output_format, context_url=context_url, memmap_rtdose=memmap_rtdose,
+                           result_cache=result_cache, overwrite=overwrite)
+
+
+@click.command()
+@click.argument('results_path', type=click.Path(exists=True))
+@click.argument('output_folder', type=click.Path(exists=True))
+@click.option('-cu', '--context-url', default=None,
+              help='URL of the JSON-LD context the documents refer to, by default it is written in the output folder.')
+def export_dvh_results(results_path, output_folder, context_url):
+    """
+    Export the JSON-LD documents of a parquet, arrow or npz DVH result store
+    """
+    count = export_jsonld(results_path, output_folder, context_url)
+    logging.info(f"Exported {count} calculations to {output_folder}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import logging
+
+import numpy as np
+import pydicom
+from dicompylercore import dicomparser
+
+from LinkedDicomTe.rt.parser_cache import parser_cache
+
+PIXEL_DATA_TAG = 0x7FE00010
+# maximum difference in mm for positions, spacings and frame offsets of coincident grids
+GEOMETRY_TOLERANCE = 1e-3
+# attributes which have to be equal for doses to be summed
+DOSE_ATTRIBUTES = ("DoseUnits", "DoseType")
+
+
+def header_without_pixel_data(ds):
+    """
+    :param ds: pydicom Dataset of the RT Dose
+    :return: copy of the dataset without the pixel data
+    """
+    header = pydicom.Dataset()
+    if hasattr(ds, "file_meta"):
+        header.file_meta = ds.file_meta
+    for element in ds:
+        if element.tag != PIXEL_DATA_TAG:
+            header.add(element)
+    return header
+
+
+def grid_axes(ds):
+    """
+    :param ds: pydicom Dataset of the RT Dose
+    :return: x, y and z axes of the grid in mm, following dicompyler-core DoseGrid
+    """
+    position = [float(value) for value in ds.ImagePositionPatient]
+    spacing = [float(value) for value in ds.PixelSpacing]
+    x_axis = np.arange(ds.Columns) * spacing[0] + position[0]
+    y_axis = np.arange(ds.Rows) * spacing[1] + position[1]
+    z_axis = np.array(ds.GridFrameOffsetVector, dtype=float) + position[2]
+    return x_axis, y_axis, z_axis
+
+
+def is_coincident(ds, other):
+    """
+    :return: True when both RT Dose grids have the same position, spacing, size and frame offsets
+    """
+    axes = grid_axes(ds)
+    other_axes = grid_axes(other)
+    return all(axis.shape == other_axis.shape and np.allclose(axis, other_axis, rtol=0, atol=GEOMETRY_TOLERANCE)
+               for axis, other_axis in zip(axes, other_axes))
+
+
+def open_rt_dose(dose_path, memmap_pixel_array=True):
+    """
+    :param dose_path: file path of an RT Dose
+    :param memmap_pixel_array: memory map the pixel array of an uncompressed little endian file, other pixel data
+        is always loaded, see parser_cache.open_parser
+    :return: DicomParser of the file through the parser cache
+    """
+    return parser_cache.get_parser(dose_path, memmap_pixel_array=memmap_pixel_array)
+
+
+def memmap_source(pixel_array):
+    """
+    :param pixel_array: numpy array, a memory mapped array covers all the pixel data as returned by
+        DicomParser.GetPixelArray or np.load
+    :return: (file path, dtype, offset, shape) to memory map the same array again, None when it is not memory mapped
+    """
+    filename = getattr(pixel_array, "filename", None)
+    if isinstance(pixel_array, np.memmap) and filename is not None and pixel_array.flags.c_contiguous:
+        return str(filename), pixel_array.dtype, pixel_array.offset, pixel_array.shape
+    return None
+
+
+def open_memmap_source(source):
+    """
+    :param source: see memmap_source
+    :return: read only memory mapped array
+    """
+    filename, dtype, offset, shape = source
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+class DoseAccumulator:
+    """
+    Sum RT Dose grids in place in one float32 buffer on the grid of the first dose. The geometry of every dose
+    is checked once against the reference grid: coincident grids are scaled and added frame by frame, other
+    grids are resampled with trilinear interpolation on the reference grid, dose outside of them is 0.
+    With a buffer_path the buffer is a memory mapped .npy file instead of an array in memory.
+    """
+
+    def __init__(self, reference, buffer_path=None):
+        """
+        :param reference: DicomParser of the RT Dose defining the grid of the sum, it is not added
+        :param buffer_path: path of a .npy file to accumulate in, None to accumulate in memory
+        """
+        self.header = header_without_pixel_data(reference.ds)
+        self.shape = np.shape(reference.GetPixelArray())
+        frames = len(self.header.GridFrameOffsetVector)
+        shape = (frames, self.header.Rows, self.header.Columns)
+        self.buffer_path = buffer_path
+        if buffer_path is None:
+            self.buffer = np.zeros(shape, dtype=np.float32)
+        else:
+            # a new file reads as zeros
+            self.buffer = np.lib.format.open_memmap(buffer_path, mode="w+", dtype=np.float32, shape=shape)
+        self.axes = grid_axes(self.header)
+        self.count = 0
+        self.interpolated = 0
+
+    def add(self, rt_dose):
+        """
+        :param rt_dose: DicomParser of the RT Dose to add
+        :return:
+        """
+        ds = rt_dose.ds
+        for attribute in DOSE_ATTRIBUTES:
+            if getattr(ds, attribute, None) != getattr(self.header, attribute, None):
+                raise Exception(f"Cannot sum doses with a different {attribute}: "
+                                f"{getattr(ds, attribute, None)} and {getattr(self.header, attribute, None)}")
+        if not np.allclose(np.array(ds.ImageOrientationPatient, dtype=float),
+                           np.array(self.header.ImageOrientationPatient, dtype=float), atol=GEOMETRY_TOLERANCE):
+            raise Exception(f"Cannot sum doses with a different ImageOrientationPatient: "
+                            f"{ds.ImageOrientationPatient} and {self.header.ImageOrientationPatient}")
+
+        scaling = float(ds.DoseGridScaling)
+        pixels = rt_dose.GetPixelArray()
+        pixels = pixels.reshape((-1, pixels.shape[-2], pixels.shape[-1]))
+        if is_coincident(ds, self.header):
+            frame = np.empty(self.buffer.shape[1:], dtype=np.float32)
+            for index in range(self.buffer.shape[0]):
+                np.multiply(pixels[index], scaling, out=frame)
+                self.buffer[index] += frame
+        else:
+            logging.info(f"Resampling dose {getattr(ds, 'SOPInstanceUID', '')} on the grid of the summed dose")
+            self.__add_resampled(ds, pixels, scaling)
+            self.interpolated += 1
+        self.count += 1
+
+    def __add_resampled(self, ds, pixels, scaling):
+        from scipy.ndimage import map_coordinates
+        x_axis, y_axis, z_axis = grid_axes(ds)
+        x_spacing, y_spacing = (float(value) for value in ds.PixelSpacing)
+        # index of the reference axes in the grid of the other dose, -2 is outside and interpolates to 0
+        columns = (self.axes[0] - x_axis[0]) / x_spacing
+        rows = (self.axes[1] - y_axis[0]) / y_spacing
+        if z_axis.size > 1:
+            order = np.argsort(z_axis)
+            frames = np.interp(self.axes[2], z_axis[order], order.astype(float), left=-2, right=-2)
+        else:
+            frames = np.where(np.isclose(self.axes[2], z_axis[0], atol=GEOMETRY_TOLERANCE), 0.0, -2.0)
+        row_index, column_index = np.meshgrid(rows, columns, indexing="ij")
+        resampled = np.empty(self.buffer.shape[1:], dtype=np.float32)
+        for index, frame in enumerate(frames):
+            coordinates = [np.full(row_index.shape, frame), row_index, column_index]
+            map_coordinates(pixels, coordinates, output=resampled, order=1, mode="constant", cval=0.0)
+            resampled *= scaling
+            self.buffer[index] += resampled
+
+    def result(self):
+        """
+        :return: DicomParser of the summed dose, the pixel array is the float32 buffer in Gy with a DoseGridScaling
+        of 1, memory mapped read only from the buffer_path when given
+        """
+        header = header_without_pixel_data(self.header)
+        # the elements are shared with the parsed reference dose, they are replaced instead of changed
+        for keyword, value in (("DoseGridScaling", 1.0),
+                               ("DoseComment", ("INTERPOLATED" if self.interpolated else "DIRECT") + " SUMMATION")):
+            if keyword in header:
+                delattr(header, keyword)
+            setattr(header, keyword, value)
+        parser = dicomparser.DicomParser(header)
+        if self.buffer_path is not None:
+            self.buffer.flush()
+            self.buffer = np.load(self.buffer_path, mmap_mode="r")
+        parser.pixel_array = self.buffer.reshape(self.shape)
+        return parser
+
+
+def sum_doses(rt_doses, buffer_path=None, memmap_rtdose=True):
+    """
+    :param rt_doses: list of file paths or DicomParsers of the RT Doses to sum
+    :param buffer_path: .npy file to accumulate in and memory map the sum from, see DoseAccumulator
+    :param memmap_rtdose: memory map the pixel arrays of the RT Dose files, see open_rt_dose
+    :return: DicomParser of the summed dose on the grid of the first dose
+    """
+    if not rt_doses:
+        raise Exception("No RT Dose to sum")
+    parsers = [open_rt_dose(rt_dose, memmap_rtdose) if isinstance(rt_dose, str) else rt_dose
+               for rt_dose in rt_doses]
+    accumulator = DoseAccumulator(parsers[0], buffer_path)
+    for parser in parsers:
+        accumulator.add(parser)
+    logging.info(f"Summed {accumulator.count} doses, {accumulator.interpolated} resampled")
+    return accumulator.result()
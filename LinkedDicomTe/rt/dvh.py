@@ -3,24 +3,228 @@ import datetime
 from abc import ABC, abstractmethod
 from dicompylercore import dicomparser, dvh, dvhcalc  # TODO do not load this module if dicompyler is not used
 import dicompylercore
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_URL
 import rdflib
-import json
 import os
+import functools
+import shutil
+import tempfile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import logging
 from rdflib.plugins.stores.sparqlstore import SPARQLStore
 import pydicom
 from dicompylercore import dose
+from LinkedDicomTe.rt.parser_cache import parser_cache, extract_structures
+from LinkedDicomTe.rt.dose_sum import header_without_pixel_data, memmap_source, open_memmap_source, open_rt_dose, \
+    sum_doses
+from LinkedDicomTe.rt.scheduler import DvhScheduler, group_jobs, stream_jobs
+from LinkedDicomTe.rt.sparql_pages import SparqlPager
+from LinkedDicomTe.rt.metrics import MetricSet, DEFAULT_METRICS
+from LinkedDicomTe.rt.result_sink import DvhCurve, JsonLdSink, open_result_sink
+from LinkedDicomTe.rt.result_cache import DvhResultCache
+
+
+# parameters of the dicompyler-core DVH calculation of get_dvh_for_structures, part of the result cache key
+DVH_PARAMETERS = {
+    "limit": None,
+    "calculate_full_volume": True,
+    "use_structure_extents": False,
+    "interpolation_resolution": None,
+    "interpolation_segments_between_planes": 0
+}
+
+# dose grid of the DVH pool workers, set once per worker process by _init_dvh_worker
+_worker_dose = None
+_worker_rx_dose = None
+
+
+def _to_file_path(path):
+    """
+    :param path: URIRef or string
+    :return: file path, without the file:// scheme of an URIRef
+    """
+    if type(path) == rdflib.term.URIRef:
+        return str(path).replace("file://", "")
+    return path
+
+
+def _dose_parser(dose_data, memmap_rtdose=False):
+    """
+    :param dose_data: file path, pydicom Dataset, DoseGrid or DicomParser of the RT Dose
+    :param memmap_rtdose: memory map the pixel array when dose_data is a file path
+    :return: DicomParser of the RT Dose
+    """
+    if isinstance(dose_data, dicomparser.DicomParser):
+        return dose_data
+    if isinstance(dose_data, dose.DoseGrid):
+        return dicomparser.DicomParser(dose_data.ds)
+    if isinstance(dose_data, str):
+        return open_rt_dose(dose_data, memmap_rtdose)
+    return dicomparser.DicomParser(dose_data)
+
+
+def _rx_dose(rt_plan_p):
+    """
+    :param rt_plan_p: pydicom Dataset or file path of the RT Plan, can be None
+    :return: prescription dose in Gy, None when not available
+    """
+    if rt_plan_p is None:
+        return None
+    rt_plan_p = _to_file_path(rt_plan_p)
+    if isinstance(rt_plan_p, str):
+        plan = parser_cache.get_parser(rt_plan_p).GetPlan()
+    else:
+        plan = dicomparser.DicomParser(rt_plan_p).GetPlan()
+    if plan['rxdose'] is None:
+        return None
+    return plan['rxdose'] / 100
+
+
+def _structures_with_planes(structure):
+    """
+    :param structure: file path or pydicom Dataset of the RT Structure Set
+    :return: dict of ROI number -> structure dict with the planes and thickness needed by the DVH calculation,
+    file paths are parsed once through the parser cache
+    """
+    if isinstance(structure, str):
+        return parser_cache.get_structures(structure)
+    return extract_structures(dicomparser.DicomParser(structure))
+
+
+def _cumulative_dvh(structure, rt_dose, rx_dose=None, limit=None, calculate_full_volume=True,
+                    use_structure_extents=False, interpolation_resolution=None,
+                    interpolation_segments_between_planes=0, callback=None):
+    """
+    :param structure: structure dict with planes and thickness
+    :param rt_dose: DicomParser of the RT Dose
+    :param rx_dose: prescription dose in Gy, can be None
+    :return: cumulative dvh.DVH in Gy
+    """
+    calc_dvh = dvhcalc._calculate_dvh(structure, rt_dose, limit, calculate_full_volume,
+                                      use_structure_extents, interpolation_resolution,
+                                      interpolation_segments_between_planes,
+                                      callback)
+    kwargs = {}
+    if rx_dose is not None:
+        kwargs["rx_dose"] = rx_dose
+    return dvh.DVH(counts=calc_dvh.histogram,
+                   bins=(np.arange(0, 2) if (calc_dvh.histogram.size == 1) else
+                         np.arange(0, calc_dvh.histogram.size + 1) / 100),
+                   dvh_type='differential',
+                   dose_units='Gy',
+                   notes=calc_dvh.notes,
+                   name=structure['name'],
+                   **kwargs).cumulative
+
+
+def _structure_dvh(rt_dose, rx_dose, structure):
+    """
+    :return: tuple of the cumulative DVH or None, and the error message when it failed
+    """
+    try:
+        return _cumulative_dvh(structure, rt_dose, rx_dose, **DVH_PARAMETERS), None
+    except Exception as except_t:
+        return None, str(except_t)
+
+
+def _init_dvh_worker(dose_header, pixel_array_source, rx_dose):
+    """
+    Initializer of the DVH pool processes. The dose grid is memory mapped from the same file region as the
+    memory mapped grid of the parent, the RT Dose file or the .npy file an in memory grid was written to, so all
+    workers share the pages of the same grid instead of getting a pickled copy or opening the RT Dose again.
+    """
+    global _worker_dose, _worker_rx_dose
+    _worker_dose = dicomparser.DicomParser(dose_header)
+    _worker_dose.pixel_array = open_memmap_source(pixel_array_source)
+    _worker_rx_dose = rx_dose
+
+
+def _structure_dvh_worker(structure):
+    return _structure_dvh(_worker_dose, _worker_rx_dose, structure)
+
+
+def _calculate_structure_dvhs(structures, rt_dose_data, rx_dose, workers=1, use_threads=False, memmap_rtdose=True):
+    """
+    Calculate the DVH of the structures, in order, with a pool of workers when workers > 1.
+    Threads share the parsed dose grid directly, processes memory map it, see _init_dvh_worker.
+    :param structures: list of structure dicts with planes and thickness
+    :param rt_dose_data: file path, pydicom Dataset or DoseGrid of the RT Dose
+    :param rx_dose: prescription dose in Gy, can be None
+    :param workers: number of workers
+    :param use_threads: use a thread pool instead of a process pool
+    :param memmap_rtdose: memory map the pixel array of an RT Dose file
+    :return: generator of (structure, cumulative DVH or None, error message)
+    """
+    if workers <= 1 or len(structures) <= 1 or use_threads:
+        rt_dose = _dose_parser(rt_dose_data, memmap_rtdose)
+        calculate = functools.partial(_structure_dvh, rt_dose, rx_dose)
+        if workers <= 1 or len(structures) <= 1:
+            results = map(calculate, structures)
+            for structure, result in zip(structures, results):
+                yield (structure,) + result
+            return
+        with ThreadPool(min(workers, len(structures))) as pool:
+            for structure, result in zip(structures, pool.imap(calculate, structures)):
+                yield (structure,) + result
+        return
+
+    temporary_folder = None
+    try:
+        rt_dose = _dose_parser(rt_dose_data, memmap_rtdose)
+        dose_header = header_without_pixel_data(rt_dose.ds)
+        # a dose memory mapped from its RT Dose file or a summed dose memory mapped from a .npy file is shared as it is
+        pixel_array_source = memmap_source(rt_dose.GetPixelArray())
+        if pixel_array_source is None:
+            temporary_folder = tempfile.mkdtemp(prefix="ldcm-dose-")
+            pixel_array_path = os.path.join(temporary_folder, "pixel_array.npy")
+            np.save(pixel_array_path, rt_dose.GetPixelArray())
+            pixel_array_source = memmap_source(np.load(pixel_array_path, mmap_mode="r"))
+        del rt_dose
+
+        with Pool(min(workers, len(structures)), initializer=_init_dvh_worker,
+                  initargs=(dose_header, pixel_array_source, rx_dose)) as pool:
+            for structure, result in zip(structures, pool.imap(_structure_dvh_worker, structures)):
+                yield (structure,) + result
+    finally:
+        if temporary_folder is not None:
+            shutil.rmtree(temporary_folder, ignore_errors=True)
+
+
+def _cache_parameters(metric_set):
+    """
+    :return: the calculation parameters which are part of the result cache key
+    """
+    return {"metrics": list(metric_set.names), "dvh": DVH_PARAMETERS}
 
 
-def get_dvh_for_structures(rt_struct_path, rt_dose_data, rt_plan_path=None):
+def _open_result_cache(result_cache):
+    """
+    :param result_cache: DvhResultCache, path of the cache file or None
+    :return: DvhResultCache or None
+    """
+    if result_cache is None or isinstance(result_cache, DvhResultCache):
+        return result_cache
+    return DvhResultCache(result_cache)
+
+
+def get_dvh_for_structures(rt_struct_path, rt_dose_data, rt_plan_path=None, workers=1, use_threads=False,
+                           metrics=DEFAULT_METRICS, memmap_rtdose=True, result_cache=None, cache_key=None):
     """
             Calculate DVH parameters for all structures available in the RT-STRUCT file.
+            The RT-STRUCT, RT-DOSE and RT-PLAN are parsed once, with workers > 1 the structures are
+            calculated in parallel.
             Input:
                 - rtStructPath: an URIRef or string containing the file path of the RT-STRUCT file
                 - rtDosePath: an URIRef or string containing the file path of the RT-DOSE file or the rt-dose itself
                 - rtPlan
+                - workers: number of processes (or threads) calculating structures in parallel
+                - use_threads: use threads instead of processes
+                - metrics: names of the Dx/Dxcc/Vx/VxGy metrics to calculate, or a MetricSet
+                - memmap_rtdose: memory map the pixel array of the RT-DOSE file instead of loading it
+                - result_cache: DvhResultCache, structures found in it are not calculated again
+                - cache_key: package key of the results in the cache, by default the key of the given files
             Output:
                 - A python list containing a dictionaries with the following items:
                     - structureName: name of the structure as given in the RT-STRUCT file
@@ -28,68 +232,55 @@ def get_dvh_for_structures(rt_struct_path, rt_dose_data, rt_plan_path=None):
                     - mean: mean dose for this structure
                     - max: maximum dose for this structure
                     - volume: volume of the structure
+                    - a value per metric, for example D10 or V20
                     - color: color (Red Green Blue) for the structure on a scale of 0-255
-                    - dvh_d: list of dose values on the DVH curve
-                    - dvh_v: list of volume values on the DVH curve
+                    - dvh_curve: the DVH curve, its dvh_points a DvhCurve of the dose and volume arrays
             """
-    dvh_list = []  # result dvh
-
-    if type(rt_struct_path) == rdflib.term.URIRef:
-        rt_struct_path = str(rt_struct_path).replace("file://", "")
-    structObj = dicomparser.DicomParser(rt_struct_path)
+    metric_set = metrics if isinstance(metrics, MetricSet) else MetricSet(metrics)
+
+    rt_struct_path = _to_file_path(rt_struct_path)
+    rt_dose_data = _to_file_path(rt_dose_data)
+    rt_plan_path = _to_file_path(rt_plan_path)
+    # copies, the cached structures are shared
+    structures = [dict(structure) for structure in _structures_with_planes(rt_struct_path).values()]
+
+    # ROI number -> structure result
+    results = {}
+    if result_cache is not None and cache_key is None:
+        if isinstance(rt_struct_path, str) and isinstance(rt_dose_data, str) and \
+                (rt_plan_path is None or isinstance(rt_plan_path, str)):
+            cache_key = result_cache.package_key(rt_struct_path, (rt_dose_data,), rt_plan_path,
+                                                 _cache_parameters(metric_set))
+        else:
+            logging.warning("The result cache needs the file paths of the RT objects, it is not used")
+            result_cache = None
+    if result_cache is not None:
+        for structure in structures:
+            cached = result_cache.get_structure(cache_key, structure["id"])
+            if cached is not None:
+                results[structure["id"]] = cached
+        if results:
+            logging.info(f"{len(results)} of {len(structures)} structures found in the result cache")
+    to_calculate = [structure for structure in structures if structure["id"] not in results]
 
     # RT-plan can be empty
+    rx_dose = _rx_dose(rt_plan_path)
 
-    if type(rt_dose_data) == rdflib.term.URIRef:
-        rt_dose_data = str(rt_dose_data).replace("file://", "")
-    structures = structObj.GetStructures()
+    if rx_dose is None and to_calculate:
+        logging.warning("No prescription dose available, relative volume metrics are left empty")
 
-    for index in structures:
-        logging.info("Calculating structures " + str(structures[index]))
-        structure = structures[index]
-        try:
-            calc_dvh = get_dvh_v(rt_struct_path, rt_dose_data, index, rt_plan_path)
-        except Exception as except_t:
-            logging.warning(except_t)
+    calculated = _calculate_structure_dvhs(to_calculate, rt_dose_data, rx_dose, workers, use_threads,
+                                           memmap_rtdose) if to_calculate else []
+    for structure, calc_dvh, error in calculated:
+        logging.info("Calculated structure " + str(structure["name"]))
+        if calc_dvh is None:
+            logging.warning(error)
             logging.warning("Skipping...")
             continue
 
-        dvh_d = calc_dvh.bincenters.tolist()
-        dvh_v = calc_dvh.counts.tolist()
-        dvh_points = []
-
-        for i in range(0, len(dvh_d)):
-            dvh_points.append({
-                "d_point": dvh_d[i],
-                "v_point": dvh_v[i]
-            })
-
-        try:
-            print(calc_dvh.V5)
-            print(calc_dvh.D98)
-            print(calc_dvh.V107)
-            print(calc_dvh.V10)
-            print(calc_dvh.D10)
-            print(calc_dvh.volume, calc_dvh.volume_units)
-
-            V5value = float(calc_dvh.V5.value)
-            V10value = float(calc_dvh.V10.value)
-            V20value = float(calc_dvh.V20.value)
-            V30value = float(calc_dvh.V30.value)
-            V40value = float(calc_dvh.V40.value)
-            V50value = float(calc_dvh.V50.value)
-            V60value = float(calc_dvh.V60.value)
-
-        except Exception as e:
-            logging.warning("Value not available exception =")
-            logging.error(e)
-            V5value = None
-            V10value = None
-            V20value = None
-            V30value = None
-            V40value = None
-            V50value = None
-            V60value = None
+        # the curve stays in arrays, the sinks write its points
+        dvh_points = DvhCurve(calc_dvh.bincenters, calc_dvh.counts)
+        metric_values = metric_set.calculate(calc_dvh.counts, calc_dvh.bins, rx_dose)
 
         id_data = "http://data.local/ldcm-rt/" + str(uuid4())
         try:
@@ -100,33 +291,31 @@ def get_dvh_for_structures(rt_struct_path, rt_dose_data, rt_plan_path=None):
                 "mean": {"@id": f"{id_data}/mean", "unit": "Gray", "value": calc_dvh.mean},
                 "max": {"@id": f"{id_data}/max", "unit": "Gray", "value": calc_dvh.max},
                 "volume": {"@id": f"{id_data}/volume", "unit": "cc", "value": int(calc_dvh.volume)},
-                "D10": {"@id": f"{id_data}/D10", "unit": "Gray", "value": float(calc_dvh.D10.value)},
-                "D20": {"@id": f"{id_data}/D20", "unit": "Gray", "value": float(calc_dvh.D20.value)},
-                "D30": {"@id": f"{id_data}/D30", "unit": "Gray", "value": float(calc_dvh.D30.value)},
-                "D40": {"@id": f"{id_data}/D40", "unit": "Gray", "value": float(calc_dvh.D40.value)},
-                "D50": {"@id": f"{id_data}/D50", "unit": "Gray", "value": float(calc_dvh.D50.value)},
-                "D60": {"@id": f"{id_data}/D60", "unit": "Gray", "value": float(calc_dvh.D60.value)},
-                "V5": {"@id": f"{id_data}/V5", "unit": "Gray", "value": V5value},
-                "V10": {"@id": f"{id_data}/V10", "unit": "Gray", "value": V10value},
-                "V20": {"@id": f"{id_data}/V20", "unit": "Gray", "value": V20value},
-                "V30": {"@id": f"{id_data}/V5", "unit": "Gray", "value": V30value},
-                "V40": {"@id": f"{id_data}/V10", "unit": "Gray", "value": V40value},
-                "V50": {"@id": f"{id_data}/V20", "unit": "Gray", "value": V50value},
-                "V60": {"@id": f"{id_data}/V20", "unit": "Gray", "value": V60value},
+            }
+            for name, value in metric_values.items():
+                structOut[name] = {"@id": f"{id_data}/{name}", "unit": "Gray" if name[0].upper() == "D" else "cc",
+                                   "value": value}
+            structOut.update({
                 "color": ','.join(str(e) for e in structure.get("color", np.array([])).tolist()),
 
                 "dvh_curve": {
                     "@id": f"{id_data}/dvh_curve",
                     "dvh_points": dvh_points
                 }
-            }
+            })
         except Exception as e:
             logging.info("error")
             logging.warning(e)
             continue
 
-        dvh_list.append(structOut)
-    return dvh_list
+        results[structure["id"]] = structOut
+        if result_cache is not None:
+            result_cache.put_structure(cache_key, structure["id"], structOut)
+
+    rois = [structure["id"] for structure in structures if structure["id"] in results]
+    if result_cache is not None:
+        result_cache.put_package(cache_key, rois)
+    return [results[roi] for roi in rois]
 
 
 def get_dvh_v(structure,
@@ -184,51 +373,16 @@ def get_dvh_v(structure,
     """
 
     # rtplan = rtplan.replace("/data/pre-act/mnt/", "/Volumes/research/Projects/cds/p0630-pre-act-dm/")
-    rt_str = dicomparser.DicomParser(structure)
-    if type(dose_data) is str:
-        rt_dose = dicomparser.DicomParser(dose_data, memmap_pixel_array=memmap_rtdose)
-    else:
-        rt_dose = dose_data
-    structures = rt_str.GetStructures()
-    s = structures[roi]
-    s['planes'] = rt_str.GetStructureCoordinates(roi)
-    s['thickness'] = thickness if thickness else rt_str.CalculatePlaneThickness(
-        s['planes'])
-
-    calc_dvh = dvhcalc._calculate_dvh(s, rt_dose, limit, calculate_full_volume,
-                                      use_structure_extents, interpolation_resolution,
-                                      interpolation_segments_between_planes,
-                                      callback)
-    if rt_plan_p is not None:
-        rt_plan = dicomparser.DicomParser(rt_plan_p)
-
-        plan = rt_plan.GetPlan()
-        if plan['rxdose'] is not None:
-
-            return dvh.DVH(counts=calc_dvh.histogram,
-                           bins=(np.arange(0, 2) if (calc_dvh.histogram.size == 1) else
-                                 np.arange(0, calc_dvh.histogram.size + 1) / 100),
-                           dvh_type='differential',
-                           dose_units='Gy',
-                           notes=calc_dvh.notes,
-                           name=s['name'],
-                           rx_dose=plan['rxdose'] / 100).cumulative
-        else:
-            return dvh.DVH(counts=calc_dvh.histogram,
-                           bins=(np.arange(0, 2) if (calc_dvh.histogram.size == 1) else
-                                 np.arange(0, calc_dvh.histogram.size + 1) / 100),
-                           dvh_type='differential',
-                           dose_units='Gy',
-                           notes=calc_dvh.notes,
-                           name=s['name']).cumulative
-    else:
-        return dvh.DVH(counts=calc_dvh.histogram,
-                       bins=(np.arange(0, 2) if (calc_dvh.histogram.size == 1) else
-                             np.arange(0, calc_dvh.histogram.size + 1) / 100),
-                       dvh_type='differential',
-                       dose_units='Gy',
-                       notes=calc_dvh.notes,
-                       name=s['name']).cumulative
+    structures = _structures_with_planes(_to_file_path(structure))
+    if roi not in structures:
+        raise Exception(f"No coordinates available for ROI {roi}")
+    s = dict(structures[roi])
+    if thickness:
+        s['thickness'] = thickness
+    rt_dose = _dose_parser(_to_file_path(dose_data), memmap_rtdose)
+    return _cumulative_dvh(s, rt_dose, _rx_dose(rt_plan_p), limit, calculate_full_volume,
+                           use_structure_extents, interpolation_resolution,
+                           interpolation_segments_between_planes, callback)
 
 
 class DVH_factory(ABC):
@@ -238,13 +392,24 @@ class DVH_factory(ABC):
     Tested only on GraphDB
     """
 
-    def __init__(self, file_path, query, urls=None, ):
+    def __init__(self, file_path, query, urls=None, store_path=None, store_type="Oxigraph", page_size=None,
+                 page_workers=4):
         """
         :param file_path:
         :param urls:
+        :param store_path: persistent store to query, file_path is loaded in it when the store is empty
+        :param store_type: rdflib store plugin used for store_path
+        :param page_size: rows per page of the query, the packages are calculated while the next pages are
+        fetched. None to run the query at once.
+        :param page_workers: number of pages fetched at the same time from the endpoint
         """
         self.query = query
-        if file_path is not None:
+        self.endpoint = urls if file_path is None and store_path is None else None
+        self.page_size = page_size
+        self.page_workers = page_workers
+        if store_path is not None:
+            self.__ldcm_graph = RDFService.GraphService(file_path, storePath=store_path, storeType=store_type)
+        elif file_path is not None:
             self.__ldcm_graph = RDFService.GraphService(file_path)
         else:
             store = SPARQLStore(urls)
@@ -257,18 +422,21 @@ class DVH_factory(ABC):
         return self.__ldcm_graph
 
     @abstractmethod
-    def calculate_dvh(self, folder_to_store_results):
+    def calculate_dvh(self, folder_to_store_results, workers=1, structure_workers=1, max_memory=None, timeout=None,
+                      retries=1, metrics=DEFAULT_METRICS, output_format="jsonld", context_url=None,
+                      memmap_rtdose=True, result_cache=None, overwrite=False):
         pass
 
 
-def check_dose_summ(dose_path):
+def check_dose_summ(dose_path, memmap_rtdose=True):
     """
     :param dose_path:
+    :param memmap_rtdose: memory map the RT Dose files instead of loading them, see open_rt_dose
     :return:
     """
     dose_to_sum = []
     for e in dose_path:
-        data = pydicom.dcmread(e)
+        data = open_rt_dose(e, memmap_rtdose).ds
         dose_summ = data.DoseSummationType
         if dose_summ == "BEAM":
             dose_to_sum.append(e)
@@ -278,57 +446,89 @@ def check_dose_summ(dose_path):
 def dose_summation(dose_file0, dose_file1):
     """
 
-    :param dose_file0:
-    :param dose_file1:
-    :return:
+    :param dose_file0: file path, DoseGrid or DicomParser of the first dose
+    :param dose_file1: file path of the second dose
+    :return: DicomParser of the summed dose, see dose_summation_process
     """
-    if type(dose_file0) is not dicompylercore.dose.DoseGrid:
-        grid_1 = dose.DoseGrid(dose_file0)
-    else:
-        grid_1 = dose_file0
-    grid_2 = dose.DoseGrid(dose_file1)
-    grid_sum = grid_1 + grid_2
-    return grid_sum
+    if isinstance(dose_file0, dose.DoseGrid):
+        dose_file0 = _dose_parser(dose_file0)
+    return dose_summation_process([dose_file0, dose_file1])
 
 
-def dose_summation_process(dose_to_sum_list):
+def dose_summation_process(dose_to_sum_list, pixel_array_path=None, memmap_rtdose=True):
     """
-
-    :param dose_to_sum_list: list of string path to the
-    :return:
+    Sum the doses in one pass on the grid of the first dose, see DoseAccumulator
+    :param dose_to_sum_list: list of string path to the RT Dose files
+    :param pixel_array_path: .npy file the sum is written to and memory mapped from, kept in memory when None
+    :param memmap_rtdose: memory map the RT Dose files instead of loading them
+    :return: DicomParser of the summed dose
     """
+    return sum_doses(dose_to_sum_list, pixel_array_path, memmap_rtdose)
 
-    result_dose = dose_to_sum_list[0]
-    data = pydicom.read_file(result_dose)
 
-    dose_summ = data.DoseSummationType
-    print(dose_summ)
-    print(data[0x3004, 0x000E].value)
-    print(data[0x0020, 0x0032])
-    print(data[0x0020, 0x0037])
-    print(data[0x0020, 0x000D])
-    print(data[0x0028, 0x0030])
-    print(data[0x3004, 0x000E])
-    print(data[0x3004, 0x000C])
-    for i in range(1, len(dose_to_sum_list)):
-        data = pydicom.read_file(dose_to_sum_list[i])
-
-        dose_summ = data.DoseSummationType
-        print(dose_summ)
-        print(data[0x3004, 0x000E].value)
-        print(data[0x0020, 0x0032])
-        print(data[0x0020, 0x0037])
-        print(data[0x0020, 0x000D])
-        print(data[0x0028, 0x0030])
-        print(data[0x3004, 0x000E])
-        print(data[0x3004, 0x000C])
-        print('fin')
-
-        result_dose = dose_summation(result_dose, dose_to_sum_list[i])
-    return result_dose
+def calculate_dose_structures(rt_struct_path, *rt_dose_path, rt_plan_path=None, structure_workers=1,
+                              metrics=DEFAULT_METRICS, memmap_rtdose=True, result_cache=None):
+    """
+    Calculate the DVH of all structures, the BEAM doses are summed when more than one RT Dose is given
+    :param rt_struct_path:
+    :param rt_dose_path:
+    :param rt_plan_path:
+    :param structure_workers: number of processes calculating the structures in parallel
+    :param metrics: names of the DVH metrics to calculate
+    :param memmap_rtdose: memory map the RT Dose files, and a summed dose from a temporary .npy file
+    :param result_cache: DvhResultCache or path of the cache file, a package found in it is not calculated again
+    :return: list of structure results of get_dvh_for_structures
+    """
+    rt_struct_path = _to_file_path(rt_struct_path)
+    rt_dose_path = [_to_file_path(dose_path) for dose_path in rt_dose_path]
+    rt_plan_path = _to_file_path(rt_plan_path)
+    metric_set = metrics if isinstance(metrics, MetricSet) else MetricSet(metrics)
+    cache = _open_result_cache(result_cache)
+    try:
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.package_key(rt_struct_path, rt_dose_path, rt_plan_path, _cache_parameters(metric_set))
+            calculatedDose = cache.get_package(cache_key)
+            if calculatedDose is not None:
+                logging.info(f"DVH of {rt_struct_path} | {rt_dose_path} found in the result cache")
+                return calculatedDose
+
+        if len(rt_dose_path) == 1:
+            return get_dvh_for_structures(rt_struct_path, rt_dose_path[0], rt_plan_path, workers=structure_workers,
+                                          metrics=metric_set, memmap_rtdose=memmap_rtdose, result_cache=cache,
+                                          cache_key=cache_key)
+        list_to_sum = check_dose_summ(rt_dose_path, memmap_rtdose)
+        temporary_folder = tempfile.mkdtemp(prefix="ldcm-dose-") if memmap_rtdose else None
+        try:
+            pixel_array_path = os.path.join(temporary_folder, "dose_sum.npy") if memmap_rtdose else None
+            grid_sum = dose_summation_process(list_to_sum, pixel_array_path, memmap_rtdose)
+            return get_dvh_for_structures(rt_struct_path, grid_sum, rt_plan_path, workers=structure_workers,
+                                          metrics=metric_set, memmap_rtdose=memmap_rtdose, result_cache=cache,
+                                          cache_key=cache_key)
+        finally:
+            if temporary_folder is not None:
+                shutil.rmtree(temporary_folder, ignore_errors=True)
+    finally:
+        if cache is not None and cache is not result_cache:
+            cache.close()
+
+
+def calculate_dvh_job(job, structure_workers=1, metrics=DEFAULT_METRICS, memmap_rtdose=True, result_cache=None):
+    """
+    :param job: DvhJob
+    :param structure_workers: number of processes calculating the structures in parallel
+    :param metrics: names of the DVH metrics to calculate
+    :param memmap_rtdose: memory map the RT Dose, see calculate_dose_structures
+    :param result_cache: path of the result cache file, opened in the process running the job
+    :return: list of structure results of get_dvh_for_structures
+    """
+    return calculate_dose_structures(job.rt_struct_path, *job.rt_dose_paths, rt_plan_path=job.rt_plan_path,
+                                     structure_workers=structure_workers, metrics=metrics,
+                                     memmap_rtdose=memmap_rtdose, result_cache=result_cache)
 
 
-def calculate_dvh_folder(rt_struct_path, *rt_dose_path, rt_plan_path=None, patient_id, folder_to_store_results):
+def calculate_dvh_folder(rt_struct_path, *rt_dose_path, rt_plan_path=None, patient_id, folder_to_store_results,
+                         structure_workers=1, metrics=DEFAULT_METRICS, memmap_rtdose=True, result_cache=None):
     """
 
 
@@ -337,114 +537,87 @@ def calculate_dvh_folder(rt_struct_path, *rt_dose_path, rt_plan_path=None, patie
     :param rt_plan_path:
     :param patient_id:
     :param folder_to_store_results:
+    :param structure_workers: number of processes calculating the structures in parallel
+    :param metrics: names of the DVH metrics to calculate
+    :param memmap_rtdose: memory map the RT Dose, see calculate_dose_structures
+    :param result_cache: DvhResultCache or path of the cache file, see calculate_dose_structures
     :return:
     """
-    if type(rt_dose_path) is not tuple or len(rt_dose_path) == 1:
-
-        try:
-            calculatedDose = get_dvh_for_structures(rt_struct_path, rt_dose_path,
-                                                    rt_plan_path)
-        except Exception as ex:
-            print(ex)
-            logging.warning(ex)
-            logging.info("Error skipping")
-            return
-    else:
-        list_to_sum = check_dose_summ(rt_dose_path)
-        grid_sum = dose_summation_process(list_to_sum)
-        calculatedDose = get_dvh_for_structures(rt_struct_path, grid_sum,
-                                                rt_plan_path)
+    try:
+        calculatedDose = calculate_dose_structures(rt_struct_path, *rt_dose_path, rt_plan_path=rt_plan_path,
+                                                   structure_workers=structure_workers, metrics=metrics,
+                                                   memmap_rtdose=memmap_rtdose, result_cache=result_cache)
+    except Exception as ex:
+        logging.warning(ex)
+        logging.info("Error skipping")
+        return
 
     logging.info("Calculation Complete ")
-    uuid_for_calculation = uuid4()
+    save_dvh_folder_result(calculatedDose, patient_id, folder_to_store_results)
+
+
+def calculate_dvh_packages(packages, folder_to_store_results, workers=1, max_memory=None, timeout=None, retries=1,
+                           structure_workers=1, metrics=DEFAULT_METRICS, output_format="jsonld", context_url=None,
+                           memmap_rtdose=True, result_cache=None, overwrite=False):
+    """
+    Calculate and save the DVH of dose packages concurrently, packages with the same files are calculated once
+    and saved for every package.
+    :param packages: iterable of (patient_id, rt_struct_path, tuple of rt_dose_paths, rt_plan_path)
+    :param folder_to_store_results:
+    :param workers: number of packages calculated at the same time
+    :param max_memory: memory budget of the running packages, see DvhScheduler
+    :param timeout: seconds after which the calculation of a package is stopped
+    :param retries: number of times a failed package is tried again
+    :param structure_workers: number of processes calculating the structures of a package in parallel
+    :param metrics: names of the DVH metrics to calculate
+    :param output_format: jsonld for a file per calculation, or parquet, arrow or npz for one columnar store
+    :param context_url: URL of the JSON-LD context the .jsonld documents refer to, written in the folder when None
+    :param memmap_rtdose: memory map the RT Dose, see calculate_dose_structures
+    :param result_cache: path of the result cache file, packages found in it are not calculated again
+    :param overwrite: replace the columnar store of an earlier run in the folder
+    :return:
+    """
+    jobs = group_jobs(packages, lambda package: (package[1], tuple(package[2]), package[3]))
+
+    sink = open_result_sink(folder_to_store_results, output_format, context_url, overwrite)
+
+    def save_results(job, calculatedDose):
+        for package in job.rows:
+            save_dvh_folder_result(calculatedDose, package[0], folder_to_store_results, sink)
+
+    try:
+        DvhScheduler(workers, max_memory, timeout, retries, job_processes=structure_workers).run(
+            jobs, functools.partial(calculate_dvh_job, structure_workers=structure_workers, metrics=metrics,
+                                    memmap_rtdose=memmap_rtdose, result_cache=result_cache),
+            save_results)
+    finally:
+        sink.close()
+
+
+def _calculation_uuid(calculatedDose, *identifiers):
+    """
+    :param calculatedDose: list of structure results of get_dvh_for_structures
+    :param identifiers: values identifying the document, for example the patient id
+    :return: uuid of the calculation document, the same for results reused from the result cache
+    """
+    if not calculatedDose:
+        return uuid4()
+    names = [str(structure["@id"]) for structure in calculatedDose] + [str(value) for value in identifiers]
+    return uuid5(NAMESPACE_URL, "|".join(names))
+
+
+def save_dvh_folder_result(calculatedDose, patient_id, folder_to_store_results, sink=None):
+    """
+    Save the JSON-LD document of a calculation
+    :param calculatedDose: list of structure results of get_dvh_for_structures
+    :param patient_id:
+    :param folder_to_store_results:
+    :param sink: DvhResultSink, a .jsonld file is written in folder_to_store_results when not given.
+    The sink adds the JSON-LD context.
+    :return:
+    """
+    uuid_for_calculation = _calculation_uuid(calculatedDose, patient_id)
     resultDict = {
-        "@context": {
-            "CalculationResult": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/CalculationResult",
-            "PatientID": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/PatientIdentifier",
-            "doseFraction": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/DoseFractionNumbers",
-            "references": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/references",
-                "@type": "@id"
-            },
-            "software": {
-                "@id": "https://schema.org/SoftwareApplication",
-                "@type": "@id"
-            },
-            "version": "https://schema.org/version",
-            "dateCreated": "https://schema.org/dateCreated",
-            "containsStructureDose": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/containsStructureDose",
-                "@type": "@id"
-            },
-            "structureName": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/structureName",
-            "min": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/min",
-                "@type": "@id"
-            },
-            "mean": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/mean",
-                "@type": "@id"
-            },
-            "max": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/max",
-                "@type": "@id"
-            },
-            "volume": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/volume",
-                "@type": "@id"
-            },
-            "D10": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D10",
-                "@type": "@id"
-            },
-            "D20": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D20",
-                "@type": "@id"
-            },
-            "D30": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D30",
-                "@type": "@id"
-            },
-            "D40": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D40",
-                "@type": "@id"
-            },
-            "D50": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D50",
-                "@type": "@id"
-            },
-            "D60": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D60",
-                "@type": "@id"
-            },
-            "V5": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V5",
-                "@type": "@id"
-            },
-            "V10": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V10",
-                "@type": "@id"
-            },
-            "V20": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V20",
-                "@type": "@id"
-            },
-            "dvh_points": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_point",
-                "@type": "@id"
-            },
-            "dvh_curve": {
-                "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_curve",
-                "@type": "@id"
-            },
-            "d_point": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_d_point",
-            "v_point": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_v_point",
-            "Gray": "http://purl.obolibrary.org/obo/UO_0000134",
-            "cc": "http://purl.obolibrary.org/obo/UO_0000097",
-            "unit": "@type",
-            "value": "https://schema.org/value",
-            "has_color": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/has_color"
-        },
         "@type": "CalculationResult",
         "@id": "http://data.local/ldcm-rt/" + str(uuid_for_calculation),
         "PatientID": patient_id,
@@ -458,11 +631,9 @@ def calculate_dvh_folder(rt_struct_path, *rt_dose_path, rt_plan_path=None, patie
         "containsStructureDose": [calculatedDose]
     }
 
-    filename = os.path.join(folder_to_store_results, f"{uuid_for_calculation}.jsonld")
-    logging.info("Saving in" + str(filename))
-    with open(filename, "w") as f:
-        json.dump(resultDict, f)
-        logging.info("Saving done")
+    if sink is None:
+        sink = JsonLdSink(folder_to_store_results)
+    sink.write(resultDict)
 
 
 class DVH_dicompyler(DVH_factory):
@@ -478,14 +649,33 @@ class DVH_dicompyler(DVH_factory):
         logging.info("Execution Query...")
         query = self.query
 
+        if self.page_size:
+            # rows of the same files come one after the other, so their package is complete when the file changes
+            pager = SparqlPager(query, self.endpoint, self.get_ldcm_graph(), self.page_size, self.page_workers,
+                                order_by=("rtStructPath", "rtDosePath", "rtPlanPath"))
+            return pager.rows()
+
         ldcm = self.get_ldcm_graph()
         dose_objects = ldcm.runSparqlQuery(query)
         return dose_objects
 
-    def calculate_dvh(self, folder_to_store_results):
+    def calculate_dvh(self, folder_to_store_results, workers=1, structure_workers=1, max_memory=None, timeout=None,
+                      retries=1, metrics=DEFAULT_METRICS, output_format="jsonld", context_url=None,
+                      memmap_rtdose=True, result_cache=None, overwrite=False):
         """
 
         :param folder_to_store_results:
+        :param workers: number of dose packages calculated at the same time
+        :param structure_workers: number of processes calculating the structures of a package in parallel
+        :param max_memory: memory budget of the running packages, see DvhScheduler
+        :param timeout: seconds after which the calculation of a package is stopped
+        :param retries: number of times a failed package is tried again
+        :param metrics: names of the DVH metrics to calculate
+        :param output_format: jsonld for a file per calculation, or parquet, arrow or npz for one columnar store
+        :param context_url: URL of the JSON-LD context the .jsonld documents refer to, written in the folder when None
+        :param memmap_rtdose: memory map the RT Dose, see calculate_dose_structures
+        :param result_cache: path of the result cache file, packages found in it are not calculated again
+        :param overwrite: replace the columnar store of an earlier run in the folder
         :return:
         """
         logging.info('Retrieving data from ttl file...')
@@ -497,141 +687,58 @@ class DVH_dicompyler(DVH_factory):
         logging.info("Data retrieve completed.")
         logging.info('Reading the data...')
 
-        for dosePackage in dcmDosePackages:
-            logging.info(
-                f"Processing  {dosePackage.patientID} | {dosePackage.rtDosePath} | {dosePackage.rtStructPath} |"
-                f"{dosePackage.rtPlanPath} | {dosePackage.fgn}...")
-            logging.info("Starting Calculation...")
-            try:
-
-                calculatedDose = get_dvh_for_structures(dosePackage.rtStructPath, dosePackage.rtDosePath,
-                                                        dosePackage.rtPlanPath)
-            except Exception as ex:
-                print(ex)
-                logging.warning(ex)
-                logging.info("Error skipping")
-                continue
+        # the rows of the fraction groups of a plan share the same files, which are calculated once
+        def job_key(dosePackage):
+            return (str(_to_file_path(dosePackage.rtStructPath)),
+                    (str(_to_file_path(dosePackage.rtDosePath)),),
+                    str(_to_file_path(dosePackage.rtPlanPath)) if dosePackage.rtPlanPath is not None else None)
+
+        if self.page_size:
+            # the packages are calculated while the rows are fetched
+            jobs = stream_jobs(dcmDosePackages, job_key)
+        else:
+            jobs = group_jobs(dcmDosePackages, job_key)
+            logging.info(f"{len(jobs)} dose packages to calculate for {sum(len(job.rows) for job in jobs)} rows")
+
+        sink = open_result_sink(folder_to_store_results, output_format, context_url, overwrite)
+
+        def save_results(job, calculatedDose):
             logging.info("Calculation Complete ")
-            uuid_for_calculation = uuid4()
-            resultDict = {
-                "@context": {
-                    "CalculationResult": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/CalculationResult",
-                    "PatientID": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/PatientIdentifier",
-                    "doseFraction": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/DoseFractionNumbers",
-                    "references": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/references",
-                        "@type": "@id"
-                    },
-                    "software": {
-                        "@id": "https://schema.org/SoftwareApplication",
-                        "@type": "@id"
-                    },
-                    "version": "https://schema.org/version",
-                    "dateCreated": "https://schema.org/dateCreated",
-                    "containsStructureDose": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/containsStructureDose",
-                        "@type": "@id"
-                    },
-                    "structureName": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/structureName",
-                    "min": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/min",
-                        "@type": "@id"
-                    },
-                    "mean": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/mean",
-                        "@type": "@id"
-                    },
-                    "max": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/max",
-                        "@type": "@id"
-                    },
-                    "volume": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/volume",
-                        "@type": "@id"
-                    },
-                    "D10": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D10",
-                        "@type": "@id"
-                    },
-                    "D20": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D20",
-                        "@type": "@id"
-                    },
-                    "D30": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D30",
-                        "@type": "@id"
-                    },
-                    "D40": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D40",
-                        "@type": "@id"
-                    },
-                    "D50": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D50",
-                        "@type": "@id"
-                    },
-                    "D60": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/D60",
-                        "@type": "@id"
-                    },
-                    "V5": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V5",
-                        "@type": "@id"
-                    },
-                    "V10": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V10",
-                        "@type": "@id"
-                    },
-                    "V20": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V20",
-                        "@type": "@id"
-                    },
-                    "V30": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V30",
-                        "@type": "@id"
-                    },
-                    "V40": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V40",
-                        "@type": "@id"
-                    },
-                    "V50": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V50",
-                        "@type": "@id"
-                    },
-                    "V60": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/V60",
-                        "@type": "@id"
-                    },
-                    "dvh_points": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_point",
-                        "@type": "@id"
-                    },
-                    "dvh_curve": {
-                        "@id": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_curve",
-                        "@type": "@id"
-                    },
-                    "d_point": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_d_point",
-                    "v_point": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/dvh_v_point",
-                    "Gray": "http://purl.obolibrary.org/obo/UO_0000134",
-                    "cc": "http://purl.obolibrary.org/obo/UO_0000097",
-                    "unit": "@type",
-                    "value": "https://schema.org/value",
-                    "has_color": "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/has_color"
-                },
-                "@type": "CalculationResult",
-                "@id": "http://data.local/ldcm-rt/" + str(uuid_for_calculation),
-                "PatientID": dosePackage.patientID,
-                "doseFraction": dosePackage.fgn,
-                "references": [dosePackage.rtDose, dosePackage.rtStruct],
-                "software": {
-                    "@id": "https://github.com/dicompyler/dicompyler-core",
-                    "version": dicompylercore.__version__
-                },
-                "dateCreated": datetime.datetime.now().isoformat(),
-                "containsStructureDose": [calculatedDose]
-            }
+            for dosePackage in job.rows:
+                self.__save_result(dosePackage, calculatedDose, sink)
 
-            filename = os.path.join(folder_to_store_results, f"{uuid_for_calculation}.jsonld")
-            logging.info("Saving in" + str(filename))
-            with open(filename, "w") as f:
-                json.dump(resultDict, f)
-                logging.info("Saving done")
+        try:
+            DvhScheduler(workers, max_memory, timeout, retries, job_processes=structure_workers).run(
+                jobs, functools.partial(calculate_dvh_job, structure_workers=structure_workers, metrics=metrics,
+                                        memmap_rtdose=memmap_rtdose, result_cache=result_cache),
+                save_results)
+        finally:
+            sink.close()
+
+    def __save_result(self, dosePackage, calculatedDose, sink):
+        """
+        Save the JSON-LD document of a dose package
+        :param dosePackage: query row
+        :param calculatedDose: list of structure results of get_dvh_for_structures
+        :param sink: DvhResultSink
+        :return:
+        """
+        logging.info(
+            f"Saving  {dosePackage.patientID} | {dosePackage.rtDosePath} | {dosePackage.rtStructPath} |"
+            f"{dosePackage.rtPlanPath} | {dosePackage.fgn}...")
+        uuid_for_calculation = _calculation_uuid(calculatedDose, dosePackage.patientID, dosePackage.fgn,
+                                                 dosePackage.rtDose, dosePackage.rtStruct)
+        resultDict = {
+            "@type": "CalculationResult",
+            "@id": "http://data.local/ldcm-rt/" + str(uuid_for_calculation),
+            "PatientID": dosePackage.patientID,
+            "doseFraction": dosePackage.fgn,
+            "references": [dosePackage.rtDose, dosePackage.rtStruct],
+            "software": {
+                "@id": "https://github.com/dicompyler/dicompyler-core",
+                "version": dicompylercore.__version__
+            },
+            "dateCreated": datetime.datetime.now().isoformat(),
+            "containsStructureDose": [calculatedDose]
+        }
+        sink.write(resultDict)
@@ -0,0 +1,96 @@
+import re
+
+import numpy as np
+
+# metrics calculated when no metric set is configured
+DEFAULT_METRICS = ("D10", "D20", "D30", "D40", "D50", "D60", "V5", "V10", "V20", "V30", "V40", "V50", "V60")
+
+METRIC_PATTERN = re.compile(r"^(D|V)(\d+(?:\.\d+)?)(gy|cc)?$", re.IGNORECASE)
+
+
+class MetricSet:
+    """
+    A set of dose (Dx, Dxcc) and volume (Vx, VxGy) metrics, calculated in one vectorized pass over a cumulative
+    DVH. The lookups follow dicompyler-core: the nearest dose bin or volume count is taken, Vx is the volume
+    receiving x percent of the prescription dose, VxGy the volume receiving x Gy, Dx the minimum dose to the
+    hottest x percent of the volume and Dxcc the minimum dose to the hottest x cc.
+    """
+
+    def __init__(self, names=DEFAULT_METRICS):
+        """
+        :param names: metric names, or a comma separated string of metric names
+        """
+        if isinstance(names, str):
+            names = [name.strip() for name in names.split(",") if name.strip()]
+        self.names = tuple(names)
+        kinds = []
+        thresholds = []
+        absolute = []
+        for name in self.names:
+            match = METRIC_PATTERN.match(name)
+            if match is None:
+                raise Exception(f"Invalid DVH metric {name}, expected for example D95, D2cc, V20 or V20Gy")
+            kinds.append(match.group(1).upper())
+            thresholds.append(float(match.group(2)))
+            absolute.append(match.group(3) is not None)
+        kinds = np.array(kinds)
+        thresholds = np.array(thresholds, dtype=float)
+        absolute = np.array(absolute, dtype=bool)
+        self.__dose = kinds == "D"
+        self.__volume = kinds == "V"
+        self.__thresholds = thresholds
+        self.__absolute = absolute
+
+    @staticmethod
+    def __nearest(values, targets):
+        """
+        :return: index of the first value nearest to each target
+        """
+        return np.argmin(np.fabs(values[:, np.newaxis] - targets[np.newaxis, :]), axis=0)
+
+    def calculate(self, counts, bins, rx_dose=None):
+        """
+        :param counts: counts of the cumulative DVH, absolute volume in cc
+        :param bins: dose bin edges in Gy, one more than counts
+        :param rx_dose: prescription dose in Gy, relative volume metrics are None without it
+        :return: dict of metric name -> float value or None
+        """
+        counts = np.asarray(counts, dtype=float)
+        bins = np.asarray(bins, dtype=float)
+        values = np.zeros(len(self.names))
+        available = np.ones(len(self.names), dtype=bool)
+
+        # volume metrics: the count at the dose bin nearest to the threshold
+        volume = self.__volume
+        if volume.any():
+            index = np.zeros(len(self.names), dtype=int)
+            absolute = volume & self.__absolute
+            index[absolute] = self.__nearest(bins, self.__thresholds[absolute])
+            relative = volume & ~self.__absolute
+            if rx_dose:
+                index[relative] = self.__nearest(100 * bins / rx_dose, self.__thresholds[relative])
+            else:
+                available[relative] = False
+            in_range = volume & (index < counts.size)
+            values[in_range] = counts[index[in_range]]
+
+        # dose metrics: the dose bin nearest to the volume threshold
+        dose = self.__dose
+        if dose.any() and counts.size > 0:
+            has_dose = counts.size > 1 and counts.max() > 0
+            relative_counts = 100 * counts / (counts.max() if has_dose else 1)
+            absolute = self.__absolute[dose]
+            thresholds = self.__thresholds[dose]
+            volume_counts = np.where(absolute[np.newaxis, :], counts[:, np.newaxis], relative_counts[:, np.newaxis])
+            differences = np.fabs(volume_counts - thresholds[np.newaxis, :])
+            index = np.argmin(differences, axis=0)
+            # D100 takes the last bin nearest to 100%, the dose to the whole volume
+            whole = ~absolute & (thresholds == 100)
+            if whole.any():
+                index[whole] = counts.size - 1 - np.argmin(differences[::-1, whole], axis=0)
+            doses = bins[index]
+            doses[thresholds > volume_counts.max(axis=0)] = 0.0
+            values[dose] = doses
+
+        return {name: (float(value) if is_available else None)
+                for name, value, is_available in zip(self.names, values, available)}
@@ -0,0 +1,202 @@
+import logging
+import os
+import struct
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pydicom
+from dicompylercore import dicomparser
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+# default maximum footprint of the cached objects
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# rough size of one contour point kept as a python list of three floats
+CONTOUR_POINT_BYTES = 3 * 24 + 8 + 56
+# size of the pixel data element header: tag and length, with the VR and 2 reserved bytes in explicit VR
+ELEMENT_HEADER_SIZE = {ImplicitVRLittleEndian: 8, ExplicitVRLittleEndian: 12}
+PIXEL_DATA_TAG_BYTES = struct.pack("<HH", 0x7FE0, 0x0010)
+
+
+class ParserCache:
+    """
+    Size bounded cache of parsed RT objects: DicomParser instances of RTSTRUCT, RTDOSE and RTPLAN files
+    and the structure coordinates extracted from a structure set. Entries are keyed by
+    the file path and its modification time, so a changed file is parsed again, and the least recently
+    used entries are evicted once the estimated memory footprint exceeds max_bytes.
+    The cached objects are shared, callers must not modify them.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param max_bytes: maximum estimated footprint of all cached objects in bytes
+        """
+        self.max_bytes = max_bytes
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def __file_key(kind, file_path, *args):
+        return (kind, os.path.abspath(file_path), os.stat(file_path).st_mtime_ns) + args
+
+    def __get(self, key, load, footprint):
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return self.__entries[key][0]
+        value = load()
+        size = footprint(value)
+        with self.__lock:
+            self.misses += 1
+            if key not in self.__entries:
+                self.__entries[key] = (value, size)
+                self.__bytes += size
+                self.__evict()
+        return value
+
+    def __evict(self):
+        # the most recent entry is always kept, even when it is larger than max_bytes on its own
+        while self.__bytes > self.max_bytes and len(self.__entries) > 1:
+            key, (value, size) = self.__entries.popitem(last=False)
+            self.__bytes -= size
+            logging.debug(f"Evicted {key[1]} from the parser cache")
+
+    def get_parser(self, file_path, memmap_pixel_array=False):
+        """
+        :param file_path: path of a DICOM file
+        :param memmap_pixel_array: memory map the pixel array instead of loading it
+        :return: dicomparser.DicomParser of the file
+        """
+        return self.__get(self.__file_key("parser", file_path, memmap_pixel_array),
+                          lambda: open_parser(file_path, memmap_pixel_array),
+                          lambda parser: parser_footprint(parser, os.path.getsize(file_path)))
+
+    def get_structures(self, file_path):
+        """
+        Extract the structures of a structure set once, with their planes and thickness.
+        :param file_path: path of the RTSTRUCT file
+        :return: see extract_structures
+        """
+        return self.__get(self.__file_key("structures", file_path),
+                          lambda: extract_structures(self.get_parser(file_path)),
+                          structures_footprint)
+
+    def footprint(self):
+        """
+        :return: estimated footprint of the cached objects in bytes
+        """
+        return self.__bytes
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+
+def pixel_data_offset(file_path, element_position, transfer_syntax, length):
+    """
+    :param file_path: path of a DICOM file
+    :param element_position: file position of the pixel data element
+    :param transfer_syntax: transfer syntax UID of the file
+    :param length: length of the pixel array in bytes
+    :return: file position of the pixel data value, None when the pixel data cannot be memory mapped as it is
+    """
+    header_size = ELEMENT_HEADER_SIZE.get(transfer_syntax)
+    if header_size is None or not length:
+        return None
+    with open(file_path, "rb") as file:
+        file.seek(element_position)
+        header = file.read(header_size)
+    if len(header) < header_size or header[:4] != PIXEL_DATA_TAG_BYTES:
+        return None
+    if struct.unpack("<I", header[-4:])[0] < length:
+        # undefined length of encapsulated pixel data, or less data than the grid
+        return None
+    return element_position + header_size
+
+
+def open_parser(file_path, memmap_pixel_array=False):
+    """
+    The pixel data offset is found here instead of by dicompyler-core, which assumes the 8 byte element header
+    of implicit VR also for explicit VR files. Pixel data which cannot be memory mapped as it is stored
+    (compressed, deflated or big endian) is loaded.
+    :param file_path: path of a DICOM file
+    :param memmap_pixel_array: memory map the pixel array instead of loading it
+    :return: dicomparser.DicomParser of the file
+    """
+    if not memmap_pixel_array:
+        return dicomparser.DicomParser(file_path)
+    with open(file_path, "rb") as file:
+        ds = pydicom.dcmread(file, defer_size=100, force=True, stop_before_pixels=True)
+        element_position = file.tell()
+    transfer_syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+    length = 0
+    if all(keyword in ds for keyword in ("Rows", "Columns", "BitsAllocated")):
+        length = int(getattr(ds, "NumberOfFrames", 1) or 1) * ds.Rows * ds.Columns * ds.BitsAllocated // 8
+    offset = pixel_data_offset(file_path, element_position, transfer_syntax, length)
+    if offset is None:
+        logging.debug(f"Pixel data of {file_path} ({transfer_syntax}) is loaded instead of memory mapped")
+        return dicomparser.DicomParser(file_path)
+    # the attributes DicomParser sets itself when it memory maps the pixel data
+    parser = dicomparser.DicomParser(ds)
+    parser.memmap_pixel_array = True
+    parser.filename = file_path
+    parser.offset = offset
+    parser.pixel_array = parser.get_pixel_array
+    return parser
+
+
+def extract_structures(rt_str):
+    """
+    :param rt_str: DicomParser of an RT Structure Set
+    :return: dict of ROI number -> structure dict with the keys of DicomParser.GetStructures, "planes" and
+    "thickness". Structures of which the coordinates cannot be read are left out with a warning.
+    """
+    result = {}
+    for roi, structure in rt_str.GetStructures().items():
+        try:
+            structure['planes'] = rt_str.GetStructureCoordinates(roi)
+            structure['thickness'] = rt_str.CalculatePlaneThickness(structure['planes'])
+        except Exception as except_t:
+            logging.warning(except_t)
+            logging.warning(f"Skipping structure {structure.get('name')}...")
+            continue
+        result[roi] = structure
+    return result
+
+
+def parser_footprint(parser, file_size):
+    """
+    :param parser: DicomParser
+    :param file_size: size of the parsed file in bytes
+    :return: estimated size in bytes, the header read from the file plus the loaded pixel array
+    """
+    if parser.memmap_pixel_array or "PixelData" not in parser.ds:
+        return file_size
+    size = file_size
+    pixel_array = getattr(parser, "pixel_array", None)
+    if isinstance(pixel_array, np.ndarray):
+        size += pixel_array.nbytes
+    return size
+
+
+def structures_footprint(structures):
+    """
+    :param structures: dict of structures as returned by ParserCache.get_structures
+    :return: estimated size in bytes of the contour points
+    """
+    points = 0
+    for structure in structures.values():
+        for plane in structure.get('planes', {}).values():
+            for contour in plane:
+                points += len(contour.get('data', []))
+    return points * CONTOUR_POINT_BYTES + sys.getsizeof(structures)
+
+
+# cache shared by the DVH calculation of a run
+parser_cache = ParserCache()
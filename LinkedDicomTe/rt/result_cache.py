@@ -0,0 +1,154 @@
+import datetime
+import hashlib
+import json
+import logging
+import sqlite3
+
+import dicompylercore
+import numpy as np
+import pydicom
+
+from LinkedDicomTe.rt.result_sink import DvhCurve
+
+# version of the stored results, changed when the structure results of get_dvh_for_structures change
+CACHE_FORMAT_VERSION = 1
+# seconds a process waits for the lock of another process writing to the cache
+CACHE_TIMEOUT = 60
+
+
+def read_sop_instance_uid(file_path):
+    """
+    :param file_path: path of a DICOM file
+    :return: SOPInstanceUID, read without parsing the rest of the file
+    """
+    ds = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=["SOPInstanceUID"], force=True)
+    return str(ds.SOPInstanceUID)
+
+
+class DvhResultCache:
+    """
+    Persistent cache of DVH results in a SQLite file, shared by the processes of a run. The result of every
+    structure is stored under a hash of the RTSTRUCT, RTDOSE and RTPLAN SOPInstanceUIDs, the ROI number, the
+    calculation parameters and the dicompyler-core version, and a package records the ROIs calculated for its
+    files. A package found in the cache is returned without reading the dose, and a package stopped halfway
+    only calculates the structures which are missing.
+    """
+
+    def __init__(self, cache_path):
+        """
+        :param cache_path: SQLite file, created when it does not exist
+        """
+        self.cache_path = cache_path
+        self.__connection = sqlite3.connect(cache_path, timeout=CACHE_TIMEOUT)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        with self.__connection:
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS structures (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    dose BLOB NOT NULL,
+                    volume BLOB NOT NULL,
+                    created TEXT NOT NULL
+                )
+            """)
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS packages (
+                    key TEXT PRIMARY KEY,
+                    rois TEXT NOT NULL,
+                    created TEXT NOT NULL
+                )
+            """)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def package_key(rt_struct_path, rt_dose_paths, rt_plan_path, parameters):
+        """
+        :param rt_struct_path: path of the RTSTRUCT
+        :param rt_dose_paths: paths of the RTDOSE files, summed when more than one
+        :param rt_plan_path: path of the RTPLAN, can be None
+        :param parameters: JSON serializable calculation parameters, for example the metric names
+        :return: hex digest identifying the calculation of the package
+        """
+        key = {
+            "format": CACHE_FORMAT_VERSION,
+            "dicompyler": dicompylercore.__version__,
+            "rtstruct": read_sop_instance_uid(rt_struct_path),
+            "rtdose": [read_sop_instance_uid(dose_path) for dose_path in rt_dose_paths],
+            "rtplan": read_sop_instance_uid(rt_plan_path) if rt_plan_path is not None else None,
+            "parameters": parameters,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def structure_key(package_key, roi):
+        """
+        :return: hex digest identifying the calculation of one ROI of a package
+        """
+        return hashlib.sha256(f"{package_key}/{roi}".encode()).hexdigest()
+
+    def get_package(self, package_key):
+        """
+        :param package_key: see package_key
+        :return: list of structure results in ROI order, None when the package or one of its structures is missing
+        """
+        row = self.__connection.execute("SELECT rois FROM packages WHERE key = ?", (package_key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        results = []
+        for roi in json.loads(row[0]):
+            result = self.get_structure(package_key, roi)
+            if result is None:
+                self.misses += 1
+                return None
+            results.append(result)
+        self.hits += 1
+        return results
+
+    def put_package(self, package_key, rois):
+        """
+        :param package_key: see package_key
+        :param rois: ROI numbers with a stored result, in order
+        :return:
+        """
+        with self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO packages (key, rois, created) VALUES (?, ?, ?)",
+                                      (package_key, json.dumps([int(roi) for roi in rois]),
+                                       datetime.datetime.now().isoformat()))
+
+    def get_structure(self, package_key, roi):
+        """
+        :return: structure result as returned by get_dvh_for_structures, None when it is not cached
+        """
+        row = self.__connection.execute("SELECT result, dose, volume FROM structures WHERE key = ?",
+                                        (self.structure_key(package_key, roi),)).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[0])
+        result["dvh_curve"]["dvh_points"] = DvhCurve(np.frombuffer(row[1], dtype=np.float64),
+                                                     np.frombuffer(row[2], dtype=np.float64))
+        return result
+
+    def put_structure(self, package_key, roi, result):
+        """
+        :param package_key: see package_key
+        :param roi: ROI number
+        :param result: structure result as returned by get_dvh_for_structures
+        :return:
+        """
+        curve = result["dvh_curve"]["dvh_points"]
+        stored = dict(result)
+        stored["dvh_curve"] = {key: value for key, value in result["dvh_curve"].items() if key != "dvh_points"}
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO structures (key, result, dose, volume, created) VALUES (?, ?, ?, ?, ?)",
+                (self.structure_key(package_key, roi), json.dumps(stored),
+                 np.ascontiguousarray(curve.dose, dtype=np.float64).tobytes(),
+                 np.ascontiguousarray(curve.volume, dtype=np.float64).tobytes(),
+                 datetime.datetime.now().isoformat()))
+
+    def close(self):
+        logging.debug(f"DVH result cache {self.cache_path}: {self.hits} hits, {self.misses} misses")
+        self.__connection.close()
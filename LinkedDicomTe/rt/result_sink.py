@@ -0,0 +1,488 @@
+import glob
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from json.encoder import encode_basestring
+
+import numpy as np
+
+from LinkedDicomTe.rt.metrics import METRIC_PATTERN
+
+LDCM_DVH = "https://johanvansoest.nl/ontologies/LinkedDicom-dvh/"
+
+# JSON-LD context of the DVH calculation results, terms of other metrics are added by context_with_metric_terms
+DVH_JSONLD_CONTEXT = {
+    "CalculationResult": LDCM_DVH + "CalculationResult",
+    "PatientID": LDCM_DVH + "PatientIdentifier",
+    "doseFraction": LDCM_DVH + "DoseFractionNumbers",
+    "references": {"@id": LDCM_DVH + "references", "@type": "@id"},
+    "software": {"@id": "https://schema.org/SoftwareApplication", "@type": "@id"},
+    "version": "https://schema.org/version",
+    "dateCreated": "https://schema.org/dateCreated",
+    "containsStructureDose": {"@id": LDCM_DVH + "containsStructureDose", "@type": "@id"},
+    "structureName": LDCM_DVH + "structureName",
+    "min": {"@id": LDCM_DVH + "min", "@type": "@id"},
+    "mean": {"@id": LDCM_DVH + "mean", "@type": "@id"},
+    "max": {"@id": LDCM_DVH + "max", "@type": "@id"},
+    "volume": {"@id": LDCM_DVH + "volume", "@type": "@id"},
+    "D10": {"@id": LDCM_DVH + "D10", "@type": "@id"},
+    "D20": {"@id": LDCM_DVH + "D20", "@type": "@id"},
+    "D30": {"@id": LDCM_DVH + "D30", "@type": "@id"},
+    "D40": {"@id": LDCM_DVH + "D40", "@type": "@id"},
+    "D50": {"@id": LDCM_DVH + "D50", "@type": "@id"},
+    "D60": {"@id": LDCM_DVH + "D60", "@type": "@id"},
+    "V5": {"@id": LDCM_DVH + "V5", "@type": "@id"},
+    "V10": {"@id": LDCM_DVH + "V10", "@type": "@id"},
+    "V20": {"@id": LDCM_DVH + "V20", "@type": "@id"},
+    "V30": {"@id": LDCM_DVH + "V30", "@type": "@id"},
+    "V40": {"@id": LDCM_DVH + "V40", "@type": "@id"},
+    "V50": {"@id": LDCM_DVH + "V50", "@type": "@id"},
+    "V60": {"@id": LDCM_DVH + "V60", "@type": "@id"},
+    "dvh_points": {"@id": LDCM_DVH + "dvh_point", "@type": "@id"},
+    "dvh_curve": {"@id": LDCM_DVH + "dvh_curve", "@type": "@id"},
+    "d_point": LDCM_DVH + "dvh_d_point",
+    "v_point": LDCM_DVH + "dvh_v_point",
+    "Gray": "http://purl.obolibrary.org/obo/UO_0000134",
+    "cc": "http://purl.obolibrary.org/obo/UO_0000097",
+    "unit": "@type",
+    "value": "https://schema.org/value",
+    "has_color": LDCM_DVH + "has_color",
+    "color": LDCM_DVH + "has_color"
+}
+# file the context is written to, once per output folder
+CONTEXT_FILE_NAME = "dvh_context.jsonld"
+# number of curve points formatted per chunk written
+CURVE_CHUNK_POINTS = 4096
+
+# DVH curve of a structure as two arrays, serialized as a list of {"d_point", "v_point"} objects
+DvhCurve = namedtuple("DvhCurve", ["dose", "volume"])
+
+OUTPUT_FORMATS = ("jsonld", "parquet", "arrow", "npz")
+# file names of the columnar stores in the output folder
+RESULT_FILE_NAMES = {"parquet": "dvh_results.parquet", "arrow": "dvh_results.arrow", "npz": "dvh_results"}
+# number of structure rows collected before they are appended to a columnar store
+DEFAULT_BUFFER_ROWS = 1024
+# schema metadata key of the JSON-LD context
+CONTEXT_METADATA_KEY = b"jsonld_context"
+
+CALCULATION_COLUMNS = ["calculation_id", "patient_id", "dose_fraction", "references", "date_created",
+                       "software_version"]
+STRUCTURE_COLUMNS = ["structure_id", "structure_name", "color", "min", "mean", "max", "volume"]
+CURVE_COLUMNS = ["dvh_dose", "dvh_volume"]
+
+
+class DvhResultSink(ABC):
+    """
+    Destination of the DVH calculation results. A result is the JSON-LD document of one calculation,
+    with a structure result per structure in "containsStructureDose".
+    """
+
+    def __init__(self, folder_to_store_results):
+        self.folder_to_store_results = folder_to_store_results
+
+    @abstractmethod
+    def write(self, resultDict):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonLdSink(DvhResultSink):
+    """
+    Write every calculation to its own .jsonld file. The documents refer to the context by URL: the given
+    context_url, or the context file written once in the output folder. The documents are streamed with
+    write_jsonld, the curves are not converted to lists of dicts first.
+    """
+
+    def __init__(self, folder_to_store_results, context_url=None, context=DVH_JSONLD_CONTEXT):
+        super().__init__(folder_to_store_results)
+        self.context_url = context_url
+        self.context = context
+        self.context_written = False
+
+    def write_context(self):
+        filename = os.path.join(self.folder_to_store_results, CONTEXT_FILE_NAME)
+        with open(filename, "w") as f:
+            json.dump({"@context": self.context}, f, indent=2)
+        self.context_written = True
+
+    def write(self, resultDict):
+        if self.context_url is None:
+            context = context_with_metric_terms(self.context, resultDict["containsStructureDose"][0])
+            if context is not self.context or not self.context_written:
+                self.context = context
+                self.write_context()
+            document = {"@context": CONTEXT_FILE_NAME}
+        else:
+            # metrics not defined in the shared context get their terms in the document
+            context = context_with_metric_terms(self.context, resultDict["containsStructureDose"][0])
+            extra_terms = {key: value for key, value in context.items() if key not in self.context}
+            document = {"@context": [self.context_url, extra_terms] if extra_terms else self.context_url}
+        document.update(resultDict)
+        uuid_for_calculation = resultDict["@id"].rsplit("/", 1)[-1]
+        filename = os.path.join(self.folder_to_store_results, f"{uuid_for_calculation}.jsonld")
+        logging.info("Saving in" + str(filename))
+        with open(filename, "w") as f:
+            write_jsonld(document, f)
+            logging.info("Saving done")
+
+
+class ColumnarSink(DvhResultSink):
+    """
+    Collect the results of a run in one columnar store with a row per structure: the calculation metadata,
+    the structure statistics, a column per DVH metric and the curve as two array columns. Rows are appended
+    in batches of buffer_rows while the calculations finish. The JSON-LD context is stored once with the
+    data, so the JSON-LD documents can be exported again with export_jsonld.
+    The store of an earlier run in the same folder is only replaced with overwrite, it is not appended to.
+    """
+
+    def __init__(self, folder_to_store_results, buffer_rows=DEFAULT_BUFFER_ROWS, overwrite=False):
+        super().__init__(folder_to_store_results)
+        self.buffer_rows = buffer_rows
+        self.overwrite = overwrite
+        self.context = None
+        self.metric_names = None
+        self.rows = []
+
+    def remove_earlier_results(self, file_paths):
+        """
+        :param file_paths: files of the store of an earlier run, removed when overwrite is set
+        :return:
+        """
+        if not file_paths:
+            return
+        if not self.overwrite:
+            raise Exception(f"DVH results of an earlier run found in {self.folder_to_store_results} "
+                            f"({', '.join(os.path.basename(path) for path in sorted(file_paths))}), "
+                            f"remove them or run with --overwrite")
+        logging.warning(f"Overwriting the DVH results of an earlier run in {self.folder_to_store_results}")
+        for file_path in file_paths:
+            os.remove(file_path)
+
+    def write(self, resultDict):
+        if self.context is None:
+            self.context = context_with_metric_terms(DVH_JSONLD_CONTEXT, resultDict["containsStructureDose"][0])
+        for structure in resultDict["containsStructureDose"][0]:
+            if self.metric_names is None:
+                self.metric_names = [key for key in structure if METRIC_PATTERN.match(key)]
+            self.rows.append(flatten_structure(resultDict, structure, self.metric_names))
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.append(self.rows)
+            self.rows = []
+
+    @abstractmethod
+    def append(self, rows):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class ArrowSink(ColumnarSink):
+    """
+    Append the rows to a Parquet file (one row group per batch) or an Arrow IPC file, needs pyarrow
+    """
+
+    def __init__(self, folder_to_store_results, output_format="parquet", buffer_rows=DEFAULT_BUFFER_ROWS,
+                 overwrite=False):
+        super().__init__(folder_to_store_results, buffer_rows, overwrite)
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception(f"Output format {output_format} is not available, install pyarrow")
+        self.pyarrow = pyarrow
+        self.output_format = output_format
+        self.file_path = os.path.join(folder_to_store_results, RESULT_FILE_NAMES[output_format])
+        self.remove_earlier_results([self.file_path] if os.path.exists(self.file_path) else [])
+        self.writer = None
+        self.schema = None
+
+    def append(self, rows):
+        pyarrow = self.pyarrow
+        if self.schema is None:
+            string_list = pyarrow.list_(pyarrow.string())
+            fields = [pyarrow.field(name, string_list if name == "references" else pyarrow.string())
+                      for name in CALCULATION_COLUMNS + STRUCTURE_COLUMNS[:3]]
+            fields += [pyarrow.field(name, pyarrow.float64()) for name in STRUCTURE_COLUMNS[3:] + self.metric_names]
+            fields += [pyarrow.field(name, pyarrow.list_(pyarrow.float64())) for name in CURVE_COLUMNS]
+            self.schema = pyarrow.schema(fields, metadata={CONTEXT_METADATA_KEY: json.dumps(self.context)})
+            if self.output_format == "parquet":
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(self.file_path, self.schema, compression="zstd")
+            else:
+                import pyarrow.ipc
+                self.writer = pyarrow.ipc.new_file(self.file_path, self.schema)
+        columns = {name: [row[name] for row in rows] for name in self.schema.names}
+        self.writer.write_table(pyarrow.table(columns, schema=self.schema))
+        logging.info(f"Appended {len(rows)} structures to {self.file_path}")
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class NpzSink(ColumnarSink):
+    """
+    Write every batch of rows to a compressed .npz part, without extra dependencies. The curves are
+    stored ragged: all points concatenated, with the offset of the curve of every row.
+    The parts are numbered from 0 in every run, read_dvh_results reads all parts in the folder.
+    """
+
+    def __init__(self, folder_to_store_results, buffer_rows=DEFAULT_BUFFER_ROWS, overwrite=False):
+        super().__init__(folder_to_store_results, buffer_rows, overwrite)
+        self.remove_earlier_results(glob.glob(os.path.join(folder_to_store_results,
+                                                           f"{RESULT_FILE_NAMES['npz']}-*.npz")))
+        self.part = 0
+
+    def append(self, rows):
+        arrays = {"jsonld_context": np.array(json.dumps(self.context))}
+        for name in CALCULATION_COLUMNS + STRUCTURE_COLUMNS[:3]:
+            values = [json.dumps(row[name]) if name == "references" else row[name] for row in rows]
+            arrays[name] = np.array(values, dtype=str)
+        for name in STRUCTURE_COLUMNS[3:] + self.metric_names:
+            arrays[name] = np.array([np.nan if row[name] is None else row[name] for row in rows], dtype=float)
+        for name in CURVE_COLUMNS:
+            curves = [np.asarray(row[name], dtype=float) for row in rows]
+            arrays[name] = np.concatenate(curves) if curves else np.zeros(0)
+            arrays[name + "_offsets"] = np.concatenate([[0], np.cumsum([curve.size for curve in curves])])
+        file_path = os.path.join(self.folder_to_store_results,
+                                 f"{RESULT_FILE_NAMES['npz']}-{self.part:05d}.npz")
+        np.savez_compressed(file_path, **arrays)
+        self.part += 1
+        logging.info(f"Saved {len(rows)} structures in {file_path}")
+
+
+def context_with_metric_terms(context, calculatedDose):
+    """
+    :param context: JSON-LD context dict
+    :param calculatedDose: list of structure results of get_dvh_for_structures
+    :return: the context, with a term added for every metric in the results which is not defined yet
+    """
+    for structure in calculatedDose:
+        for key in structure:
+            if key not in context and METRIC_PATTERN.match(key):
+                context = dict(context)
+                context[key] = {"@id": LDCM_DVH + key, "@type": "@id"}
+    return context
+
+
+def _float_json(value):
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "Infinity" if value > 0 else "-Infinity"
+    return float.__repr__(value)
+
+
+def _float_view(array):
+    """
+    :return: memoryview over the array as doubles, iterating it gives python floats without a list copy
+    """
+    return memoryview(np.ascontiguousarray(array, dtype=np.float64)).cast("B").cast("d")
+
+
+def iter_jsonld(value):
+    """
+    Serialize a result document in chunks, formatted like json.dump with the default separators.
+    DvhCurve values are written as their list of points, numpy arrays and scalars are written directly.
+    :param value:
+    :return: generator of strings
+    """
+    if isinstance(value, DvhCurve):
+        dose = _float_view(value.dose)
+        volume = _float_view(value.volume)
+        yield "["
+        for start in range(0, len(dose), CURVE_CHUNK_POINTS):
+            end = start + CURVE_CHUNK_POINTS
+            chunk = ", ".join('{"d_point": %s, "v_point": %s}' % (_float_json(d_point), _float_json(v_point))
+                              for d_point, v_point in zip(dose[start:end], volume[start:end]))
+            yield (", " if start else "") + chunk
+        yield "]"
+    elif isinstance(value, dict):
+        yield "{"
+        first = True
+        for key, item in value.items():
+            yield ("" if first else ", ") + encode_basestring(str(key)) + ": "
+            yield from iter_jsonld(item)
+            first = False
+        yield "}"
+    elif isinstance(value, (list, tuple)):
+        yield "["
+        first = True
+        for item in value:
+            if not first:
+                yield ", "
+            yield from iter_jsonld(item)
+            first = False
+        yield "]"
+    elif isinstance(value, np.ndarray):
+        yield "[" + ", ".join(_float_json(item) for item in _float_view(value)) + "]"
+    elif isinstance(value, (float, np.floating)):
+        yield _float_json(float(value))
+    elif isinstance(value, np.integer):
+        yield str(int(value))
+    elif isinstance(value, str):
+        yield encode_basestring(str(value))
+    else:
+        yield json.dumps(value)
+
+
+def write_jsonld(document, file):
+    """
+    Stream a result document to an open text file
+    :param document:
+    :param file:
+    :return:
+    """
+    file.writelines(iter_jsonld(document))
+
+
+def flatten_structure(resultDict, structure, metric_names):
+    """
+    :param resultDict: JSON-LD document of a calculation
+    :param structure: structure result of get_dvh_for_structures
+    :param metric_names: names of the metric columns
+    :return: dict with a value for every column
+    """
+    curve = structure["dvh_curve"]["dvh_points"]
+    row = {
+        "calculation_id": resultDict["@id"],
+        "patient_id": str(resultDict.get("PatientID")),
+        "dose_fraction": str(resultDict.get("doseFraction")),
+        "references": [str(reference) for reference in resultDict.get("references", [])],
+        "date_created": resultDict.get("dateCreated"),
+        "software_version": resultDict.get("software", {}).get("version"),
+        "structure_id": structure["@id"],
+        "structure_name": structure["structureName"],
+        "color": structure.get("color", ""),
+        "dvh_dose": np.asarray(curve.dose, dtype=float),
+        "dvh_volume": np.asarray(curve.volume, dtype=float),
+    }
+    for name in STRUCTURE_COLUMNS[3:] + metric_names:
+        value = structure.get(name, {}).get("value")
+        row[name] = None if value is None else float(value)
+    return row
+
+
+def open_result_sink(folder_to_store_results, output_format="jsonld", context_url=None, overwrite=False):
+    """
+    :param folder_to_store_results:
+    :param output_format: one of OUTPUT_FORMATS
+    :param context_url: URL of the JSON-LD context referred to by the .jsonld documents, the context is written
+    in folder_to_store_results when not given
+    :param overwrite: replace the columnar store of an earlier run in the folder, see ColumnarSink
+    :return: DvhResultSink
+    """
+    if output_format == "jsonld":
+        return JsonLdSink(folder_to_store_results, context_url)
+    if output_format in ("parquet", "arrow"):
+        return ArrowSink(folder_to_store_results, output_format, overwrite=overwrite)
+    if output_format == "npz":
+        return NpzSink(folder_to_store_results, overwrite=overwrite)
+    raise Exception(f"Unknown output format {output_format}, expected one of {', '.join(OUTPUT_FORMATS)}")
+
+
+def read_dvh_results(results_path):
+    """
+    Read a columnar store written by a ColumnarSink
+    :param results_path: .parquet or .arrow file, or the folder or name prefix of .npz parts
+    :return: tuple of a pandas DataFrame with a row per structure and the JSON-LD context
+    """
+    import pandas as pd
+    if results_path.endswith(".parquet") or results_path.endswith(".arrow"):
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("Reading parquet or arrow results needs pyarrow")
+        if results_path.endswith(".parquet"):
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(results_path)
+        else:
+            import pyarrow.ipc
+            with pyarrow.memory_map(results_path) as source:
+                table = pyarrow.ipc.open_file(source).read_all()
+        context = json.loads(table.schema.metadata[CONTEXT_METADATA_KEY])
+        return table.to_pandas(), context
+
+    if os.path.isdir(results_path):
+        results_path = os.path.join(results_path, RESULT_FILE_NAMES["npz"])
+    frames = []
+    context = {}
+    for part_path in sorted(glob.glob(results_path + "-*.npz")):
+        with np.load(part_path) as part:
+            context = json.loads(str(part["jsonld_context"]))
+            columns = {}
+            for name in part.files:
+                if name == "jsonld_context" or name.endswith("_offsets") or name in CURVE_COLUMNS:
+                    continue
+                columns[name] = part[name]
+            columns["references"] = [json.loads(references) for references in columns["references"]]
+            for name in CURVE_COLUMNS:
+                offsets = part[name + "_offsets"]
+                columns[name] = np.split(part[name], offsets[1:-1])
+            frame = pd.DataFrame(columns)
+            for name in frame.columns:
+                if name not in CALCULATION_COLUMNS + STRUCTURE_COLUMNS[:3] + CURVE_COLUMNS:
+                    frame[name] = frame[name].where(frame[name].notna(), None)
+            frames.append(frame)
+    if not frames:
+        raise Exception(f"No DVH results found at {results_path}")
+    return pd.concat(frames, ignore_index=True), context
+
+
+def export_jsonld(results_path, folder_to_store_results, context_url=None):
+    """
+    Write the JSON-LD document of every calculation in a columnar store
+    :param results_path: see read_dvh_results
+    :param folder_to_store_results:
+    :param context_url: see JsonLdSink
+    :return: number of documents written
+    """
+    frame, context = read_dvh_results(results_path)
+    metric_names = [name for name in frame.columns if METRIC_PATTERN.match(name)]
+    sink = JsonLdSink(folder_to_store_results, context_url, context)
+    count = 0
+    for calculation_id, rows in frame.groupby("calculation_id", sort=False):
+        first = rows.iloc[0]
+        calculatedDose = []
+        for row in rows.itertuples(index=False):
+            row = row._asdict()
+            structure_id = row["structure_id"]
+            structOut = {"@id": structure_id, "structureName": row["structure_name"]}
+            for name in STRUCTURE_COLUMNS[3:] + metric_names:
+                unit = "cc" if name == "volume" or name[0].upper() == "V" else "Gray"
+                value = row[name]
+                if value is not None and name == "volume":
+                    value = int(value)
+                structOut[name] = {"@id": f"{structure_id}/{name}", "unit": unit,
+                                   "value": None if value is None or value != value else value}
+            structOut["color"] = row["color"]
+            structOut["dvh_curve"] = {
+                "@id": f"{structure_id}/dvh_curve",
+                "dvh_points": DvhCurve(row["dvh_dose"], row["dvh_volume"])
+            }
+            calculatedDose.append(structOut)
+        sink.write({
+            "@type": "CalculationResult",
+            "@id": calculation_id,
+            "PatientID": first["patient_id"],
+            "doseFraction": first["dose_fraction"],
+            "references": list(first["references"]),
+            "software": {
+                "@id": "https://github.com/dicompyler/dicompyler-core",
+                "version": first["software_version"]
+            },
+            "dateCreated": first["date_created"],
+            "containsStructureDose": [calculatedDose]
+        })
+        count += 1
+    return count
@@ -0,0 +1,220 @@
+import logging
+import multiprocessing
+import os
+import time
+from collections import OrderedDict, deque, namedtuple
+from multiprocessing.connection import wait
+
+from LinkedDicomTe.util import parse_memory_size
+
+# A dose package to calculate: the rows are the SPARQL or CSV rows which share the same files
+DvhJob = namedtuple("DvhJob", ["rt_struct_path", "rt_dose_paths", "rt_plan_path", "rows"])
+
+# rough memory needed per job: the interpreter, plus factors of the file sizes for the parsed
+# dose grid (pixel array and summation buffers) and the structure coordinates
+JOB_BASE_MEMORY = 100 * 1024 * 1024
+DOSE_MEMORY_FACTOR = 4
+STRUCT_MEMORY_FACTOR = 4
+
+
+def group_jobs(rows, job_key):
+    """
+    Group the rows which refer to the same files in one job, so they are calculated only once.
+    :param rows: iterable of rows
+    :param job_key: function of a row returning (rt_struct_path, tuple of rt_dose_paths, rt_plan_path)
+    :return: list of DvhJob, in the order of the first row of each job
+    """
+    jobs = OrderedDict()
+    for row in rows:
+        key = job_key(row)
+        if key not in jobs:
+            jobs[key] = DvhJob(key[0], key[1], key[2], [])
+        jobs[key].rows.append(row)
+    return list(jobs.values())
+
+
+def stream_jobs(rows, job_key):
+    """
+    Group consecutive rows which refer to the same files in one job, yielding every job as soon as its last
+    row is read. For rows ordered by the job key this gives the jobs of group_jobs without reading all rows
+    first, a key which comes back later gives another job.
+    :param rows: iterable of rows
+    :param job_key: function of a row returning (rt_struct_path, tuple of rt_dose_paths, rt_plan_path)
+    :return: generator of DvhJob
+    """
+    job = None
+    for row in rows:
+        key = job_key(row)
+        if job is None or (job.rt_struct_path, job.rt_dose_paths, job.rt_plan_path) != key:
+            if job is not None:
+                yield job
+            job = DvhJob(key[0], key[1], key[2], [])
+        job.rows.append(row)
+    if job is not None:
+        yield job
+
+
+def estimate_job_memory(job, job_processes=1):
+    """
+    :param job: DvhJob
+    :param job_processes: number of processes calculating the job, every process is counted as a full copy
+    :return: estimated peak memory of the job in bytes
+    """
+    estimate = JOB_BASE_MEMORY
+    for dose_path in job.rt_dose_paths:
+        if os.path.exists(dose_path):
+            estimate += os.path.getsize(dose_path) * DOSE_MEMORY_FACTOR
+    if os.path.exists(job.rt_struct_path):
+        estimate += os.path.getsize(job.rt_struct_path) * STRUCT_MEMORY_FACTOR
+    return estimate * max(1, job_processes)
+
+
+def _run_job(calculate, job, connection):
+    try:
+        connection.send((True, calculate(job)))
+    except Exception as except_t:
+        connection.send((False, f"{type(except_t).__name__}: {except_t}"))
+    finally:
+        connection.close()
+
+
+class DvhScheduler:
+    """
+    Run DVH jobs concurrently, every job in its own process so a job exceeding its timeout can be
+    stopped. Jobs are only started while the estimated memory of the running jobs stays below
+    max_memory, failed or timed out jobs are retried, and results are handed to a callback in the
+    main process as soon as a job finishes. Every job sends its result over its own pipe, so stopping a
+    job cannot corrupt the results of the others.
+    """
+
+    def __init__(self, workers=1, max_memory=None, timeout=None, retries=1, poll_interval=0.5, job_processes=1):
+        """
+        :param workers: maximum number of jobs running at the same time
+        :param max_memory: memory budget in bytes (or a string like "8G") for the running jobs, None for no limit
+        :param timeout: seconds after which a job is stopped, None for no timeout
+        :param retries: number of times a failed job is tried again
+        :param poll_interval: seconds between checks of the running jobs
+        :param job_processes: number of processes a job runs, e.g. the structure workers, for the memory estimate
+        """
+        self.workers = max(1, workers)
+        self.max_memory = parse_memory_size(max_memory)
+        self.timeout = timeout
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.job_processes = max(1, job_processes)
+        self.finished = 0
+        self.failed = 0
+
+    def run(self, jobs, calculate, on_result, on_failure=None):
+        """
+        :param jobs: iterable of DvhJob, read while the jobs run, so jobs can start before all jobs are known
+        :param calculate: picklable function of a DvhJob returning its result, run in the worker
+        :param on_result: function(job, result) called in the main process when a job is done
+        :param on_failure: function(job, error message) called when a job failed its last attempt
+        :return:
+        """
+        self.finished = 0
+        self.failed = 0
+        if self.workers == 1 and self.timeout is None:
+            self.__run_inline(jobs, calculate, on_result, on_failure)
+        else:
+            self.__run_processes(jobs, calculate, on_result, on_failure)
+        logging.info(f"DVH jobs done: {self.finished} finished, {self.failed} failed")
+
+    def __run_inline(self, jobs, calculate, on_result, on_failure):
+        for job in jobs:
+            for attempt in range(self.retries + 1):
+                try:
+                    result = calculate(job)
+                except Exception as except_t:
+                    error = f"{type(except_t).__name__}: {except_t}"
+                    logging.warning(f"DVH job {job.rt_struct_path} failed (attempt {attempt + 1}): {error}")
+                    continue
+                self.finished += 1
+                on_result(job, result)
+                break
+            else:
+                self.__fail(job, error, on_failure)
+
+    def __fail(self, job, error, on_failure):
+        self.failed += 1
+        logging.warning(f"Skipping DVH job {job.rt_struct_path} | {job.rt_dose_paths}: {error}")
+        if on_failure is not None:
+            on_failure(job, error)
+
+    def __run_processes(self, jobs, calculate, on_result, on_failure):
+        source = iter(jobs)
+        # jobs read from the source so far, indexed by job index
+        jobs = []
+        estimates = []
+        pending = deque()
+        # job index -> (process, connection the result is received on, attempt, start time)
+        running = {}
+
+        def has_pending():
+            # the next job is only read from the source when it can be started
+            if not pending:
+                job = next(source, None)
+                if job is not None:
+                    jobs.append(job)
+                    estimates.append(estimate_job_memory(job, self.job_processes))
+                    pending.append((len(jobs) - 1, 0))
+            return len(pending) > 0
+
+        def retry_or_fail(index, attempt, error):
+            logging.warning(f"DVH job {jobs[index].rt_struct_path} failed (attempt {attempt + 1}): {error}")
+            if attempt < self.retries:
+                pending.append((index, attempt + 1))
+            else:
+                self.__fail(jobs[index], error, on_failure)
+
+        def handle_result(index):
+            process, connection, attempt, start = running.pop(index)
+            try:
+                ok, value = connection.recv()
+            except EOFError:
+                # exited without a result, for example killed because it ran out of memory
+                process.join()
+                retry_or_fail(index, attempt, f"worker exited with code {process.exitcode}")
+                return
+            finally:
+                connection.close()
+            process.join()
+            if ok:
+                self.finished += 1
+                on_result(jobs[index], value)
+            else:
+                retry_or_fail(index, attempt, value)
+
+        while has_pending() or running:
+            # start jobs while there is a free worker and the memory budget allows it,
+            # a job is always started when nothing else is running
+            while len(running) < self.workers and has_pending():
+                index, attempt = pending[0]
+                used = sum(estimates[i] for i in running)
+                if running and self.max_memory is not None and used + estimates[index] > self.max_memory:
+                    break
+                pending.popleft()
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                # the rows stay in the main process, the worker only needs the files
+                process = multiprocessing.Process(target=_run_job,
+                                                  args=(calculate, jobs[index]._replace(rows=[]), sender))
+                process.start()
+                # the pipe is at its end once the worker closes it, also when the worker is killed
+                sender.close()
+                running[index] = (process, receiver, attempt, time.monotonic())
+
+            connections = {running[index][1]: index for index in running}
+            for connection in wait(list(connections), timeout=self.poll_interval):
+                handle_result(connections[connection])
+
+            if self.timeout is None:
+                continue
+            now = time.monotonic()
+            for index, (process, connection, attempt, start) in list(running.items()):
+                if now - start > self.timeout:
+                    process.terminate()
+                    process.join()
+                    connection.close()
+                    del running[index]
+                    retry_or_fail(index, attempt, f"timeout after {self.timeout} s")
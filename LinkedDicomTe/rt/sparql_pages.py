@@ -0,0 +1,136 @@
+import io
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rdflib.query import Result
+
+from LinkedDicomTe.util import new_http_session
+
+# rows per page of a paged query
+DEFAULT_PAGE_SIZE = 1000
+# seconds to wait for a page from a SPARQL endpoint
+PAGE_TIMEOUT = 300
+
+SELECT_PATTERN = re.compile(r"\bSELECT\s+(?:DISTINCT\s+|REDUCED\s+)?(.*?)\s*(?:\bWHERE\b|\{)",
+                            re.IGNORECASE | re.DOTALL)
+ALIAS_PATTERN = re.compile(r"\bAS\s+\?(\w+)", re.IGNORECASE)
+VARIABLE_PATTERN = re.compile(r"[?$](\w+)")
+SOLUTION_MODIFIER_PATTERN = re.compile(r"\b(ORDER\s+BY|LIMIT|OFFSET)\b", re.IGNORECASE)
+
+
+def projected_variables(query):
+    """
+    :param query: SPARQL SELECT query
+    :return: names of the variables selected by the query, in order
+    """
+    match = SELECT_PATTERN.search(query)
+    if match is None:
+        raise Exception("Only SELECT queries can be paged")
+    projection = match.group(1)
+    # (expression AS ?alias) selects the alias only
+    aliases = ALIAS_PATTERN.findall(projection)
+    projection = re.sub(r"\(.*?\)", " ", projection, flags=re.DOTALL)
+    variables = VARIABLE_PATTERN.findall(projection) + aliases
+    if not variables:
+        raise Exception("A paged query has to select its variables by name, not with SELECT *")
+    return variables
+
+
+def paged_query(query, page_size, offset, order_by=()):
+    """
+    :param query: SPARQL SELECT query without ORDER BY, LIMIT or OFFSET
+    :param page_size: rows per page
+    :param offset: index of the first row of the page
+    :param order_by: variables to order by first, the other selected variables follow to give a stable order
+    :return: query of one page
+    """
+    if SOLUTION_MODIFIER_PATTERN.search(query[query.rfind("}"):]):
+        raise Exception("A paged query cannot have its own ORDER BY, LIMIT or OFFSET")
+    variables = projected_variables(query)
+    order = [variable for variable in order_by if variable in variables]
+    order += [variable for variable in variables if variable not in order]
+    return (f"{query.rstrip()}\nORDER BY {' '.join('?' + variable for variable in order)}\n"
+            f"LIMIT {page_size}\nOFFSET {offset}")
+
+
+class SparqlPager:
+    """
+    Run a SELECT query page by page with LIMIT and OFFSET, ordered on all selected variables, and yield the rows
+    while the next pages are fetched. Pages of a SPARQL endpoint are fetched by a bounded number of threads
+    over one keep-alive session, pages of a local graph are queried one after the other.
+    """
+
+    def __init__(self, query, endpoint=None, graph_service=None, page_size=DEFAULT_PAGE_SIZE, workers=4,
+                 order_by=(), timeout=PAGE_TIMEOUT, session=None):
+        """
+        :param query: SPARQL SELECT query without ORDER BY, LIMIT or OFFSET
+        :param endpoint: URL of the SPARQL endpoint, None to query graph_service
+        :param graph_service: GraphService to query when there is no endpoint
+        :param page_size: rows per page
+        :param workers: number of pages fetched at the same time from an endpoint
+        :param order_by: variables to order by first, rows with the same values for them come one after the other
+        :param timeout: seconds to wait for a page from an endpoint
+        :param session: requests Session for the endpoint, a pooled session is created when None
+        """
+        if endpoint is None and graph_service is None:
+            raise Exception("A SPARQL endpoint or graph is needed to page a query")
+        self.query = query
+        self.endpoint = endpoint
+        self.graph_service = graph_service
+        self.page_size = page_size
+        self.workers = max(1, workers) if endpoint is not None else 1
+        self.order_by = tuple(order_by)
+        self.timeout = timeout
+        self.session = session
+        if endpoint is not None and session is None:
+            self.session = new_http_session(self.workers)
+        self.pages = 0
+        self.row_count = 0
+
+    def fetch_page(self, page):
+        """
+        :param page: page index
+        :return: list of the result rows of the page
+        """
+        start = time.monotonic()
+        query = paged_query(self.query, self.page_size, page * self.page_size, self.order_by)
+        if self.endpoint is None:
+            rows = list(self.graph_service.runSparqlQuery(query))
+        else:
+            response = self.session.post(self.endpoint, data={"query": query},
+                                         headers={"Accept": "application/sparql-results+json"},
+                                         timeout=self.timeout)
+            if not 200 <= response.status_code < 300:
+                raise Exception(f"Query of page {page} failed with status {response.status_code}: "
+                                f"{response.text[:200]}")
+            rows = list(Result.parse(io.BytesIO(response.content), format="json"))
+        logging.info(f"Fetched page {page}: {len(rows)} rows in {time.monotonic() - start:.1f} s")
+        return rows
+
+    def rows(self):
+        """
+        :return: generator of the result rows, in order
+        """
+        self.pages = 0
+        self.row_count = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # the next pages are fetched while the rows of the current page are used
+            futures = {page: executor.submit(self.fetch_page, page) for page in range(self.workers)}
+            page = 0
+            try:
+                while True:
+                    rows = futures.pop(page).result()
+                    self.pages += 1
+                    self.row_count += len(rows)
+                    if len(rows) == self.page_size:
+                        futures[page + self.workers] = executor.submit(self.fetch_page, page + self.workers)
+                    yield from rows
+                    if len(rows) < self.page_size:
+                        break
+                    page += 1
+            finally:
+                for future in futures.values():
+                    future.cancel()
+        logging.info(f"Query done: {self.row_count} rows in {self.pages} pages")
@@ -1,6 +1,41 @@
 import os
+import re
 
 import requests
+from requests.adapters import HTTPAdapter
+
+# connections kept open per host by a pooled session
+HTTP_POOL_SIZE = 4
+
+# memory sizes like 512M or 8GB, see parse_memory_size
+MEMORY_SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.IGNORECASE)
+MEMORY_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def new_http_session(pool_size=HTTP_POOL_SIZE):
+    """
+    Create a session which keeps its connections alive, to reuse them for the requests to the same host
+    :param pool_size: maximum number of connections kept open per host
+    :return: requests Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def parse_memory_size(size):
+    """
+    :param size: number of bytes, or a string like "512M" or "8GB"
+    :return: number of bytes, None when size is None
+    """
+    if size is None or isinstance(size, int):
+        return size
+    match = MEMORY_SIZE_PATTERN.match(str(size))
+    if match is None:
+        raise Exception(f"Invalid memory size {size}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()])
 
 
 def save_list(my_list, path):
@@ -42,39 +77,37 @@ def check_if_exist(path):
     return os.path.exists(path)
 
 
-def upload_graph_db(graphdb_url, repository_id, data_file, contenttype):
+def upload_graph_db(graphdb_url, repository_id, data_file, contenttype, chunk_size=None, workers=4, retries=5,
+                    checkpoint_path=None, compress=True, parse_in_memory=False):
     """
-    Import the data in graphdb based on the tupe specified by contetype(json/ttl tested)
+    Import the data in graphdb based on the tupe specified by contetype(json/ttl tested).
+    N-Triples are sent gzip compressed in chunks, Turtle is streamed as one request, see BulkUploader.
 
     @param graphdb_url:
     @param repository_id:
-    @param contenttype:
+    @param contenttype: content type of the data file
     @param data_file:
-    @return:
+    @param chunk_size: uncompressed size of a chunk in bytes, None for the default size
+    @param workers: number of chunks sent at the same time
+    @param retries: number of times a failed chunk is sent again
+    @param checkpoint_path: JSON file recording the uploaded chunks, an interrupted upload continues from it
+    @param compress: send the chunks with gzip content encoding
+    @param parse_in_memory: parse a small file of another format (e.g. JSON-LD) in memory and send it as N-Triples
+    @return: upload report, see BulkUploader.report
     """
+    from LinkedDicomTe.BulkUploader import BulkUploader, DEFAULT_CHUNK_SIZE, RDF_FORMATS
 
     # Define the URL for the GraphDB REST API endpoint to upload data
     upload_url = f"{graphdb_url}/repositories/{repository_id}/statements"
 
-    # Load JSON-LD data from a file
-
-    with open(data_file, "r") as file:
-        data = file.read()
-        data = data.encode('utf-8')
-
-    # Set headers for the HTTP request
-    headers = {
-        "Content-Type": contenttype,
-    }
-
-    # Send a POST request to upload the data to GraphDB
-    response = requests.post(upload_url, data=data, headers=headers)
-
-    # Check the response
-    if response.status_code in (200, 204):
-        print("Data imported successfully.")
-    else:
-        print("Error importing data. Status code:", response.status_code)
-        print("Response content:", response.content)
+    uploader = BulkUploader(upload_url, chunk_size=chunk_size or DEFAULT_CHUNK_SIZE, workers=workers,
+                            retries=retries, compress=compress)
+    # N-Triples files are recognized from their content, also when the content type says Turtle
+    rdf_format = RDF_FORMATS.get(contenttype)
+    if rdf_format == "turtle":
+        rdf_format = None
+    report = uploader.upload_file(data_file, rdf_format, checkpoint_path, parse_in_memory)
+    print("Data imported successfully.")
+    return report
 
 # Reading the list back from the plain text file
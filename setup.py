@@ -17,8 +17,13 @@ setup(
         "click",
         "pynetdicom",
         "requests",
-        "dicompyler-core"
+        "dicompyler-core",
+        "scipy"
     ],
+    extras_require={
+        "store": ["oxrdflib"],
+        "parquet": ["pyarrow"]
+    },
     entry_points = {
         'console_scripts': [
             'ldcm-parse = LinkedDicomTe.cli:main_parse',
@@ -26,7 +31,8 @@ setup(
             'ldcm-calc-dvh = LinkedDicomTe.cli:calc_dvh',
             'ldcm-scp = LinkedDicomTe.CLI_SCP:start_scp',
             'ldcm-upload = LinkedDicomTe.cli:upload_graph',
-            'ldcm-dvh-from-file = LinkedDicomTe.cli:DVH_from_folder_file'
+            'ldcm-dvh-from-file = LinkedDicomTe.cli:DVH_from_folder_file',
+            'ldcm-dvh-export = LinkedDicomTe.cli:export_dvh_results'
         ]
     },
     package_data = {
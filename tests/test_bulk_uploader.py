@@ -0,0 +1,148 @@
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from LinkedDicomTe.BulkUploader import BulkUploader, chunk_lines
+
+TRIPLE = "<http://example.org/s{0}> <http://example.org/p> \"value {0}\" .\n"
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                block = self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+                body += block
+        else:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        status = self.server.respond(body)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RecordingServer(ThreadingHTTPServer):
+    """
+    Records the decompressed request bodies. The status of a request is taken from the statuses of its first
+    triple, which default to 204.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RecordingHandler)
+        self.lock = threading.Lock()
+        self.bodies = []
+        self.statuses = {}
+
+    def respond(self, body):
+        with self.lock:
+            statuses = self.statuses.get(body.split(b" ", 1)[0], [])
+            status = statuses.pop(0) if statuses else 204
+            if status < 300:
+                self.bodies.append(body)
+            return status
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/statements"
+
+
+@pytest.fixture
+def server():
+    server = RecordingServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def write_ntriples(folder, count):
+    path = folder / "data.nt"
+    path.write_text("".join(TRIPLE.format(index) for index in range(count)))
+    return str(path)
+
+
+def first_subjects(path, chunk_size):
+    with open(path, "rb") as file:
+        return [chunk.split(b" ", 1)[0] for _, chunk, _ in chunk_lines(file, chunk_size)]
+
+
+def test_chunks_arrive_compressed_and_complete(tmp_path, server):
+    path = write_ntriples(tmp_path, 1000)
+    uploader = BulkUploader(server.url, chunk_size=4096, workers=3)
+    report = uploader.upload_file(path)
+
+    assert report["chunks"] == len(server.bodies) > 1
+    assert report["triples"] == 1000
+    assert report["sent_bytes"] < report["bytes"]
+    received = sorted(line for body in server.bodies for line in body.decode().splitlines(keepends=True))
+    with open(path) as file:
+        assert received == sorted(file.readlines())
+
+
+def test_retry_status_is_sent_again_and_client_error_fails(tmp_path, server):
+    path = write_ntriples(tmp_path, 1000)
+    subjects = first_subjects(path, 4096)
+    server.statuses[subjects[0]] = [503, 503]
+    server.statuses[subjects[1]] = [400]
+    uploader = BulkUploader(server.url, chunk_size=4096, workers=2, backoff=0.01)
+
+    with pytest.raises(Exception, match=r"failed for chunks \[1\]"):
+        uploader.upload_file(path)
+    assert uploader.failed == [1]
+    assert server.statuses[subjects[0]] == []
+    assert len(server.bodies) == len(subjects) - 1
+    assert any(body.startswith(subjects[0]) for body in server.bodies)
+
+
+def test_rerun_with_checkpoint_sends_only_missing_chunks(tmp_path, server):
+    path = write_ntriples(tmp_path, 1000)
+    checkpoint = str(tmp_path / "checkpoint.json")
+    subjects = first_subjects(path, 4096)
+    server.statuses[subjects[2]] = [400]
+    uploader = BulkUploader(server.url, chunk_size=4096, workers=2)
+    with pytest.raises(Exception):
+        uploader.upload_file(path, checkpoint_path=checkpoint)
+    assert len(server.bodies) == len(subjects) - 1
+
+    server.bodies.clear()
+    report = uploader.upload_file(path, checkpoint_path=checkpoint)
+    assert report["skipped"] == len(subjects) - 1
+    assert report["chunks"] == 1
+    assert len(server.bodies) == 1 and server.bodies[0].startswith(subjects[2])
+
+
+def test_turtle_is_streamed_as_one_request(tmp_path, server):
+    path = tmp_path / "data.ttl"
+    path.write_text("@prefix ex: <http://example.org/> .\n" +
+                    "".join(f"ex:s{index} ex:p \"value {index}\" .\n" for index in range(1000)))
+    server.statuses[b"@prefix"] = [503]
+    uploader = BulkUploader(server.url, backoff=0.01)
+    report = uploader.upload_file(str(path))
+
+    assert report["chunks"] == 1
+    assert server.bodies == [path.read_bytes()]
+
+
+def test_other_formats_are_only_parsed_when_asked(tmp_path, server):
+    path = tmp_path / "data.jsonld"
+    path.write_text('{"@id": "http://example.org/s", "http://example.org/p": "value"}')
+    uploader = BulkUploader(server.url)
+    with pytest.raises(Exception, match="--stream"):
+        uploader.upload_file(str(path))
+    assert not server.bodies
+
+    report = uploader.upload_file(str(path), parse_in_memory=True)
+    assert report["triples"] == 1
+    assert server.bodies == [b'<http://example.org/s> <http://example.org/p> "value" .\n']
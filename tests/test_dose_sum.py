@@ -0,0 +1,54 @@
+import numpy as np
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+from LinkedDicomTe.rt.dose_sum import open_rt_dose, sum_doses
+from LinkedDicomTe.rt.parser_cache import parser_cache
+
+
+def write_rt_dose(folder, name, transfer_syntax, source="rtdose.dcm"):
+    ds = pydicom.dcmread(get_testdata_file(source))
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.is_implicit_VR = transfer_syntax == ImplicitVRLittleEndian
+    ds.is_little_endian = True
+    path = str(folder / name)
+    ds.save_as(path, write_like_original=False)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def empty_parser_cache():
+    parser_cache.clear()
+    yield
+    parser_cache.clear()
+
+
+@pytest.mark.parametrize("transfer_syntax", [ImplicitVRLittleEndian, ExplicitVRLittleEndian])
+@pytest.mark.parametrize("source", ["rtdose.dcm", "rtdose_1frame.dcm"])
+def test_memmapped_rt_dose_equals_loaded(tmp_path, transfer_syntax, source):
+    path = write_rt_dose(tmp_path, "rtdose.dcm", transfer_syntax, source)
+    memmapped = open_rt_dose(path, memmap_pixel_array=True)
+    loaded = open_rt_dose(path, memmap_pixel_array=False)
+    assert isinstance(memmapped.GetPixelArray(), np.memmap)
+    np.testing.assert_array_equal(memmapped.GetPixelArray(), loaded.GetPixelArray())
+    np.testing.assert_array_equal(loaded.GetPixelArray(), pydicom.dcmread(path).pixel_array)
+
+
+@pytest.mark.parametrize("source", ["rtdose_expb.dcm", "rtdose_rle.dcm"])
+def test_rt_dose_which_cannot_be_memmapped_is_loaded(source):
+    path = get_testdata_file(source)
+    parser = open_rt_dose(path, memmap_pixel_array=True)
+    assert not isinstance(parser.GetPixelArray(), np.memmap)
+    np.testing.assert_array_equal(parser.GetPixelArray(), pydicom.dcmread(path).pixel_array)
+
+
+@pytest.mark.parametrize("memmap_rtdose", [True, False])
+def test_sum_doses_of_both_vr_forms(tmp_path, memmap_rtdose):
+    implicit = write_rt_dose(tmp_path, "implicit.dcm", ImplicitVRLittleEndian)
+    explicit = write_rt_dose(tmp_path, "explicit.dcm", ExplicitVRLittleEndian)
+    ds = pydicom.dcmread(implicit)
+    expected = 2 * ds.pixel_array.astype(np.float32) * np.float32(ds.DoseGridScaling)
+    summed = sum_doses([implicit, explicit], memmap_rtdose=memmap_rtdose)
+    np.testing.assert_allclose(summed.GetPixelArray(), expected, rtol=1e-6)